@@ -14,26 +14,2133 @@
 """Archive manipulation library for the Docker rules."""
 
 # pylint: disable=g-import-not-at-top
+import array
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import errno
 import gzip
+import hashlib
+import heapq
 import io
+import json
+import mmap
 import os
+import pickle
+import posixpath
+import queue
+import shutil
+import stat
+import struct
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 
 try:
-  import lzma  # pylint: disable=g-import-not-at-top, unused-import
+  import lzma  # pylint: disable=g-import-not-at-top
   HAS_LZMA = True
 except ImportError:
   HAS_LZMA = False
 
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+  HAS_ZSTD = True
+except ImportError:
+  HAS_ZSTD = False
+
+try:
+  import lz4.frame  # pylint: disable=g-import-not-at-top
+  HAS_LZ4 = True
+except ImportError:
+  HAS_LZ4 = False
+
 # This is slightly a lie. We do support xz fallback through the xz tool, but
 # that is fragile. Users should stick to the expectations provided here.
 COMPRESSIONS = ('', 'gz', 'bz2', 'xz') if HAS_LZMA else ('', 'gz', 'bz2')
+if HAS_ZSTD:
+  COMPRESSIONS += ('zst',)
+if HAS_LZ4:
+  COMPRESSIONS += ('lz4',)
+
+# Magic numbers of the compressed formats tarfile cannot read by itself.
+_ZSTD_MAGIC = b'\050\265\057\375'
+_LZ4_MAGIC = b'\004\042\115\030'
+
+# Magic numbers of the compressed formats tarfile reads by itself.
+_GZIP_MAGIC = b'\037\213'
+_BZIP2_MAGIC = b'BZh'
+_XZ_MAGIC = b'\375\067\172\130\132\000'
+
+
+# The earliest time zip files can represent, 1980-01-01 00:00:00 UTC.
+ZIP_EPOCH = 315532800
+
+# Use a deterministic mtime that doesn't confuse other programs.
+# See: https://github.com/bazelbuild/bazel/issues/1299
+PORTABLE_MTIME = 946684800  # 2000-01-01 00:00:00.000 UTC
+
+# Default size of the uncompressed blocks handed to compression threads.
+DEFAULT_GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Default size limit of the compressed member cache.
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Members with less content than that are not worth a cache entry, and
+# members with more would evict too much of the cache.
+_CACHE_MIN_SIZE = 64 * 1024
+_CACHE_MAX_ENTRY_SIZE = 256 * 1024 * 1024
+
+# Default total size of the input files read ahead and not added yet, and the
+# maximum number of threads reading them.
+DEFAULT_PREFETCH_MAX_SIZE = 256 * 1024 * 1024
+_PREFETCH_THREADS = 4
+
+# Default size of the content of each compressed tar decompressed ahead and
+# not merged yet, and the size of the chunks it is decompressed by.
+DEFAULT_DECOMPRESS_BUFFER_SIZE = 64 * 1024 * 1024
+_DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# The commands decompressing to stdout on other cores, used when installed.
+_DECOMPRESS_COMMANDS = {
+    _GZIP_MAGIC: ['pigz', '-d', '-c'],
+    _XZ_MAGIC: ['xz', '-d', '-c', '-T0'],
+}
+
+# Default size of the entries sorted in memory before they are written to
+# disk, and the maximum number of sorted runs merged at once.
+DEFAULT_SORT_BUFFER_SIZE = 64 * 1024 * 1024
+_SORT_MAX_RUNS = 64
+# The maximum number of input files kept open while writing sorted members.
+_SORT_OPEN_FILES = 64
+# The attributes of the TarInfo of the members recorded to be sorted.
+_SORTED_INFO_FIELDS = ('name', 'mode', 'uid', 'gid', 'size', 'mtime', 'type',
+                       'linkname', 'uname', 'gname', 'devmajor', 'devminor',
+                       'pax_headers', 'sparse')
+
+# Files smaller than that are read on the main thread in a pipeline, and the
+# size and maximum number of the chunks read ahead for bigger ones.
+_READ_AHEAD_MIN_SIZE = 1024 * 1024
+_READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+_READ_AHEAD_CHUNKS = 4
+
+# Files smaller than that are copied through Python buffers rather than by
+# the kernel, it is not worth the extra system calls.
+_ZERO_COPY_MIN_SIZE = 64 * 1024
+
+# Default size of the buffer of output files.
+DEFAULT_OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# The holes of sparse files are observed as chunks of zeros of that size.
+_HOLE_CHUNK = bytes(64 * 1024)
+
+# The media types of OCI image layers, by compression.
+_OCI_LAYER_MEDIA_TYPES = {
+    '': 'application/vnd.oci.image.layer.v1.tar',
+    'gz': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'tgz': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'zst': 'application/vnd.oci.image.layer.v1.tar+zstd',
+    'zstd': 'application/vnd.oci.image.layer.v1.tar+zstd',
+}
+
+# The names of the OCI whiteouts, deleting a file of the lower layers, or
+# all the content of the directory of the opaque whiteout.
+_WHITEOUT_PREFIX = '.wh.'
+_OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+# The type of the members in the digest manifest.
+_MANIFEST_TYPES = {
+    tarfile.REGTYPE: 'file',
+    tarfile.AREGTYPE: 'file',
+    tarfile.CONTTYPE: 'file',
+    tarfile.DIRTYPE: 'directory',
+    tarfile.SYMTYPE: 'symlink',
+    tarfile.LNKTYPE: 'hardlink',
+    tarfile.CHRTYPE: 'char',
+    tarfile.BLKTYPE: 'block',
+    tarfile.FIFOTYPE: 'fifo',
+}
+
+
+def _copy_file_range(in_fd, in_offset, out_fd, out_offset, size):
+  """Copies a range of a file to another file, in the kernel if possible.
+
+  Uses copy_file_range(2), which can even share extents on filesystems that
+  support reflinks, then sendfile(2), and falls back to plain reads and
+  writes when neither is available for these files.
+
+  Args:
+    in_fd: the file descriptor to copy from.
+    in_offset: the offset to copy from.
+    out_fd: the file descriptor to copy to.
+    out_offset: the offset to copy to.
+    size: the number of bytes to copy.
+
+  Returns:
+    The number of bytes copied, less than `size` if the input is too short.
+  """
+  copied = 0
+  if hasattr(os, 'copy_file_range'):
+    try:
+      while copied < size:
+        n = os.copy_file_range(in_fd, out_fd, size - copied,
+                               in_offset + copied, out_offset + copied)
+        if n == 0:
+          return copied
+        copied += n
+    except OSError:
+      # Not supported between these files (e.g. across filesystems on older
+      # kernels), copy the rest another way.
+      pass
+  if copied < size and hasattr(os, 'sendfile'):
+    try:
+      os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+      while copied < size:
+        n = os.sendfile(out_fd, in_fd, in_offset + copied, size - copied)
+        if n == 0:
+          return copied
+        copied += n
+    except OSError:
+      pass
+  os.lseek(in_fd, in_offset + copied, os.SEEK_SET)
+  os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+  while copied < size:
+    data = os.read(in_fd, min(size - copied, DEFAULT_GZIP_BLOCK_SIZE))
+    if not data:
+      break
+    os.write(out_fd, data)
+    copied += len(data)
+  return copied
+
+
+def _split_extension(name):
+  """Splits the archive extension off a file name: foo.tar.gz, foo.tgz."""
+  directory, base = os.path.split(name)
+  end = base.find('.tar')
+  if end <= 0:
+    end = base.rfind('.')
+  if end <= 0:
+    end = len(base)
+  return os.path.join(directory, base[:end]), base[end:]
+
+
+def _volume_name(name, number):
+  """Returns the name of a volume of an archive: foo.001.tar.gz."""
+  stem, extension = _split_extension(name)
+  return '%s.%03d%s' % (stem, number, extension)
+
+
+def _compressed_size_bound(size):
+  """Returns a bound of the size of some data compressed in blocks.
+
+  This is more than the worst case expansion of all the supported formats,
+  with the headers and trailers of blocks of at least 64KiB.
+  """
+  return size + size // 64 + 1024
+
+
+def _data_extents(fd, size):
+  """Returns the (offset, size) of the data extents of a file.
+
+  Holes are found with SEEK_DATA and SEEK_HOLE. Without them, or on file
+  systems without holes, the whole file is a single extent.
+
+  Args:
+    fd: the file descriptor of the file. Its offset is changed.
+    size: the size of the file.
+  """
+  if not hasattr(os, 'SEEK_DATA'):
+    return [(0, size)]
+  extents = []
+  offset = 0
+  try:
+    while offset < size:
+      try:
+        start = os.lseek(fd, offset, os.SEEK_DATA)
+      except OSError as e:
+        if e.errno != errno.ENXIO:
+          raise
+        # Only a hole remains.
+        break
+      end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+      extents.append((start, end - start))
+      offset = end
+  except OSError:
+    return [(0, size)]
+  return extents
+
+
+class _SparseContent(object):
+  """The content of a sparse member in the PAX 1.0 format of GNU tar.
+
+  That is the sparse map, the number of extents then the offset and size of
+  each, in decimal lines padded to a block, followed by the data of the
+  extents.
+  """
+
+  def __init__(self, fileobj, extents):
+    self._fileobj = fileobj
+    self._extents = collections.deque(
+        (offset, size) for offset, size in extents if size)
+    lines = ['%d\n' % len(extents)]
+    lines += ['%d\n%d\n' % extent for extent in extents]
+    sparse_map = ''.join(lines).encode('ascii')
+    self._map = sparse_map + tarfile.NUL * (
+        -len(sparse_map) % tarfile.BLOCKSIZE)
+    self.size = len(self._map) + sum(size for _, size in self._extents)
+
+  def read(self, size):
+    chunks = []
+    while size > 0 and (self._map or self._extents):
+      if self._map:
+        data = self._map[:size]
+        self._map = self._map[len(data):]
+      else:
+        offset, length = self._extents[0]
+        self._fileobj.seek(offset)
+        data = self._fileobj.read(min(size, length))
+        if not data:
+          break
+        if len(data) == length:
+          self._extents.popleft()
+        else:
+          self._extents[0] = (offset + len(data), length - len(data))
+      chunks.append(data)
+      size -= len(data)
+    return b''.join(chunks)
+
+
+class _ObservedReader(object):
+  """Hands the content of a member to observers as it is read.
+
+  Only the bytes past those already observed are handed over, so the
+  content can be read twice, to compute a cache key then to write it.
+  Seeking past them, like _SparseContent does over the holes of a file,
+  hands the bytes skipped over as zeros.
+  """
+
+  def __init__(self, fileobj, size, observers):
+    """Wraps a file object.
+
+    Args:
+      fileobj: the file to read the content from.
+      size: the size of the content.
+      observers: the functions to call with the content, in order.
+    """
+    self._fileobj = fileobj
+    self._size = size
+    self._observers = observers
+    self.name = getattr(fileobj, 'name', '')
+    try:
+      self._start = fileobj.tell()
+    except (AttributeError, OSError):
+      self._start = 0
+    # Positions relative to the start of the content.
+    self._position = 0
+    self._observed = 0
+
+  def _observe(self, data):
+    for observer in self._observers:
+      observer(data)
+
+  def _observe_zeros(self, end):
+    while self._observed < end:
+      with memoryview(_HOLE_CHUNK) as zeros:
+        size = min(end - self._observed, len(zeros))
+        self._observe(zeros[:size])
+      self._observed += size
+
+  def read(self, size=-1):
+    data = self._fileobj.read(size)
+    end = self._position + len(data)
+    if end > self._observed:
+      self._observe_zeros(self._position)
+      if self._observed > self._position:
+        self._observe(data[self._observed - self._position:])
+      else:
+        self._observe(data)
+      self._observed = end
+    self._position = end
+    return data
+
+  def tell(self):
+    return self._start + self._position
+
+  def seekable(self):
+    return self._fileobj.seekable()
+
+  def seek(self, offset):
+    self._fileobj.seek(offset)
+    self._position = offset - self._start
+
+  def finish(self):
+    """Hands the end of the content over, a hole if it was not read."""
+    self._observe_zeros(self._size)
+
+
+class _DigestWriter(object):
+  """Computes the SHA-256 and the size of what is written to a file object."""
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.sha256 = hashlib.sha256()
+    self.size = 0
+
+  def write(self, data):
+    self.update(data)
+    return self.fileobj.write(data)
+
+  def update(self, data):
+    """Accounts for data written to the file object by other means."""
+    self.sha256.update(data)
+    self.size += len(data)
+
+  def tell(self):
+    return self.fileobj.tell()
+
+  def flush(self):
+    self.fileobj.flush()
+
+  def close(self):
+    self.fileobj.close()
+
+
+def _layer_path(name):
+  """Returns the path of a member of a layer, to compare it across layers."""
+  return posixpath.normpath('/' + name).lstrip('/')
+
+
+def _is_whited_out(path, deleted, opaque):
+  """Whether whiteouts delete a path, see TarFileWriter.merge_tars()."""
+  if path in deleted:
+    return True
+  while path:
+    path = posixpath.dirname(path)
+    if path in deleted or path in opaque:
+      return True
+  return False
+
+
+def _crc32_operator(length):
+  """Returns the GF(2) matrix that appends `length` zero bytes to a CRC-32.
+
+  The matrix is represented as a list of 32 column vectors. Applying it to
+  the CRC of some data A gives the CRC of A followed by `length` zero bytes,
+  which is what is needed to combine the CRCs of two consecutive blocks
+  (see crc32_combine() in zlib).
+  """
+
+  def times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+      if vector & 1:
+        result ^= matrix[i]
+      vector >>= 1
+      i += 1
+    return result
+
+  def square(matrix):
+    return [times(matrix, matrix[n]) for n in range(32)]
+
+  # Operator for one zero bit, then square it up to one zero byte.
+  odd = [0xedb88320] + [1 << n for n in range(31)]
+  result = [1 << n for n in range(32)]
+  operator = square(square(square(odd)))
+  while length:
+    if length & 1:
+      result = [times(operator, column) for column in result]
+    length >>= 1
+    if length:
+      operator = square(operator)
+  return result
+
+
+def _crc32_combine(crc1, crc2, operator):
+  """Combines two CRC-32 given the operator for the length of the second."""
+  result = 0
+  i = 0
+  while crc1:
+    if crc1 & 1:
+      result ^= operator[i]
+    crc1 >>= 1
+    i += 1
+  return result ^ crc2
+
+
+class OutputFile(object):
+  """An output file written with few system calls, and created atomically.
+
+  Writes are gathered in a large page aligned buffer, and written out in
+  chunks of its size. The content goes to a temporary file next to the
+  output, preallocated with posix_fallocate() when its size can be
+  estimated, so that big outputs are not fragmented. It is renamed to the
+  output on close(), so that a failed build never leaves a truncated
+  output behind. Seeking is supported, zipfile needs it to rewrite the
+  headers of its members. Outputs that exist and are not regular files,
+  like devices and FIFOs, are written to directly instead.
+
+  Attributes:
+    name: the name of the output.
+    syscalls: the number of system calls made to write the file.
+    bytes_written: the number of bytes written by these calls.
+    seconds: the time spent in these calls.
+  """
+
+  def __init__(self, name, size_hint=0,
+               buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE):
+    """Opens the temporary file.
+
+    Args:
+      name: the name of the output.
+      size_hint: the expected size of the output, 0 if unknown.
+      buffer_size: the size of the buffer.
+    """
+    self.name = name
+    self.closed = False
+    self.syscalls = 0
+    self.bytes_written = 0
+    self.seconds = 0.0
+    try:
+      regular = stat.S_ISREG(os.stat(name).st_mode)
+    except FileNotFoundError:
+      regular = True
+    if regular:
+      self._temp = '%s.%d.tmp' % (name, os.getpid())
+      self._fd = os.open(self._temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+    else:
+      # Renaming over a device or a FIFO would replace it.
+      self._temp = None
+      self._fd = os.open(name, os.O_WRONLY)
+    # Anonymous maps are page aligned.
+    self._buffer = mmap.mmap(-1, buffer_size)
+    self._used = 0
+    # The offset of the file descriptor, and the size of the content.
+    self._position = 0
+    self._size = 0
+    self._preallocated = 0
+    self._discarded = False
+    self._sha256 = None
+    if size_hint:
+      self.preallocate(size_hint)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    if t is not None:
+      self.discard()
+    self.close()
+
+  def _syscall(self, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    self.seconds += time.perf_counter() - start
+    self.syscalls += 1
+    return result
+
+  def _write(self, data):
+    with memoryview(data) as view:
+      if self._sha256:
+        self._sha256.update(view)
+      written = 0
+      while written < len(view):
+        written += self._syscall(os.write, self._fd, view[written:])
+    self.bytes_written += written
+    self._position += written
+    self._size = max(self._size, self._position)
+
+  def start_digest(self):
+    """Computes the SHA-256 of the content, which cannot be seeked anymore."""
+    if self._position:
+      raise ValueError('Content already written to %s' % self.name)
+    self._sha256 = hashlib.sha256()
+
+  def hexdigest(self):
+    """Returns the SHA-256 of the content, once closed, see start_digest()."""
+    return self._sha256.hexdigest()
+
+  def preallocate(self, size):
+    """Reserves space for the output, if the file system supports it."""
+    if (size <= self._preallocated or self._temp is None or
+        not hasattr(os, 'posix_fallocate')):
+      return
+    try:
+      self._syscall(os.posix_fallocate, self._fd, 0, size)
+    except OSError:
+      return
+    self._preallocated = size
+
+  def write(self, data):
+    size = len(data)
+    if self._used + size > len(self._buffer):
+      self.flush()
+    if size >= len(self._buffer):
+      self._write(data)
+    else:
+      self._buffer[self._used:self._used + size] = data
+      self._used += size
+    return size
+
+  def tell(self):
+    return self._position + self._used
+
+  def flush(self):
+    if self._used:
+      used = self._used
+      self._used = 0
+      with memoryview(self._buffer)[:used] as view:
+        self._write(view)
+
+  def fileno(self):
+    """Returns the file descriptor, flush() before writing to it."""
+    return self._fd
+
+  def seekable(self):
+    """Whether the output can be seeked, and written through fileno()."""
+    return self._sha256 is None and self._temp is not None
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if self._sha256:
+      raise io.UnsupportedOperation('%s is being hashed' % self.name)
+    self.flush()
+    if whence == os.SEEK_CUR:
+      offset += self._position
+    elif whence == os.SEEK_END:
+      offset += self._size
+    self._position = self._syscall(os.lseek, self._fd, offset, os.SEEK_SET)
+    # The content may have been written through fileno().
+    self._size = max(self._size, self._position)
+    return self._position
+
+  def discard(self):
+    """Makes close() remove the output instead of creating it."""
+    self._discarded = True
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      if not self._discarded:
+        self.flush()
+        if self._preallocated > self._size:
+          self._syscall(os.ftruncate, self._fd, self._size)
+    except:
+      self._discarded = True
+      raise
+    finally:
+      os.close(self._fd)
+      self._buffer.close()
+      if self._temp is not None:
+        if self._discarded:
+          os.remove(self._temp)
+        else:
+          os.replace(self._temp, self.name)
+
+  def stats(self):
+    return '%d bytes in %d system calls, %.0f MiB/s' % (
+        self.bytes_written, self.syscalls,
+        self.bytes_written / max(self.seconds, 1e-9) / (1024 * 1024))
+
+
+class _BlockCompressedWriter(object):
+  """A write-only file object compressing its input by blocks on threads.
+
+  The data written to this object is cut into blocks of `block_size` bytes.
+  Each block is compressed independently, on a pool of `threads` worker
+  threads (or inline if `threads` is 0), and the results are written in
+  order to the underlying file. The zlib, bz2 and lzma compressors release
+  the GIL, so the blocks really are compressed concurrently.
+
+  The output only depends on the block size and the compression settings,
+  never on the number of threads, so archives stay reproducible.
+
+  Subclasses implement _compress_block() and may write a header and a
+  trailer around the compressed blocks.
+
+  Attributes:
+    independent_blocks: whether each block can be decompressed on its own.
+    block_offsets: the offset in the output file of each block written.
+    block_observer: if set, called with the index and the result of
+        _compress_block() of each block, in order, as they are written.
+  """
+
+  independent_blocks = False
+
+  def __init__(self, name, threads=0, block_size=None):
+    self.name = name
+    self.fileobj = OutputFile(name)
+    self.block_size = block_size or self._default_block_size()
+    self.block_offsets = []
+    self.block_observer = None
+    self.closed = False
+    self._offset = 0
+    self._blocks = 0
+    self._buffer = bytearray()
+    self._pending = collections.deque()
+    self._executor = None
+    if threads > 0:
+      self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+    # Bound the number of blocks in flight to bound memory usage.
+    self._max_pending = 2 * threads
+    self._write_header()
+
+  def tell(self):
+    """Returns the number of uncompressed bytes written so far."""
+    return self._offset
+
+  def write(self, data):
+    self._buffer += data
+    self._offset += len(data)
+    while len(self._buffer) >= self.block_size:
+      block = bytes(self._buffer[:self.block_size])
+      del self._buffer[:self.block_size]
+      self._submit(block, last=False)
+    return len(data)
+
+  def flush(self):
+    # Flushing must not change the block boundaries, or the output would
+    # depend on when the caller decided to flush.
+    pass
+
+  def end_block(self):
+    """Ends the current block, so that the next write starts a new one.
+
+    Returns:
+      The index of the block the next write goes to.
+    """
+    if self._buffer:
+      self._submit(bytes(self._buffer), last=False)
+      self._buffer = bytearray()
+    return self._blocks
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      self._submit(bytes(self._buffer), last=True)
+      self._buffer = bytearray()
+      while self._pending:
+        self._output(self._pending.popleft().result())
+      self._write_trailer()
+    finally:
+      if self._executor:
+        self._executor.shutdown()
+      self.fileobj.close()
+
+  def output_size(self):
+    """Ends the current block and returns the size of the output so far."""
+    self.end_block()
+    while self._pending:
+      self._output(self._pending.popleft().result())
+    return self.fileobj.tell()
+
+  def _submit(self, block, last):
+    self._blocks += 1
+    args = self._block_arguments(block, last)
+    if not self._executor:
+      self._output(self._compress_block(*args))
+      return
+    if len(self._pending) >= self._max_pending:
+      self._output(self._pending.popleft().result())
+    self._pending.append(self._executor.submit(self._compress_block, *args))
+
+  def _output(self, result):
+    self.block_offsets.append(self.fileobj.tell())
+    if self.block_observer:
+      self.block_observer(len(self.block_offsets) - 1, result)
+    self._write_block(result)
+
+  def _default_block_size(self):
+    return DEFAULT_GZIP_BLOCK_SIZE
+
+  def _block_arguments(self, block, last):
+    """Returns the arguments of _compress_block(), called on the main thread.
+
+    Args:
+      block: the uncompressed data of the block.
+      last: whether this is the last block of the stream.
+    """
+    return (block, last)
+
+  def _compress_block(self, block, last):
+    """Compresses a block. Called on a worker thread."""
+    raise NotImplementedError()
+
+  def _write_block(self, result):
+    """Writes the result of _compress_block() to the output file."""
+    self.fileobj.write(result)
+
+  def _write_header(self):
+    pass
+
+  def _write_trailer(self):
+    pass
+
+
+class _ParallelGzipWriter(_BlockCompressedWriter):
+  """Block-parallel gzip compression, in the spirit of pigz.
+
+  The blocks are compressed as raw deflate streams ended by a sync flush,
+  primed with the last 32KiB of the previous block as dictionary, and
+  concatenated into a single gzip member. The CRC-32 of the blocks are
+  combined, so the output is a regular gzip file.
+  """
+
+  _DICTIONARY_SIZE = 32 * 1024
+
+  def __init__(self, name, threads=0, block_size=None, compresslevel=9,
+               mtime=0):
+    self.compresslevel = compresslevel
+    self.mtime = mtime
+    self._crc = 0
+    self._size = 0
+    self._dictionary = None
+    self._operators = {}
+    super(_ParallelGzipWriter, self).__init__(name, threads, block_size)
+
+  def _write_header(self):
+    # Same header as gzip.GzipFile, with the original file name.
+    filename = os.path.basename(self.name)
+    if filename.endswith('.gz'):
+      filename = filename[:-3]
+    filename = filename.encode('latin-1', 'replace')
+    if self.compresslevel == 9:
+      extra_flags = 2
+    elif self.compresslevel == 1:
+      extra_flags = 4
+    else:
+      extra_flags = 0
+    self.fileobj.write(b'\037\213\010')
+    self.fileobj.write(b'\010' if filename else b'\000')
+    self.fileobj.write(struct.pack('<LBB', self.mtime, extra_flags, 255))
+    if filename:
+      self.fileobj.write(filename + b'\000')
+
+  def _block_arguments(self, block, last):
+    dictionary = self._dictionary
+    self._dictionary = block[-self._DICTIONARY_SIZE:]
+    return (block, last, dictionary)
+
+  def _compress_block(self, block, last, dictionary):
+    if dictionary:
+      compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                                    -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                    zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+      compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                                    -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    data += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, zlib.crc32(block), len(block)
+
+  def _write_block(self, result):
+    data, crc, size = result
+    self.fileobj.write(data)
+    if size not in self._operators:
+      self._operators[size] = _crc32_operator(size)
+    self._crc = _crc32_combine(self._crc, crc, self._operators[size])
+    self._size += size
+
+  def _write_trailer(self):
+    self.fileobj.write(struct.pack('<LL', self._crc, self._size & 0xffffffff))
+
+
+class _ConcatenatedStreamsWriter(_BlockCompressedWriter):
+  """Compresses each block as an independent stream.
+
+  This is for the formats whose decoders read concatenated streams as a
+  single file. Subclasses implement _compress().
+  """
+
+  independent_blocks = True
+
+  def __init__(self, name, threads=0, block_size=None):
+    self._empty = True
+    super(_ConcatenatedStreamsWriter, self).__init__(name, threads, block_size)
+
+  def _compress(self, data):
+    """Compresses data to a complete stream. Called on a worker thread."""
+    raise NotImplementedError()
+
+  def _compress_block(self, block, last):
+    if not block:
+      return b''
+    return self._compress(block)
+
+  def _write_block(self, result):
+    if result:
+      self._empty = False
+      self.fileobj.write(result)
+
+  def _write_trailer(self):
+    # An empty file is not a valid stream.
+    if self._empty:
+      self.fileobj.write(self._compress(b''))
+
+  def next_file(self, name):
+    """Ends the output file, and writes the next blocks to a new one.
+
+    Each file is then a complete compressed file on its own.
+
+    Args:
+      name: the name of the new file.
+    """
+    self.output_size()
+    self._write_trailer()
+    self.fileobj.close()
+    self.name = name
+    self.fileobj = OutputFile(name)
+    self._empty = True
+
+  def cache_settings(self):
+    """Returns what the compressed output depends on, besides the input."""
+    return repr((type(self).__name__, self.block_size)).encode('utf-8')
+
+  def copy_stream(self, fileobj, offset, length, size):
+    """Copies complete compressed streams after the data written so far.
+
+    The streams are copied as a new block, by the kernel if the output can
+    be seeked, in chunks otherwise.
+
+    Args:
+      fileobj: the file to copy from.
+      offset: the offset of the streams in fileobj.
+      length: the compressed length of the streams.
+      size: the uncompressed size of the streams.
+
+    Returns:
+      The index of the block of the streams.
+    """
+    block = self.end_block()
+    while self._pending:
+      self._output(self._pending.popleft().result())
+    self._blocks += 1
+    self.block_offsets.append(self.fileobj.tell())
+    if self.fileobj.seekable():
+      self.fileobj.flush()
+      position = self.fileobj.tell()
+      if _copy_file_range(fileobj.fileno(), offset, self.fileobj.fileno(),
+                          position, length) != length:
+        raise EOFError('Unexpected end of file: %s' % fileobj.name)
+      self.fileobj.seek(position + length)
+    else:
+      fileobj.seek(offset)
+      tarfile.copyfileobj(fileobj, self.fileobj, length, EOFError)
+    self._offset += size
+    self._empty = self._empty and not length
+    return block
+
+
+class _GzipMembersWriter(_ConcatenatedStreamsWriter):
+  """gzip compression, one gzip member per block.
+
+  Like BGZF, every block can be decompressed without reading the previous
+  ones, at the cost of a slightly worse compression ratio.
+  """
+
+  def __init__(self, name, threads=0, block_size=None, compresslevel=9,
+               mtime=0):
+    self.compresslevel = compresslevel
+    self.mtime = mtime
+    super(_GzipMembersWriter, self).__init__(name, threads, block_size)
+
+  def _compress(self, data):
+    return gzip.compress(data, self.compresslevel, mtime=self.mtime)
+
+  def cache_settings(self):
+    return super(_GzipMembersWriter, self).cache_settings() + repr(
+        (self.compresslevel, self.mtime, zlib.ZLIB_RUNTIME_VERSION)).encode(
+            'utf-8')
+
+
+class _ParallelBzip2Writer(_ConcatenatedStreamsWriter):
+  """Block-parallel bzip2 compression.
+
+  Each block is compressed to a complete bzip2 stream. bzip2 decoders,
+  including bzip2 itself and Python's bz2 module, read concatenated streams
+  as a single file.
+  """
+
+  # One bzip2 block at the highest compression level.
+  _DEFAULT_BLOCK_SIZE = 900 * 1000
+
+  def __init__(self, name, threads=0, block_size=None, compresslevel=9):
+    self.compresslevel = compresslevel
+    super(_ParallelBzip2Writer, self).__init__(name, threads, block_size)
+
+  def _default_block_size(self):
+    return self._DEFAULT_BLOCK_SIZE
+
+  def _compress(self, data):
+    return bz2.compress(data, self.compresslevel)
+
+  def cache_settings(self):
+    return super(_ParallelBzip2Writer, self).cache_settings() + repr(
+        self.compresslevel).encode('utf-8')
+
+
+class _ZstdWriter(_ConcatenatedStreamsWriter):
+  """zstd compression, one frame per block.
+
+  Frames are self-contained and record their content size and checksum, so
+  the output is deterministic for a given block size and level whatever the
+  number of threads.
+  """
+
+  _DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+  def __init__(self, name, threads=0, block_size=None, level=3):
+    self.level = level
+    super(_ZstdWriter, self).__init__(name, threads, block_size)
+
+  def _default_block_size(self):
+    return self._DEFAULT_BLOCK_SIZE
+
+  def _compress(self, data):
+    # Compressor objects are not thread safe, use one per block.
+    compressor = zstandard.ZstdCompressor(level=self.level,
+                                          write_checksum=True)
+    return compressor.compress(data)
+
+  def cache_settings(self):
+    return super(_ZstdWriter, self).cache_settings() + repr(
+        (self.level, zstandard.__version__)).encode('utf-8')
+
+
+class _Lz4Writer(_ZstdWriter):
+  """lz4 compression, one frame per block."""
+
+  def __init__(self, name, threads=0, block_size=None, level=0):
+    super(_Lz4Writer, self).__init__(name, threads, block_size, level)
+
+  def _compress(self, data):
+    return lz4.frame.compress(data, compression_level=self.level,
+                              content_checksum=True)
+
+  def cache_settings(self):
+    return _ConcatenatedStreamsWriter.cache_settings(self) + repr(
+        (self.level, lz4.__version__)).encode('utf-8')
+
+
+def _xz_varint(value):
+  """Encodes an integer in the variable length format of xz."""
+  result = bytearray()
+  while value >= 0x80:
+    result.append((value & 0x7f) | 0x80)
+    value >>= 7
+  result.append(value)
+  return bytes(result)
+
+
+def _xz_padding(size):
+  return b'\000' * (-size % 4)
+
+
+class _ParallelXzWriter(_BlockCompressedWriter):
+  """Block-parallel xz compression.
+
+  Each block is compressed to a raw LZMA2 stream on a worker thread and
+  wrapped in an xz block, with its sizes recorded in the block header. The
+  blocks are followed by the index of the stream, like `xz -T` does, so the
+  output is a regular multi-block .xz file.
+  """
+
+  # Dictionary sizes of the LZMA2 presets 0 to 9, see xz(1).
+  _PRESET_DICT_SIZES = (
+      1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22,
+      1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26)
+  # Stream flags: CRC-32 check.
+  _STREAM_FLAGS = b'\000\001'
+
+  def __init__(self, name, threads=0, block_size=None, preset=6):
+    self.preset = preset
+    self._records = []
+    super(_ParallelXzWriter, self).__init__(name, threads, block_size)
+    # The dictionary never needs to be bigger than a block, and the LZMA2
+    # properties can only encode some dictionary sizes.
+    dict_size = min(self._PRESET_DICT_SIZES[preset], self.block_size)
+    self._dict_property = 0
+    while self._dict_size(self._dict_property) < dict_size:
+      self._dict_property += 1
+    self._filters = [{
+        'id': lzma.FILTER_LZMA2,
+        'preset': preset,
+        'dict_size': self._dict_size(self._dict_property),
+    }]
+
+  @staticmethod
+  def _dict_size(dict_property):
+    return (2 | (dict_property & 1)) << (dict_property // 2 + 11)
+
+  def _default_block_size(self):
+    # Same default as `xz -T`: three times the dictionary size.
+    return 3 * self._PRESET_DICT_SIZES[self.preset]
+
+  def _write_header(self):
+    self.fileobj.write(b'\3757zXZ\000' + self._STREAM_FLAGS)
+    self.fileobj.write(struct.pack('<L', zlib.crc32(self._STREAM_FLAGS)))
+
+  def _compress_block(self, block, last):
+    if not block:
+      return None
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_RAW,
+                                     filters=self._filters)
+    data = compressor.compress(block) + compressor.flush()
+    # Block flags: one filter, compressed and uncompressed sizes present.
+    header = b'\300' + _xz_varint(len(data)) + _xz_varint(len(block))
+    # Filter flags: LZMA2 with its one byte of properties.
+    header += _xz_varint(lzma.FILTER_LZMA2) + b'\001'
+    header += struct.pack('B', self._dict_property)
+    header += _xz_padding(len(header) + 1)
+    header = struct.pack('B', (len(header) + 1) // 4) + header
+    header += struct.pack('<L', zlib.crc32(header))
+    check = struct.pack('<L', zlib.crc32(block))
+    unpadded_size = len(header) + len(data) + len(check)
+    return (header + data + _xz_padding(len(data)) + check,
+            unpadded_size, len(block))
+
+  def _write_block(self, result):
+    if result:
+      data, unpadded_size, size = result
+      self.fileobj.write(data)
+      self._records.append((unpadded_size, size))
+
+  def _write_trailer(self):
+    index = b'\000' + _xz_varint(len(self._records))
+    for unpadded_size, size in self._records:
+      index += _xz_varint(unpadded_size) + _xz_varint(size)
+    index += _xz_padding(len(index))
+    index += struct.pack('<L', zlib.crc32(index))
+    self.fileobj.write(index)
+    footer = struct.pack('<L', len(index) // 4 - 1) + self._STREAM_FLAGS
+    self.fileobj.write(struct.pack('<L', zlib.crc32(footer)) + footer + b'YZ')
+
+
+class _PipelinedFile(object):
+  """A write-only file object handing its writes over to a thread.
+
+  Writes are gathered in chunks and queued, up to a bounded number of
+  chunks, for a thread that writes them in order to the wrapped file
+  object. When that object compresses its input, compression overlaps
+  with the production of the data, and the output is unchanged.
+  """
+
+  _CHUNK_SIZE = 256 * 1024
+  _MAX_PENDING = 16
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.name = getattr(fileobj, 'name', None)
+    self._buffer = bytearray()
+    self._offset = 0
+    self._error = None
+    self._queue = queue.Queue(self._MAX_PENDING)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      data = self._queue.get()
+      if data is None:
+        return
+      if self._error is None:
+        try:
+          self.fileobj.write(data)
+        except Exception as e:  # pylint: disable=broad-except
+          # Keep on draining the queue so that the writer is not blocked.
+          self._error = e
+
+  def _check(self):
+    if self._error is not None:
+      raise self._error
+
+  def tell(self):
+    return self._offset
+
+  def write(self, data):
+    self._check()
+    self._buffer += data
+    self._offset += len(data)
+    if len(self._buffer) >= self._CHUNK_SIZE:
+      self._queue.put(bytes(self._buffer))
+      self._buffer = bytearray()
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if self._thread.is_alive():
+      if self._buffer:
+        self._queue.put(bytes(self._buffer))
+        self._buffer = bytearray()
+      self._queue.put(None)
+      self._thread.join()
+      self.fileobj.close()
+    self._check()
+
+
+class _PathSet(object):
+  """A compact set of paths, for archives with millions of members.
+
+  A 64-bit fingerprint of each path is kept, in an open addressing table
+  made of two arrays of 64-bit integers, with where the path is, which takes
+  a few dozen bytes per path instead of the hundreds of bytes of a set of
+  strings. The paths themselves are appended to a temporary file, and read
+  back to be compared when their fingerprint matches, so that colliding
+  fingerprints never make distinct paths equal. The paths found last are
+  kept in memory, for the lookups of the same parent directories.
+  """
+
+  __slots__ = ('_hashes', '_where', '_mask', '_size', '_spill', '_buffer',
+               '_flushed', '_found')
+
+  # The size of the paths written to the temporary file at once.
+  _BUFFER_SIZE = 1 << 20
+  # The number of paths found last kept in memory.
+  _FOUND_SIZE = 1 << 12
+  # The bits of the length of a path, after its offset, in _where.
+  _LENGTH_BITS = 24
+
+  def __init__(self, capacity=1 << 16):
+    self._allocate(capacity)
+    self._spill = None
+    self._buffer = bytearray()
+    self._flushed = 0
+    self._found = set()
+
+  def _allocate(self, capacity):
+    self._hashes = array.array('Q', bytes(8 * capacity))
+    self._where = array.array('Q', bytes(8 * capacity))
+    self._mask = capacity - 1
+    self._size = 0
+
+  @staticmethod
+  def _fingerprint(data):
+    # An empty slot has a zero fingerprint.
+    return struct.unpack(
+        '<Q', hashlib.blake2b(data, digest_size=8).digest())[0] | 1
+
+  def _path(self, slot):
+    """Returns the encoded path of an occupied slot."""
+    where = self._where[slot]
+    offset = where >> self._LENGTH_BITS
+    length = where & ((1 << self._LENGTH_BITS) - 1)
+    if offset >= self._flushed:
+      offset -= self._flushed
+      return bytes(self._buffer[offset:offset + length])
+    return os.pread(self._spill.fileno(), length, offset)
+
+  def _find(self, fingerprint, data):
+    """Returns the slot of a path, or of the empty slot ending it."""
+    slot = (fingerprint >> 1) & self._mask
+    while self._hashes[slot] and (self._hashes[slot] != fingerprint or
+                                  self._path(slot) != data):
+      slot = (slot + 1) & self._mask
+    return slot
+
+  def _remember(self, data):
+    if len(self._found) >= self._FOUND_SIZE:
+      self._found.clear()
+    self._found.add(data)
+
+  def __contains__(self, path):
+    data = path.encode('utf-8', 'surrogateescape')
+    if data in self._found:
+      return True
+    if not self._hashes[self._find(self._fingerprint(data), data)]:
+      return False
+    self._remember(data)
+    return True
+
+  def __len__(self):
+    return self._size
+
+  def add(self, path):
+    self._add(path.encode('utf-8', 'surrogateescape'))
+
+  def update(self, other):
+    """Adds the paths of another _PathSet."""
+    # pylint: disable=protected-access
+    for slot, fingerprint in enumerate(other._hashes):
+      if fingerprint:
+        self._add(other._path(slot))
+
+  def _add(self, data):
+    if data in self._found:
+      return
+    fingerprint = self._fingerprint(data)
+    if self._hashes[self._find(fingerprint, data)]:
+      return
+    if len(data) >> self._LENGTH_BITS:
+      raise ValueError('Path too long: %r' % data[:100])
+    offset = self._flushed + len(self._buffer)
+    self._buffer += data
+    if len(self._buffer) >= self._BUFFER_SIZE:
+      if self._spill is None:
+        self._spill = tempfile.TemporaryFile(prefix='paths')
+      self._spill.write(self._buffer)
+      self._spill.flush()
+      self._flushed += len(self._buffer)
+      self._buffer = bytearray()
+    self._place(fingerprint, offset << self._LENGTH_BITS | len(data))
+    self._size += 1
+    # Keep the table at most two thirds full.
+    if 3 * self._size > 2 * self._mask:
+      old = zip(self._hashes, self._where)
+      self._allocate(2 * (self._mask + 1))
+      for fingerprint, where in old:
+        if fingerprint:
+          self._place(fingerprint, where)
+          self._size += 1
+
+  def _place(self, fingerprint, where):
+    """Stores a path known not to be in the table yet."""
+    slot = (fingerprint >> 1) & self._mask
+    while self._hashes[slot]:
+      slot = (slot + 1) & self._mask
+    self._hashes[slot] = fingerprint
+    self._where[slot] = where
+
+
+class _HeaderEncoder(object):
+  """Encodes the headers of simple members faster than tarfile.
+
+  Most members of an archive only differ by their name, size and mode, while
+  their type, owner and mtime repeat. For each combination of the latter,
+  this encoder keeps a header template with the constant fields and their
+  partial checksum, and only patches in the name, mode and size. Members
+  needing more than a single ustar header (long or non-ASCII names, big
+  numbers, pax headers, devices...) are left to tarfile, and the headers
+  encoded here are identical to those of tarfile.
+  """
+
+  # Offsets of the fields of a ustar header.
+  _NAME = slice(0, 100)
+  _MODE = slice(100, 108)
+  _SIZE = slice(124, 136)
+  _CHKSUM = slice(148, 156)
+
+  def __init__(self, tar_format):
+    if tar_format == tarfile.GNU_FORMAT:
+      self._magic = tarfile.GNU_MAGIC
+    else:
+      self._magic = tarfile.POSIX_MAGIC
+    self._templates = {}
+
+  def encode(self, info):
+    """Returns the header of info, or None if tarfile has to encode it."""
+    name = info.name
+    if info.type == tarfile.DIRTYPE and not name.endswith('/'):
+      name += '/'
+    size = info.size
+    if (info.pax_headers or len(name) > tarfile.LENGTH_NAME or
+        type(size) is not int or not 0 <= size <= 0o77777777777 or
+        info.mode is None):
+      return None
+    key = (info.type, info.linkname, info.uid, info.gid, info.uname,
+           info.gname, info.mtime)
+    template = self._templates.get(key)
+    if template is None:
+      template = self._make_template(info)
+      self._templates[key] = template
+    if not template:
+      return None
+    try:
+      name = name.encode('ascii')
+    except UnicodeEncodeError:
+      return None
+    mode = b'%07o\000' % (info.mode & 0o7777)
+    size = b'%011o\000' % size
+    header = bytearray(template[0])
+    header[0:len(name)] = name
+    header[self._MODE] = mode
+    header[self._SIZE] = size
+    checksum = template[1] + sum(name) + sum(mode) + sum(size)
+    header[self._CHKSUM] = b'%06o\000 ' % checksum
+    return bytes(header)
+
+  def _make_template(self, info):
+    """Returns the template header and its checksum, or False."""
+    for value, limit in ((info.uid, 0o7777777), (info.gid, 0o7777777),
+                         (info.mtime, 0o77777777777)):
+      if type(value) is not int or not 0 <= value <= limit:
+        return False
+    if info.type in (tarfile.CHRTYPE, tarfile.BLKTYPE) or info.type is None:
+      return False
+    strings = []
+    for value, length in ((info.linkname, tarfile.LENGTH_LINK),
+                          (info.uname, 32), (info.gname, 32)):
+      try:
+        value = value.encode('ascii')
+      except UnicodeEncodeError:
+        return False
+      if len(value) > length:
+        return False
+      strings.append(value + tarfile.NUL * (length - len(value)))
+    linkname, uname, gname = strings
+    header = b''.join([
+        tarfile.NUL * 100,  # name
+        tarfile.NUL * 8,  # mode
+        b'%07o\000' % info.uid,
+        b'%07o\000' % info.gid,
+        tarfile.NUL * 12,  # size
+        b'%011o\000' % info.mtime,
+        b'        ',  # checksum
+        info.type,
+        linkname,
+        self._magic,
+        uname,
+        gname,
+        tarfile.NUL * 16,  # devmajor, devminor
+        tarfile.NUL * 167,  # prefix and padding
+    ])
+    return header, sum(header)
+
+
+class _GzipMembersReader(object):
+  """Reads the concatenated members of a gzip file, noting where they start.
+
+  Attributes:
+    members: the (compressed offset, uncompressed offset) of each member
+        started so far, followed by the end offsets once the file is read.
+  """
+
+  _CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, fileobj):
+    self._fileobj = fileobj
+    self._pending = b''
+    self._offset = 0
+    self._size = 0
+    self._decompressor = None
+    self.members = []
+
+  def read(self, size=-1):
+    del size  # Any amount of data will do.
+    while True:
+      if not self._pending:
+        self._pending = self._fileobj.read(self._CHUNK_SIZE)
+        if not self._pending:
+          if self._decompressor:
+            raise EOFError('Truncated gzip member at %d' % self._offset)
+          self.members.append((self._offset, self._size))
+          return b''
+      if not self._decompressor:
+        self.members.append((self._offset, self._size))
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      decompressor = self._decompressor
+      data = decompressor.decompress(self._pending, 16 * self._CHUNK_SIZE)
+      if decompressor.eof:
+        rest = decompressor.unused_data
+        self._decompressor = None
+      else:
+        rest = decompressor.unconsumed_tail
+      self._offset += len(self._pending) - len(rest)
+      self._pending = rest
+      if data:
+        self._size += len(data)
+        return data
+
+
+class _CompressedMemberCache(object):
+  """An on-disk cache of compressed tar members.
+
+  Entries are files named after their key, and are evicted least recently
+  used first, by modification time, to keep the cache under a total size.
+  Entries are streamed to a temporary file and renamed into place, so builds
+  can share a cache directory and entries are never held in memory.
+
+  Attributes:
+    hits: the number of entries found.
+    misses: the number of entries not found.
+  """
+
+  def __init__(self, directory, max_size=DEFAULT_CACHE_MAX_SIZE):
+    self.directory = directory
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key):
+    """Returns an entry opened for reading, or None if there is none."""
+    path = self._path(key)
+    try:
+      f = open(path, 'rb')
+    except OSError:
+      self.misses += 1
+      return None
+    try:
+      # Mark the entry as recently used.
+      os.utime(path)
+    except OSError:
+      pass
+    self.hits += 1
+    return f
+
+  def put(self, key):
+    """Returns an OutputFile creating an entry when closed."""
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return OutputFile(path)
+
+  def evict(self):
+    """Removes the least recently used entries over the size limit."""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(self.directory):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+  def stats(self):
+    return '%d hits, %d misses' % (self.hits, self.misses)
+
+
+class _FileDeduplicator(object):
+  """Finds the files with the same content and metadata as a previous one.
+
+  Files are matched by device and inode first. Otherwise, only the files with
+  the same size and metadata as a previous one are hashed.
+
+  Attributes:
+    duplicates: the number of duplicate files written as links.
+    saved_bytes: the total size of their content.
+  """
+
+  def __init__(self):
+    # (device, inode, metadata) -> name
+    self._inodes = {}
+    # (size, metadata) -> (name, path) of the first file not hashed yet.
+    self._sizes = {}
+    # (size, metadata, digest) -> name
+    self._digests = {}
+    self.duplicates = 0
+    self.saved_bytes = 0
+
+  @staticmethod
+  def _digest(fileobj):
+    start = fileobj.tell()
+    digest = hashlib.sha256()
+    for data in iter(lambda: fileobj.read(1024 * 1024), b''):
+      digest.update(data)
+    fileobj.seek(start)
+    return digest.digest()
+
+  def find(self, fileobj, size, metadata):
+    """Looks for a previous file with the same content and metadata.
+
+    Args:
+      fileobj: the file, opened at its start.
+      size: its size.
+      metadata: the metadata that have to match.
+
+    Returns:
+      The name of the previous file or None, and the digest of the file if
+      it was computed, to pass to add().
+    """
+    st = os.fstat(fileobj.fileno())
+    name = self._inodes.get((st.st_dev, st.st_ino, metadata))
+    if name is not None or (size, metadata) not in self._sizes:
+      return name, None
+    first = self._sizes[(size, metadata)]
+    if first:
+      first_name, first_path = first
+      with open(first_path, 'rb') as f:
+        self._digests[(size, metadata, self._digest(f))] = first_name
+      self._sizes[(size, metadata)] = None
+    digest = self._digest(fileobj)
+    return self._digests.get((size, metadata, digest)), digest
 
+  def add(self, name, path, fileobj, size, metadata, digest=None):
+    """Remembers a file written to the archive, see find()."""
+    st = os.fstat(fileobj.fileno())
+    self._inodes.setdefault((st.st_dev, st.st_ino, metadata), name)
+    if (size, metadata) not in self._sizes:
+      self._sizes[(size, metadata)] = (name, path)
+    elif digest is not None:
+      self._digests.setdefault((size, metadata, digest), name)
 
-# Use a deterministic mtime that doesn't confuse other programs.
-# See: https://github.com/bazelbuild/bazel/issues/1299
-PORTABLE_MTIME = 946684800  # 2000-01-01 00:00:00.000 UTC
+  def stats(self):
+    return '%d duplicate files, %d bytes saved' % (self.duplicates,
+                                                   self.saved_bytes)
+
+
+class _InputPrefetcher(object):
+  """Reads ahead the input files about to be added, into the page cache.
+
+  The files are planned in the order they will be added, and the next few
+  are read on background threads, up to a number of files and a total size
+  in flight, so that the writer does not stall on opening and reading them
+  when the page cache is cold or the files are on a network file system.
+
+  Attributes:
+    ready: the number of files fully read ahead by the time they were added.
+    in_flight: the number of files still being read ahead when added.
+    unplanned: the number of files added that were not read ahead.
+  """
+
+  def __init__(self, lookahead, max_size=DEFAULT_PREFETCH_MAX_SIZE):
+    self.lookahead = lookahead
+    self.max_size = max_size
+    # [path, size] of the files planned and not read yet, size is None
+    # until stat'ed.
+    self._planned = collections.deque()
+    # (path, size, future) of the files being read or read ahead, in order.
+    self._pending = collections.deque()
+    self._pending_size = 0
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        min(lookahead, _PREFETCH_THREADS))
+    self.ready = 0
+    self.in_flight = 0
+    self.unplanned = 0
+
+  @staticmethod
+  def _read(path):
+    try:
+      with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+          os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        # The advice is not followed by every file system, read it anyway.
+        buf = bytearray(1024 * 1024)
+        while f.readinto(buf):
+          pass
+    except OSError:
+      # Let the writer report it, if the file is added at all.
+      pass
+
+  def _fill(self):
+    while self._planned and len(self._pending) < self.lookahead:
+      planned = self._planned[0]
+      if planned[1] is None:
+        try:
+          planned[1] = os.stat(planned[0]).st_size
+        except OSError:
+          planned[1] = 0
+      path, size = planned
+      if self._pending and self._pending_size + size > self.max_size:
+        break
+      self._planned.popleft()
+      self._pending.append((path, size,
+                            self._executor.submit(self._read, path)))
+      self._pending_size += size
+
+  def plan(self, paths):
+    """Adds files to read ahead, in the order they will be added."""
+    self._planned.extend([path, None] for path in paths)
+    self._fill()
+
+  def added(self, path):
+    """Notes that a file is about to be added, to read the next ones."""
+    for i, (pending_path, _, _) in enumerate(self._pending):
+      if pending_path == path:
+        break
+    else:
+      self.unplanned += 1
+      return
+    # The files planned before this one were not added after all.
+    for _ in range(i + 1):
+      _, size, future = self._pending.popleft()
+      self._pending_size -= size
+    if future.done():
+      self.ready += 1
+    else:
+      self.in_flight += 1
+    self._fill()
+
+  def close(self):
+    self._planned.clear()
+    self._executor.shutdown()
+
+  def stats(self):
+    return ('%d files read ahead in time, %d still being read, '
+            '%d not planned' % (self.ready, self.in_flight, self.unplanned))
+
+
+def zip_date_time(timestamp):
+  """Returns the date_time of a zip entry from a unix timestamp."""
+  ts = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+  return (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
+
+
+def zip_file_info(name, date_time, mode=None):
+  """Returns the ZipInfo of a deflated file of a zip.
+
+  Args:
+    name: the path of the file in the zip.
+    date_time: the modification time of the file, see zip_date_time().
+    mode: the unix permission mode of the file, if any.
+  """
+  info = zipfile.ZipInfo(filename=name, date_time=date_time)
+  if mode:
+    info.external_attr = mode << 16
+  info.compress_type = zipfile.ZIP_DEFLATED
+  return info
+
+
+class _ZipFanOut(object):
+  """Writes the members of a tar to a zip, on a thread.
+
+  Regular files are deflated like build_zip does, directories and symbolic
+  links are stored the way Info-ZIP does. Zip files cannot represent hard
+  links and special files, they are left out.
+  """
+
+  _MAX_PENDING = 64
+
+  def __init__(self, name):
+    self.output = OutputFile(name)
+    self._zip = zipfile.ZipFile(self.output, 'w')
+    self._entry = None
+    self._error = None
+    self._queue = queue.Queue(self._MAX_PENDING)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      if self._error is None:
+        try:
+          self._apply(*item)
+        except Exception as e:  # pylint: disable=broad-except
+          # Keep on draining the queue so that the writer is not blocked.
+          self._error = e
+
+  def _apply(self, operation, argument):
+    if operation == 'open':
+      self._entry = self._zip.open(argument, 'w')
+    elif operation == 'write':
+      self._entry.write(argument)
+    elif operation == 'close':
+      self._entry.close()
+      self._entry = None
+    else:
+      self._zip.writestr(*argument)
+
+  def _put(self, operation, argument=None):
+    if self._error is not None:
+      raise self._error
+    self._queue.put((operation, argument))
+
+  def add(self, info):
+    """Adds a member of the tar to the zip.
+
+    Args:
+      info: the TarInfo of the member.
+
+    Returns:
+      The function to call with its content, if it is a regular file,
+      until the next call.
+    """
+    name = _layer_path(info.name)
+    date_time = zip_date_time(max(ZIP_EPOCH, info.mtime))
+    if not name:
+      return None
+    if info.isdir():
+      zip_info = zipfile.ZipInfo(filename=name + '/', date_time=date_time)
+      zip_info.external_attr = (stat.S_IFDIR | info.mode) << 16 | 0x10
+      self._put('writestr', (zip_info, b''))
+    elif info.issym():
+      zip_info = zipfile.ZipInfo(filename=name, date_time=date_time)
+      zip_info.external_attr = (stat.S_IFLNK | info.mode) << 16
+      self._put('writestr', (zip_info, info.linkname.encode('utf-8')))
+    elif info.isreg():
+      zip_info = zip_file_info(name, date_time, info.mode)
+      # Like writestr() does, for the zip to be the same.
+      zip_info.file_size = info.size
+      self._put('open', zip_info)
+      return self._write
+    else:
+      print('Cannot write %s to a zip file, leaving it out' % info.name)
+    return None
+
+  def _write(self, data):
+    self._put('write', bytes(data))
+
+  def end(self):
+    """Ends the content of the regular file last added."""
+    self._put('close')
+
+  def discard(self):
+    self.output.discard()
+
+  def close(self):
+    if self._thread.is_alive():
+      self._queue.put(None)
+      self._thread.join()
+    try:
+      if self._error is not None:
+        raise self._error
+      self._zip.close()
+    except:
+      self.output.discard()
+      raise
+    finally:
+      self.output.close()
+
+
+class _TeeFile(object):
+  """A write-only file object writing to several file objects."""
+
+  def __init__(self, fileobjs):
+    self.fileobjs = fileobjs
+
+  def tell(self):
+    return self.fileobjs[0].tell()
+
+  def write(self, data):
+    for fileobj in self.fileobjs:
+      fileobj.write(data)
+    return len(data)
+
+  def flush(self):
+    for fileobj in self.fileobjs:
+      fileobj.flush()
+
+
+def _compression_magic(path):
+  """Returns the magic number of a compressed file, None if it is not."""
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(len(_XZ_MAGIC))
+  except OSError:
+    return None
+  for magic in [_GZIP_MAGIC, _BZIP2_MAGIC] + ([_XZ_MAGIC] if HAS_LZMA else []):
+    if header.startswith(magic):
+      return magic
+  return None
+
+
+class _DecompressedStream(object):
+  """A read-only file object over a compressed file decompressed ahead.
+
+  The file is decompressed on a thread, by a decompression command if one is
+  installed for its format, or else in this process (zlib, bz2 and lzma
+  release the GIL), into a bounded queue of chunks.
+  """
+
+  def __init__(self, path, magic, buffer_size=DEFAULT_DECOMPRESS_BUFFER_SIZE):
+    self.name = path
+    self._magic = magic
+    self._chunks = queue.Queue(max(1, buffer_size // _DECOMPRESS_CHUNK_SIZE))
+    self._cancelled = threading.Event()
+    self._data = b''
+    self._offset = 0
+    self._eof = False
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _open(self):
+    """Returns the decompressed file object, and the process writing it."""
+    command = _DECOMPRESS_COMMANDS.get(self._magic)
+    if command and shutil.which(command[0]):
+      process = subprocess.Popen(command + [self.name], stdout=subprocess.PIPE)
+      return process.stdout, process
+    if self._magic == _GZIP_MAGIC:
+      return gzip.open(self.name, 'rb'), None
+    if self._magic == _BZIP2_MAGIC:
+      return bz2.open(self.name, 'rb'), None
+    return lzma.open(self.name, 'rb'), None
+
+  def _put(self, item):
+    while not self._cancelled.is_set():
+      try:
+        self._chunks.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def _run(self):
+    process = None
+    try:
+      fileobj, process = self._open()
+      with fileobj:
+        while not self._cancelled.is_set():
+          data = fileobj.read(_DECOMPRESS_CHUNK_SIZE)
+          if not data:
+            break
+          self._put(data)
+      if process:
+        if self._cancelled.is_set():
+          process.kill()
+        if process.wait() != 0 and not self._cancelled.is_set():
+          raise tarfile.ReadError('Cannot decompress %s' % self.name)
+      self._put(b'')
+    except Exception as e:  # pylint: disable=broad-except
+      self._put(e)
+    finally:
+      if process and process.poll() is None:
+        process.kill()
+        process.wait()
+
+  def read(self, size=-1):
+    chunks = []
+    while not self._eof and (size < 0 or size > 0):
+      if self._offset == len(self._data):
+        data = self._chunks.get()
+        if isinstance(data, Exception):
+          raise data
+        if not data:
+          self._eof = True
+          break
+        self._data = data
+        self._offset = 0
+      end = len(self._data) if size < 0 else min(len(self._data),
+                                                 self._offset + size)
+      chunks.append(self._data[self._offset:end])
+      if size > 0:
+        size -= end - self._offset
+      self._offset = end
+    return b''.join(chunks)
+
+  def close(self):
+    """Stops the decompression, if it is not over."""
+    self._cancelled.set()
+    self._thread.join()
+
+
+class _TarDecompressor(object):
+  """Decompresses ahead the compressed tar files about to be merged.
+
+  The tars are planned in the order they will be merged, and the next few
+  compressed with gzip, bzip2 or xz are decompressed on background threads
+  or processes, each up to a bounded size ahead of its reader, so that
+  merging them does not wait on their decompression.
+
+  Attributes:
+    decompressed: the number of tars merged from their decompressed stream.
+    inline: the number of tars merged that were not decompressed ahead,
+        because they are not compressed or were not planned in time.
+  """
+
+  def __init__(self, lookahead, buffer_size=DEFAULT_DECOMPRESS_BUFFER_SIZE):
+    self.lookahead = lookahead
+    self.buffer_size = buffer_size
+    self._planned = collections.deque()
+    # How many times each path is in _planned, to look them up.
+    self._planned_counts = collections.Counter()
+    # (path, stream) of the tars being decompressed, in order, with a None
+    # stream for those that are not compressed.
+    self._pending = collections.deque()
+    self._streams = 0
+    self.decompressed = 0
+    self.inline = 0
+
+  def _next_planned(self):
+    path = self._planned.popleft()
+    self._planned_counts[path] -= 1
+    if not self._planned_counts[path]:
+      del self._planned_counts[path]
+    return path
+
+  def _fill(self):
+    while self._planned and self._streams < self.lookahead:
+      path = self._next_planned()
+      magic = _compression_magic(path)
+      stream = None
+      if magic:
+        stream = _DecompressedStream(path, magic, self.buffer_size)
+        self._streams += 1
+      self._pending.append((path, stream))
+
+  def _next_pending(self):
+    stream = self._pending.popleft()[1]
+    if stream:
+      self._streams -= 1
+    return stream
+
+  def _drop_pending(self):
+    stream = self._next_pending()
+    if stream:
+      stream.close()
+
+  def plan(self, paths):
+    """Adds files to decompress ahead, in the order they will be merged."""
+    self._planned.extend(paths)
+    self._planned_counts.update(paths)
+    self._fill()
+
+  def open(self, path):
+    """Returns the decompressed stream of a tar, None if not planned."""
+    for i, (pending_path, _) in enumerate(self._pending):
+      if pending_path == path:
+        break
+    else:
+      if path in self._planned_counts:
+        # All the tars being decompressed were not merged after all.
+        while self._pending:
+          self._drop_pending()
+        while self._next_planned() != path:
+          pass
+        self._fill()
+      self.inline += 1
+      return None
+    # The tars planned before this one were not merged after all.
+    for _ in range(i):
+      self._drop_pending()
+    stream = self._next_pending()
+    if stream:
+      self.decompressed += 1
+    else:
+      self.inline += 1
+    self._fill()
+    return stream
+
+  def close(self):
+    self._planned.clear()
+    self._planned_counts.clear()
+    while self._pending:
+      self._drop_pending()
+
+  def stats(self):
+    return '%d tars decompressed ahead, %d when merged' % (
+        self.decompressed, self.inline)
+
+
+class _ExternalSorter(object):
+  """Sorts records by key, with a bounded amount of memory.
+
+  Records are pickled and kept in memory up to a total size, then sorted and
+  written to a temporary file as a run. Iterating merges the runs, and the
+  records still in memory, at most _SORT_MAX_RUNS runs at a time. Keys must
+  be unique.
+
+  Attributes:
+    runs: the number of runs written to disk.
+  """
+
+  def __init__(self, directory, buffer_size=DEFAULT_SORT_BUFFER_SIZE):
+    self.directory = directory
+    self.buffer_size = buffer_size
+    self._records = []
+    self._size = 0
+    self._runs = []
+    self.runs = 0
+
+  def add(self, key, value):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    self._records.append((key, data))
+    self._size += len(data)
+    if self._size >= self.buffer_size:
+      self._records.sort(key=lambda record: record[0])
+      self._runs.append(self._write_run(self._records))
+      self._records = []
+      self._size = 0
+
+  def _write_run(self, records):
+    path = os.path.join(self.directory, 'run%d' % self.runs)
+    self.runs += 1
+    with open(path, 'wb') as f:
+      for record in records:
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+  @staticmethod
+  def _read_run(path):
+    with open(path, 'rb') as f:
+      while True:
+        try:
+          yield pickle.load(f)
+        except EOFError:
+          return
+
+  def _merge(self, runs):
+    return heapq.merge(*[self._read_run(run) for run in runs],
+                       key=lambda record: record[0])
+
+  def __iter__(self):
+    """Yields the (key, value) records in the order of their keys."""
+    while len(self._runs) > _SORT_MAX_RUNS:
+      runs = self._runs[:_SORT_MAX_RUNS]
+      self._runs = self._runs[_SORT_MAX_RUNS:] + [
+          self._write_run(self._merge(runs))]
+      for run in runs:
+        os.remove(run)
+    self._records.sort(key=lambda record: record[0])
+    for key, data in heapq.merge(self._merge(self._runs), self._records,
+                                 key=lambda record: record[0]):
+      yield key, pickle.loads(data)
+
+
+@contextlib.contextmanager
+def _open_tar(name, stream=None):
+  """Opens a tar file for reading, whatever its compression.
+
+  tarfile handles gzip, bzip2 and xz by itself, zstd and lz4 compressed files
+  are read as a stream through their decompressor.
+
+  Args:
+    name: the path of the tar file.
+    stream: if set, its content decompressed by a _DecompressedStream, to
+        read as a stream instead.
+
+  Yields:
+    The opened tarfile.TarFile.
+
+  Raises:
+    TarFileWriter.Error: if the module to decompress the file is missing.
+  """
+  if stream:
+    try:
+      with tarfile.open(name=name, mode='r|', fileobj=stream) as intar:
+        yield intar
+    finally:
+      stream.close()
+    return
+  with open(name, 'rb') as f:
+    magic = f.read(4)
+  # tarfile would only tell that the file is not a tar file.
+  if magic == _ZSTD_MAGIC and not HAS_ZSTD:
+    raise TarFileWriter.Error(
+        'Reading %s requires the zstandard module' % name)
+  if magic == _LZ4_MAGIC and not HAS_LZ4:
+    raise TarFileWriter.Error('Reading %s requires the lz4 module' % name)
+  if magic == _ZSTD_MAGIC:
+    fileobj = zstandard.ZstdDecompressor().stream_reader(
+        open(name, 'rb'), read_across_frames=True, closefd=True)
+  elif magic == _LZ4_MAGIC:
+    fileobj = lz4.frame.open(name, 'rb')
+  else:
+    with tarfile.open(name=name, mode='r:*') as intar:
+      yield intar
+    return
+  try:
+    with tarfile.open(name=name, mode='r|', fileobj=fileobj) as intar:
+      yield intar
+  finally:
+    fileobj.close()
 
 
 class SimpleArFile(object):
@@ -124,18 +2231,132 @@ class TarFileWriter(object):
                compressor='',
                root_directory='.',
                default_mtime=None,
-               preserve_tar_mtimes=True):
+               preserve_tar_mtimes=True,
+               compression_threads=0,
+               compression_block_size=None,
+               compression_level=None,
+               index=None,
+               low_memory=False,
+               splice_deps=False,
+               cache_dir=None,
+               cache_max_size=DEFAULT_CACHE_MAX_SIZE,
+               deduplicate=False,
+               sparse=False,
+               pipeline=False,
+               prefetch=0,
+               prefetch_max_size=DEFAULT_PREFETCH_MAX_SIZE,
+               sort=False,
+               sort_buffer_size=DEFAULT_SORT_BUFFER_SIZE,
+               volume_size=None,
+               size_hint=0,
+               digest_manifest=None,
+               descriptor=None,
+               decompress_ahead=0,
+               decompress_buffer_size=DEFAULT_DECOMPRESS_BUFFER_SIZE,
+               extra_outputs=()):
     """TarFileWriter wraps tarfile.open().
 
     Args:
       name: the tar file name.
-      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma.
+      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma, zst,
+          zstd, lz4.
       compressor: custom command to do the compression.
       root_directory: virtual root to prepend to elements in the archive.
       default_mtime: default mtime to use for elements in the archive.
           May be an integer or the value 'portable' to use the date
           2000-01-01, which is compatible with non *nix OSes'.
       preserve_tar_mtimes: if true, keep file mtimes from input tar file.
+      compression_threads: if positive, compress independent blocks on that
+          many threads instead of using a single compression stream.
+      compression_block_size: size of the blocks compressed by each thread,
+          the output only depends on this value, not on the thread count.
+      compression_level: compression level, or preset for xz. Defaults to
+          9 for gzip and bzip2, 6 for xz, 3 for zstd and 0 for lz4.
+      index: if set, path of a sidecar index to write. Compressed output is
+          then made of independently decodable blocks, a new one starting
+          with each member, and the index gives, for each member, the offset
+          of its block in the output and of its header in the tar stream.
+          Not supported with xz and custom compressors.
+      low_memory: if true, keep memory use bounded on archives with millions
+          of members: the written members are only remembered by a hash of
+          their name, and neither tarfile nor this writer keeps their TarInfo.
+      splice_deps: if true and the output is gzip compressed, the gzip
+          members of the gzip compressed tars merged without any change by
+          add_tar() are copied to the output as is, instead of being
+          decompressed and compressed again. Only the member holding the
+          end of the merged archive is compressed again, and the output ends
+          its archive in a member of its own, so that it can be spliced in
+          turn. Ignored with an index or a digest manifest.
+      cache_dir: if set, a directory where to cache the compressed members
+          with some content, so that the next builds reuse them instead of
+          compressing them again. Each of these members starts a new block,
+          like with an index, and the output is the same whether members
+          come from the cache or not. Not supported with xz and custom
+          compressors, ignored without compression.
+      cache_max_size: the size above which the least recently used entries
+          of the cache are removed, when closing the output.
+      deduplicate: if true, files added from the file system with the same
+          content and metadata as a previous one are written as hard links
+          to it.
+      sparse: if true, files added from the file system with holes are
+          written as sparse members in the PAX format of GNU tar, which only
+          store their data. Files without holes are not affected.
+      pipeline: if true, read the content of big files, write the tar
+          stream, and compress and write the output on separate threads,
+          through bounded queues. The output is the same.
+      prefetch: the number of input files planned with prefetch_files() to
+          read ahead on background threads, 0 to read none.
+      prefetch_max_size: the total size of the files read ahead and not
+          added yet above which no more are read ahead.
+      sort: if true, write all the members, including those of the merged
+          tars and the implicit directories, in the order of their names
+          when closing the output, whatever the order they were added in.
+          Hard links whose target sorts after them are written right after
+          it instead, so that the output can be extracted in order.
+          Members are recorded to temporary files, with the content that
+          cannot be read again from the inputs, and sorted with an external
+          merge sort.
+      sort_buffer_size: the size of the recorded members kept in memory
+          before they are sorted and written to a temporary file.
+      volume_size: if set, split the output into volumes of at most that
+          many bytes, each a complete archive cut on a member boundary.
+          The volumes are named after the output, numbered from 1 before
+          the extension (foo.001.tar.gz), and an index of the volumes and
+          of their members is written to foo.volumes.json, one JSON object
+          per volume. Not supported with an index, splice_deps, xz and
+          custom compressors.
+      size_hint: the expected size of the tar stream, to preallocate the
+          output file when it is not compressed. 0 if unknown.
+      digest_manifest: if set, path of a sidecar manifest to write, with one
+          JSON object per member giving its path, type, size, mode, uid,
+          gid, link target and, for regular files, the SHA-256 of its
+          content, computed as it is written. The holes of sparse files are
+          hashed as zeros. Contents are then always copied through memory,
+          never by the kernel.
+      descriptor: if set, path of a JSON file to write with the SHA-256 and
+          the size of the output (digest, size) and of the uncompressed tar
+          stream (diffID, uncompressedSize), as needed to describe an OCI
+          image layer, computed as they are written. It also gives the OCI
+          mediaType of the layer for the compressions that have one. Not
+          supported with volumes and custom compressors, splice_deps is
+          then ignored, and contents are always copied through memory.
+      decompress_ahead: the number of gzip, bzip2 or xz compressed tars
+          planned with prefetch_tars() to decompress ahead on background
+          threads, or with pigz or xz when installed, 0 to decompress them
+          when they are merged. They are still merged in order, as streams.
+      decompress_buffer_size: the size of the content of each tar
+          decompressed ahead and not merged yet above which its
+          decompression waits.
+      extra_outputs: (name, compression) of other outputs to write from the
+          same pass over the inputs, like the output with pipeline set. The
+          tar stream is written once and compressed for each output on
+          threads of its own. The compression may also be 'zip', to write
+          the members to a zip file instead, which cannot hold hard links
+          and special files. Implies pipeline, not supported with custom
+          compressors, cache_dir and volumes, and splice_deps is ignored.
+
+    Raises:
+      TarFileWriter.Error: if the compression settings are not supported.
     """
     self.preserve_mtime = preserve_tar_mtimes
     if default_mtime is None:
@@ -146,45 +2367,300 @@ class TarFileWriter(object):
       self.default_mtime = int(default_mtime)
 
     self.fileobj = None
+    # The OutputFile written, by this class or by self.fileobj.
+    self.output = None
+    open_args = {}
+    # In a pipeline, the blocks are compressed on at least one thread.
+    block_threads = compression_threads or (1 if pipeline else 0)
     self.compressor_cmd = (compressor or '').strip()
+    self.volume_size = volume_size
+    if volume_size:
+      if (index or splice_deps or self.compressor_cmd or
+          compression in ['xz', 'lzma']):
+        raise self.Error('Volumes cannot be written with these settings')
+      self.volumes_index = _split_extension(name)[0] + '.volumes.json'
+      self._volume_base = name
+      name = _volume_name(name, 1)
+    if extra_outputs:
+      if self.compressor_cmd or cache_dir or volume_size:
+        raise self.Error('Extra outputs cannot be written with these settings')
+      if deduplicate and any(c == 'zip' for _, c in extra_outputs):
+        raise self.Error('A zip cannot hold the hard links of deduplicate')
+      # Before any output is opened, not to leave temporary files behind.
+      for _, extra_compression in extra_outputs:
+        self._check_extra_output(extra_compression)
+      pipeline = True
+      block_threads = compression_threads or 1
+    if descriptor and (self.compressor_cmd or volume_size):
+      raise self.Error('A descriptor cannot be written with these settings')
+    if index and (self.compressor_cmd or compression in ['xz', 'lzma']):
+      raise self.Error('An index cannot be created for this compression')
+    if cache_dir and (self.compressor_cmd or compression in ['xz', 'lzma']):
+      raise self.Error('A cache cannot be used with this compression')
     if self.compressor_cmd:
       # Some custom command has been specified: no need for further
       # configuration, we're just going to use it.
       pass
     # Support xz compression through xz... until we can use Py3
     elif compression in ['xz', 'lzma']:
-      if HAS_LZMA:
+      preset = 6 if compression_level is None else compression_level
+      if HAS_LZMA and compression_threads > 0:
+        mode = 'w:'
+        self.fileobj = _ParallelXzWriter(
+            name,
+            threads=block_threads,
+            block_size=compression_block_size,
+            preset=preset)
+      elif HAS_LZMA and pipeline:
+        mode = 'w:'
+        self.output = OutputFile(name)
+        self.fileobj = _PipelinedFile(
+            lzma.LZMAFile(self.output, 'w', preset=preset))
+      elif HAS_LZMA:
         mode = 'w:xz'
+        open_args['preset'] = preset
       else:
-        self.compressor_cmd = 'xz -F {} -'.format(compression)
+        self.compressor_cmd = 'xz -F {} -{} -'.format(compression, preset)
     elif compression in ['bzip2', 'bz2']:
-      mode = 'w:bz2'
+      level = 9 if compression_level is None else compression_level
+      if compression_threads > 0 or index or cache_dir or volume_size:
+        mode = 'w:'
+        self.fileobj = _ParallelBzip2Writer(
+            name,
+            threads=block_threads,
+            block_size=compression_block_size,
+            compresslevel=level)
+      elif pipeline:
+        mode = 'w:'
+        self.output = OutputFile(name)
+        self.fileobj = _PipelinedFile(
+            bz2.BZ2File(self.output, 'w', compresslevel=level))
+      else:
+        mode = 'w:bz2'
+        open_args['compresslevel'] = level
+    elif compression in ['zst', 'zstd']:
+      if not HAS_ZSTD:
+        raise self.Error('zstd compression requires the zstandard module')
+      mode = 'w:'
+      self.fileobj = _ZstdWriter(
+          name,
+          threads=block_threads,
+          block_size=compression_block_size,
+          level=(3 if compression_level is None else compression_level))
+    elif compression == 'lz4':
+      if not HAS_LZ4:
+        raise self.Error('lz4 compression requires the lz4 module')
+      mode = 'w:'
+      self.fileobj = _Lz4Writer(
+          name,
+          threads=block_threads,
+          block_size=compression_block_size,
+          level=(0 if compression_level is None else compression_level))
     else:
       mode = 'w:'
       if compression in ['tgz', 'gz']:
+        level = 9 if compression_level is None else compression_level
         # The Tarfile class doesn't allow us to specify gzip's mtime attribute.
         # Instead, we manually reimplement gzopen from tarfile.py and set mtime.
-        self.fileobj = gzip.GzipFile(
-            filename=name, mode='w', compresslevel=9, mtime=self.default_mtime)
+        if index or splice_deps or cache_dir or volume_size:
+          self.fileobj = _GzipMembersWriter(
+              name,
+              threads=block_threads,
+              block_size=compression_block_size,
+              compresslevel=level,
+              mtime=self.default_mtime)
+        elif compression_threads > 0:
+          self.fileobj = _ParallelGzipWriter(
+              name,
+              threads=block_threads,
+              block_size=compression_block_size,
+              compresslevel=level,
+              mtime=self.default_mtime)
+        else:
+          self.output = OutputFile(name)
+          self.fileobj = gzip.GzipFile(
+              filename=name, mode='w', compresslevel=level,
+              fileobj=self.output, mtime=self.default_mtime)
+          if pipeline:
+            self.fileobj = _PipelinedFile(self.fileobj)
+    if isinstance(self.fileobj, _BlockCompressedWriter):
+      self.output = self.fileobj.fileobj
+    elif not self.output:
+      self.output = OutputFile(name)
+    self._outputs = [self.output]
+    # Whether the build failed, and the outputs are to be removed.
+    self._failed = False
+    self.descriptor = descriptor
+    if descriptor:
+      self._media_type = _OCI_LAYER_MEDIA_TYPES.get(compression)
+      self.output.start_digest()
+    self._size_hint = 0
     self.compressor_proc = None
     if self.compressor_cmd:
       mode = 'w|'
       self.compressor_proc = subprocess.Popen(self.compressor_cmd.split(),
                                               stdin=subprocess.PIPE,
-                                              stdout=open(name, 'wb'))
+                                              stdout=self.output)
       self.fileobj = self.compressor_proc.stdin
+    elif mode == 'w:' and self.fileobj is None:
+      # Compressed outputs end up much smaller than the tar stream, and
+      # would be truncated back, only preallocate uncompressed ones.
+      self._size_hint = min(size_hint, volume_size or size_hint)
+      self.output.preallocate(self._size_hint)
     self.name = name
     self.root_directory = root_directory.rstrip('/').rstrip('\\')
     self.root_directory = self.root_directory.replace('\\', '/')
 
-    self.tar = tarfile.open(name=name, mode=mode, fileobj=self.fileobj)
-    self.members = set([])
-    self.directories = set([])
+    self.tar = tarfile.open(name=name, mode=mode,
+                            fileobj=self.fileobj or self.output, **open_args)
+    self._header_encoder = _HeaderEncoder(self.tar.format)
+    self._zip = None
+    self._extras = []
+    try:
+      for extra_name, extra_compression in extra_outputs:
+        if extra_compression == 'zip':
+          self._zip = _ZipFanOut(extra_name)
+          self._outputs.append(self._zip.output)
+        else:
+          self._extras.append(self._open_extra_output(
+              extra_name, extra_compression, compression_threads,
+              compression_block_size, compression_level))
+    except:
+      for output in self._outputs:
+        output.discard()
+        output.close()
+      raise
+    if self._extras:
+      self.tar.fileobj = _TeeFile(
+          [self.tar.fileobj] + [extra for extra, _ in self._extras])
+    self._tar_digest = None
+    if descriptor:
+      self.tar.fileobj = self._tar_digest = _DigestWriter(self.tar.fileobj)
+    # Whether the tar stream goes straight to the output file, and can be
+    # copied to it by the kernel.
+    self._uncompressed = (mode == 'w:' and self.fileobj is None and
+                          not descriptor and not extra_outputs)
+    self.low_memory = low_memory
+    if low_memory:
+      self.members = _PathSet()
+      self.directories = _PathSet()
+    else:
+      self.members = set([])
+      self.directories = set([])
+    self.index = index
+    self.splice_deps = (splice_deps and not index and not digest_manifest and
+                        not descriptor and not extra_outputs and
+                        isinstance(self.fileobj, _GzipMembersWriter))
+    # (name, block, uncompressed offset, size) of each member, for the index.
+    self.index_entries = []
+    self.deduplicator = _FileDeduplicator() if deduplicate else None
+    self.sparse = sparse and self.tar.format == tarfile.PAX_FORMAT
+    self.digest_manifest = None
+    if digest_manifest:
+      self.digest_manifest = OutputFile(digest_manifest)
+    self._reader = None
+    if pipeline:
+      self._reader = concurrent.futures.ThreadPoolExecutor(1)
+    self.prefetcher = None
+    if prefetch > 0:
+      self.prefetcher = _InputPrefetcher(prefetch, prefetch_max_size)
+    self.decompressor = None
+    if decompress_ahead > 0:
+      self.decompressor = _TarDecompressor(decompress_ahead,
+                                           decompress_buffer_size)
+    self._sorter = None
+    if sort:
+      self._sorter = _ExternalSorter(tempfile.mkdtemp(prefix='sort'),
+                                     sort_buffer_size)
+      self._spool = open(os.path.join(self._sorter.directory, 'spool'), 'wb')
+      self._sorted_count = 0
+    if volume_size:
+      self._volumes = 0
+      self._start_volume(name)
+    self.cache = None
+    if cache_dir and isinstance(self.fileobj, _ConcatenatedStreamsWriter):
+      self.cache = _CompressedMemberCache(cache_dir, cache_max_size)
+      self._cache_settings = self.fileobj.cache_settings()
+      # [first block, end block, entry] of the members stored in the cache,
+      # the end block being None while the member is written. The blocks
+      # are streamed to the entries as they are written.
+      self._cache_stores = collections.deque()
+      self.fileobj.block_observer = self._store_cached_block
+
+  def _check_extra_output(self, compression):
+    """Raises an Error if an extra output cannot be written."""
+    if compression in ['xz', 'lzma'] and not HAS_LZMA:
+      raise self.Error('xz extra outputs require the lzma module')
+    if compression in ['zst', 'zstd'] and not HAS_ZSTD:
+      raise self.Error('zstd compression requires the zstandard module')
+    if compression == 'lz4' and not HAS_LZ4:
+      raise self.Error('lz4 compression requires the lz4 module')
+    if compression not in ['', 'tgz', 'gz', 'bzip2', 'bz2', 'xz', 'lzma',
+                           'zst', 'zstd', 'lz4', 'zip']:
+      raise self.Error('Unsupported compression: %s' % compression)
+
+  def _open_extra_output(self, name, compression, threads, block_size, level):
+    """Opens an extra output, see the extra_outputs argument.
+
+    The compression must have been checked with _check_extra_output().
+
+    Returns:
+      The file object to write the tar stream to, and the one to close.
+    """
+    if compression in ['tgz', 'gz']:
+      level = 9 if level is None else level
+      if threads > 0:
+        fileobj = _ParallelGzipWriter(name, threads=threads,
+                                      block_size=block_size,
+                                      compresslevel=level,
+                                      mtime=self.default_mtime)
+      else:
+        output = OutputFile(name)
+        fileobj = _PipelinedFile(gzip.GzipFile(
+            filename=name, mode='w', compresslevel=level, fileobj=output,
+            mtime=self.default_mtime))
+    elif compression in ['bzip2', 'bz2']:
+      level = 9 if level is None else level
+      if threads > 0:
+        fileobj = _ParallelBzip2Writer(name, threads=threads,
+                                       block_size=block_size,
+                                       compresslevel=level)
+      else:
+        output = OutputFile(name)
+        fileobj = _PipelinedFile(bz2.BZ2File(output, 'w', compresslevel=level))
+    elif compression in ['xz', 'lzma']:
+      preset = 6 if level is None else level
+      if threads > 0:
+        fileobj = _ParallelXzWriter(name, threads=threads,
+                                    block_size=block_size, preset=preset)
+      else:
+        output = OutputFile(name)
+        fileobj = _PipelinedFile(lzma.LZMAFile(output, 'w', preset=preset))
+    elif compression in ['zst', 'zstd']:
+      fileobj = _ZstdWriter(name, threads=threads or 1, block_size=block_size,
+                            level=(3 if level is None else level))
+    elif compression == 'lz4':
+      fileobj = _Lz4Writer(name, threads=threads or 1, block_size=block_size,
+                           level=(0 if level is None else level))
+    else:
+      output = OutputFile(name)
+      fileobj = _PipelinedFile(output)
+    if isinstance(fileobj, _BlockCompressedWriter):
+      output = fileobj.fileobj
+    self._outputs.append(output)
+    return fileobj, output
 
   def __enter__(self):
     return self
 
   def __exit__(self, t, v, traceback):
+    if t is not None:
+      # Do not leave a truncated output behind.
+      self._failed = True
+      for output in self._outputs:
+        output.discard()
+      if self.digest_manifest:
+        self.digest_manifest.discard()
     self.close()
 
   def add_dir(self,
@@ -221,33 +2697,7 @@ class TarFileWriter(object):
     if mtime is None:
       mtime = self.default_mtime
     path = path.rstrip('/').rstrip('\\')
-    if os.path.isdir(path):
-      # Remove trailing '/' (index -1 => last character)
-      if name[-1] in ('/', '\\'):
-        name = name[:-1]
-      # Add the x bit to directories to prevent non-traversable directories.
-      # The x bit is set to 1 only if the read bit is also set.
-      dirmode = (mode | ((0o444 & mode) >> 2)) if mode else mode
-      self.add_file(name + '/',
-                    tarfile.DIRTYPE,
-                    uid=uid,
-                    gid=gid,
-                    uname=uname,
-                    gname=gname,
-                    mtime=mtime,
-                    mode=dirmode)
-      if depth <= 0:
-        raise self.Error('Recursion depth exceeded, probably in '
-                         'an infinite directory loop.')
-      # Iterate over the sorted list of file so we get a deterministic result.
-      filelist = os.listdir(path)
-      filelist.sort()
-      for f in filelist:
-        new_name = name + '/' + f
-        new_path = os.path.join(path, f)
-        self.add_dir(new_name, new_path, uid, gid, uname, gname, mtime, mode,
-                     depth - 1)
-    else:
+    if not os.path.isdir(path):
       self.add_file(name,
                     tarfile.REGTYPE,
                     file_content=path,
@@ -257,18 +2707,478 @@ class TarFileWriter(object):
                     gname=gname,
                     mtime=mtime,
                     mode=mode)
+      return
+    # Add the x bit to directories to prevent non-traversable directories.
+    # The x bit is set to 1 only if the read bit is also set.
+    dirmode = (mode | ((0o444 & mode) >> 2)) if mode else mode
+    # Walk the tree depth first with an explicit stack of
+    # (name, path, depth, size) where size is None for directories, reusing
+    # the file types and sizes read by scandir.
+    stack = [(name, path, depth, None)]
+    while stack:
+      name, path, depth, size = stack.pop()
+      if size is not None:
+        self._add_file(name,
+                       tarfile.REGTYPE,
+                       file_content=path,
+                       file_size=size,
+                       uid=uid,
+                       gid=gid,
+                       uname=uname,
+                       gname=gname,
+                       mtime=mtime,
+                       mode=mode)
+        continue
+      # Remove trailing '/' (index -1 => last character)
+      if name[-1] in ('/', '\\'):
+        name = name[:-1]
+      self._add_file(name + '/',
+                     tarfile.DIRTYPE,
+                     uid=uid,
+                     gid=gid,
+                     uname=uname,
+                     gname=gname,
+                     mtime=mtime,
+                     mode=dirmode)
+      if depth <= 0:
+        raise self.Error('Recursion depth exceeded, probably in '
+                         'an infinite directory loop.')
+      # Iterate over the sorted list of file so we get a deterministic result.
+      with os.scandir(path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+      children = []
+      for entry in entries:
+        # Both follow symbolic links, like open() does.
+        size = None if entry.is_dir() else entry.stat().st_size
+        children.append((name + '/' + entry.name, entry.path, depth - 1, size))
+      stack.extend(reversed(children))
 
-  def _addfile(self, info, fileobj=None):
-    """Add a file in the tar file if there is no conflict."""
+  def _addfile(self, info, fileobj=None, extents=None):
+    """Add a file in the tar file if there is no conflict.
+
+    Args:
+      info: the TarInfo of the file.
+      fileobj: the file to read the content from.
+      extents: if set, the (offset, size) of the data in fileobj, to write
+          the file as a sparse member.
+
+    Returns:
+      Whether the file was added.
+    """
     if not info.name.endswith('/') and info.type == tarfile.DIRTYPE:
       # Enforce the ending / for directories so we correctly deduplicate.
       info.name += '/'
+    if self._sorter:
+      self._defer(info, fileobj, extents)
+      return True
     if info.name not in self.members:
-      self.tar.addfile(info, fileobj)
+      if self.index:
+        block = self.fileobj.end_block() if self.fileobj else None
+        self.index_entries.append((info.name, block, self.tar.offset,
+                                   info.size))
+      self._write_member(info, fileobj, extents)
       self.members.add(info.name)
-    elif info.type != tarfile.DIRTYPE:
+      return True
+    if info.type != tarfile.DIRTYPE:
       print('Duplicate file in archive: %s, '
             'picking first occurrence' % info.name)
+    return False
+
+  def _defer(self, info, fileobj=None, extents=None, deduplicate=False):
+    """Records a member to write when closing, see the sort argument."""
+    path = None
+    offset = 0
+    # Not the file objects of tarfile.extractfile(), which derive from them.
+    if type(fileobj) in (io.BufferedReader, io.FileIO):
+      path = fileobj.name
+      offset = fileobj.tell()
+    elif fileobj is not None:
+      # Keep the content that cannot be read again, from compressed tars or
+      # from memory.
+      path = self._spool.name
+      offset = self._spool.tell()
+      tarfile.copyfileobj(fileobj, self._spool, info.size)
+    fields = tuple(getattr(info, field) for field in _SORTED_INFO_FIELDS)
+    self._sorter.add((info.name, self._sorted_count),
+                     (fields, path, offset, extents, deduplicate))
+    self._sorted_count += 1
+
+  def _add_sorted(self):
+    """Writes the members recorded with sort, in the order of their names."""
+    sorter = self._sorter
+    self._sorter = None
+    self._spool.close()
+    files = collections.OrderedDict()
+    # The paths written, and the hard links waiting for their target to be
+    # written, by the path of their target.
+    written = _PathSet() if self.low_memory else set()
+    waiting = collections.defaultdict(list)
+
+    def release_links(info):
+      members = [info]
+      while members:
+        path = _layer_path(members.pop().name)
+        written.add(path)
+        for link in waiting.pop(path, ()):
+          self._addfile(link)
+          members.append(link)
+
+    try:
+      for _, (fields, path, offset, extents, deduplicate) in sorter:
+        info = tarfile.TarInfo()
+        for field, value in zip(_SORTED_INFO_FIELDS, fields):
+          setattr(info, field, value)
+        if (info.type == tarfile.LNKTYPE and
+            _layer_path(info.linkname) not in written):
+          waiting[_layer_path(info.linkname)].append(info)
+          continue
+        fileobj = None
+        if path is not None:
+          fileobj = files.get(path)
+          if fileobj is None:
+            fileobj = files[path] = open(path, 'rb')
+            if len(files) > _SORT_OPEN_FILES:
+              files.popitem(last=False)[1].close()
+          else:
+            files.move_to_end(path)
+          fileobj.seek(offset)
+        if deduplicate:
+          self._add_deduplicated(info, path, fileobj)
+        else:
+          self._addfile(info, fileobj, extents)
+        release_links(info)
+      # The links to targets that are not in the output keep their order.
+      for link in sorted((link for links in waiting.values() for link in links),
+                         key=lambda link: link.name):
+        self._addfile(link)
+    finally:
+      for f in files.values():
+        f.close()
+      shutil.rmtree(sorter.directory)
+
+  def _write_member(self, info, fileobj=None, extents=None):
+    """Write a member, header and content, to the output tar."""
+    tar = self.tar
+    entry = None
+    digest = None
+    observers = []
+    if self.digest_manifest:
+      entry = self._manifest_entry(info)
+      if info.isreg():
+        digest = hashlib.sha256()
+        observers.append(digest.update)
+    zip_content = self._zip.add(info) if self._zip else None
+    if zip_content:
+      observers.append(zip_content)
+    observed = None
+    if observers and fileobj is not None:
+      fileobj = observed = _ObservedReader(fileobj, info.size, observers)
+    if extents is not None:
+      info, fileobj = self._sparse_member(info, fileobj, extents)
+    header = self._header_encoder.encode(info)
+    if header is None:
+      header = info.tobuf(tar.format, tar.encoding, tar.errors)
+    key = None
+    if self.volume_size:
+      self._fit_in_volume(len(header) + tarfile.BLOCKSIZE * (
+          (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE))
+      self._volume_members.append(info.name)
+    if (self.cache and fileobj is not None and
+        _CACHE_MIN_SIZE <= info.size <= _CACHE_MAX_ENTRY_SIZE):
+      key = self._cache_key(header, fileobj, info.size)
+    cached = self.cache.get(key) if key else None
+    if cached is not None:
+      size = len(header) + tarfile.BLOCKSIZE * (
+          (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE)
+      with cached:
+        self.fileobj.copy_stream(cached, 0, os.fstat(cached.fileno()).st_size,
+                                 size)
+      tar.offset += size
+      if self._tar_digest:
+        self._hash_cached_member(header, fileobj, info.size)
+    else:
+      store = None
+      if key:
+        store = [self.fileobj.end_block(), None, self.cache.put(key)]
+        self._cache_stores.append(store)
+      tar.fileobj.write(header)
+      tar.offset += len(header)
+      if fileobj is not None:
+        self._write_content(fileobj, info.size)
+      if store:
+        store[1] = self.fileobj.end_block()
+    if self.cache:
+      self._store_cached_members()
+    if not self.low_memory:
+      tar.members.append(info)
+    if observed:
+      observed.finish()
+    if zip_content:
+      self._zip.end()
+    if entry:
+      if digest is not None:
+        entry['digest'] = 'sha256:' + digest.hexdigest()
+      self.digest_manifest.write(json.dumps(entry).encode('utf-8') + b'\n')
+
+  def _hash_cached_member(self, header, fileobj, size):
+    """Hashes a member written from the cache in the uncompressed stream."""
+    self._tar_digest.update(header)
+    remaining = size
+    while remaining:
+      data = fileobj.read(min(remaining, 1024 * 1024))
+      if not data:
+        raise self.Error('Unexpected end of file: %s' % fileobj.name)
+      self._tar_digest.update(data)
+      remaining -= len(data)
+    self._tar_digest.update(tarfile.NUL * (-size % tarfile.BLOCKSIZE))
+
+  @staticmethod
+  def _manifest_entry(info):
+    """Returns the entry of a member in the digest manifest, but its digest."""
+    return {
+        'path': info.name,
+        'type': _MANIFEST_TYPES.get(info.type, 'other'),
+        'size': info.size,
+        'mode': info.mode,
+        'uid': info.uid,
+        'gid': info.gid,
+        'link': info.linkname or None,
+        'digest': None,
+    }
+
+  def _start_volume(self, name):
+    self._volumes += 1
+    self._volume_name = name
+    self._volume_members = []
+    self._volume_start = self.tar.offset
+    # The size of the volume when the tar stream was at that offset.
+    self._volume_size_at = (self.tar.offset, 0)
+
+  def _remove_volumes(self):
+    """Removes the volumes finished and their index, after an error."""
+    paths = [_volume_name(self._volume_base, number)
+             for number in range(1, self._volumes + 1)]
+    for path in paths + [self.volumes_index]:
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+  def _fit_in_volume(self, size):
+    """Starts a new volume unless a member of that size fits in this one."""
+    # The end of archive marker and the padding written by tarfile.
+    trailer = 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE
+    bound = _compressed_size_bound if self.fileobj else lambda size: size
+    offset, volume_size = self._volume_size_at
+    if volume_size + bound(self.tar.offset - offset + size +
+                           trailer) <= self.volume_size:
+      return
+    if self.fileobj:
+      volume_size = self.fileobj.output_size()
+    else:
+      volume_size = self.tar.offset - self._volume_start
+    self._volume_size_at = (self.tar.offset, volume_size)
+    if (self.tar.offset == self._volume_start or
+        volume_size + bound(size + trailer) <= self.volume_size):
+      return
+    # End the volume like tarfile ends an archive.
+    padding = 2 * tarfile.BLOCKSIZE
+    padding += -(self.tar.offset - self._volume_start +
+                 padding) % tarfile.RECORDSIZE
+    self.tar.fileobj.write(tarfile.NUL * padding)
+    self.tar.offset += padding
+    name = _volume_name(self._volume_base, self._volumes + 1)
+    if self.fileobj:
+      self.fileobj.next_file(name)
+      self.output = self.fileobj.fileobj
+    else:
+      self.output.close()
+      self.output = self.tar.fileobj = OutputFile(name)
+    self.output.preallocate(self._size_hint)
+    self._outputs.append(self.output)
+    self._end_volume()
+    self._start_volume(name)
+
+  def _end_volume(self):
+    """Checks the size of the last volume written and adds it to the index."""
+    size = os.path.getsize(self._volume_name)
+    if size > self.volume_size:
+      raise self.Error('Volume %s is %d bytes, its first member does not fit'
+                       ' in %d bytes' % (self._volume_name, size,
+                                         self.volume_size))
+    with open(self.volumes_index, 'w' if self._volumes == 1 else 'a') as f:
+      f.write(json.dumps({
+          'name': os.path.basename(self._volume_name),
+          'size': size,
+          'members': self._volume_members,
+      }) + '\n')
+
+  def _sparse_member(self, info, fileobj, extents):
+    """Returns the TarInfo and the content of a sparse member."""
+    # Like GNU tar, name the member so that tools that do not support
+    # sparse members extract it apart, and keep the real name in the PAX
+    # header. The name must fit in the ustar header, or tarfile would add a
+    # path record overriding the real name.
+    directory, base = os.path.split(info.name)
+    name = os.path.join(directory, 'GNUSparseFile.0', base)
+    if len(name) > tarfile.LENGTH_NAME or not name.isascii():
+      name = './GNUSparseFile.0/' + hashlib.sha1(
+          info.name.encode('utf-8', 'surrogateescape')).hexdigest()
+    sparse_info = tarfile.TarInfo(name)
+    for attribute in ['mode', 'uid', 'gid', 'uname', 'gname', 'mtime']:
+      setattr(sparse_info, attribute, getattr(info, attribute))
+    sparse_info.pax_headers = {
+        'GNU.sparse.major': '1',
+        'GNU.sparse.minor': '0',
+        'GNU.sparse.name': info.name,
+        'GNU.sparse.realsize': str(info.size),
+    }
+    # A file ending with a hole ends with an empty extent, as with GNU tar.
+    if not extents or sum(extents[-1]) < info.size:
+      extents = extents + [(info.size, 0)]
+    content = _SparseContent(fileobj, extents)
+    sparse_info.size = content.size
+    return sparse_info, content
+
+  def _cache_key(self, header, fileobj, size):
+    """Returns the cache key of a member, None if it cannot be read twice."""
+    try:
+      start = fileobj.tell()
+      if not fileobj.seekable():
+        return None
+    except (AttributeError, OSError, tarfile.TarError):
+      return None
+    content = hashlib.sha256()
+    remaining = size
+    while remaining:
+      data = fileobj.read(min(remaining, 1024 * 1024))
+      if not data:
+        raise self.Error('Unexpected end of file: %s' % fileobj.name)
+      content.update(data)
+      remaining -= len(data)
+    fileobj.seek(start)
+    key = hashlib.sha256(self._cache_settings)
+    key.update(header)
+    key.update(content.digest())
+    return key.hexdigest()
+
+  def _store_cached_block(self, index, result):
+    """Appends a block written to the cache entry of its member, if any."""
+    for first_block, end_block, entry in self._cache_stores:
+      if index < first_block:
+        break
+      if end_block is None or index < end_block:
+        entry.write(result)
+        break
+
+  def _store_cached_members(self):
+    """Stores in the cache the members whose blocks are all written."""
+    written = len(self.fileobj.block_offsets)
+    while (self._cache_stores and self._cache_stores[0][1] is not None and
+           self._cache_stores[0][1] <= written):
+      _, _, entry = self._cache_stores.popleft()
+      try:
+        entry.close()
+      except OSError:
+        # The cache is best effort, e.g. another build may have evicted the
+        # temporary file.
+        pass
+
+  def _discard_cached_members(self):
+    """Removes the cache entries of the members not completely written."""
+    while self._cache_stores:
+      _, _, entry = self._cache_stores.popleft()
+      entry.discard()
+      entry.close()
+
+  def _write_content(self, fileobj, size):
+    """Write the content of a member, and its padding, to the output tar."""
+    out = self.tar.fileobj
+    in_fd = None
+    # Without compression, let the kernel copy the content of regular files
+    # straight to the output.
+    if size >= _ZERO_COPY_MIN_SIZE and self._uncompressed:
+      try:
+        in_fd = fileobj.fileno()
+      except (AttributeError, io.UnsupportedOperation):
+        pass
+    if in_fd is not None:
+      out.flush()
+      position = out.tell()
+      if _copy_file_range(in_fd, fileobj.tell(), out.fileno(), position,
+                          size) != size:
+        raise self.Error('Unexpected end of file: %s' % fileobj.name)
+      out.seek(position + size)
+    elif self._reader and size >= _READ_AHEAD_MIN_SIZE:
+      self._copy_read_ahead(fileobj, out, size)
+    else:
+      tarfile.copyfileobj(fileobj, out, size, bufsize=self.tar.copybufsize)
+    blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+      out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+      blocks += 1
+    self.tar.offset += blocks * tarfile.BLOCKSIZE
+
+  def _copy_read_ahead(self, fileobj, out, size):
+    """Copies content read ahead on the reader thread to the output."""
+    chunks = queue.Queue(_READ_AHEAD_CHUNKS)
+    cancelled = threading.Event()
+
+    def read():
+      remaining = size
+      try:
+        while remaining and not cancelled.is_set():
+          data = fileobj.read(min(remaining, _READ_AHEAD_CHUNK_SIZE))
+          if not data:
+            raise self.Error('Unexpected end of file: %s' %
+                             getattr(fileobj, 'name', ''))
+          chunks.put(data)
+          remaining -= len(data)
+      except Exception as e:  # pylint: disable=broad-except
+        chunks.put(e)
+
+    future = self._reader.submit(read)
+    remaining = size
+    try:
+      while remaining:
+        data = chunks.get()
+        if isinstance(data, Exception):
+          raise data
+        out.write(data)
+        remaining -= len(data)
+    except:
+      # Unblock the reader before giving up.
+      cancelled.set()
+      while not future.done():
+        try:
+          chunks.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      raise
+    future.result()
+
+  def prefetch_files(self, paths):
+    """Plans input files to read ahead, see the prefetch argument.
+
+    Args:
+      paths: the files and tar files about to be added, in the order they
+          will be added. Ignored unless prefetch was set.
+    """
+    if self.prefetcher:
+      self.prefetcher.plan(paths)
+
+  def prefetch_tars(self, paths):
+    """Plans tar files to decompress ahead, see decompress_ahead.
+
+    Only tars should be planned, other compressed files would take the
+    place of the tars merged after them.
+
+    Args:
+      paths: the tar files about to be merged, in the order they will be
+          merged. Ignored unless decompress_ahead was set.
+    """
+    if self.decompressor:
+      self.decompressor.plan(paths)
 
   def add_file(self,
                name,
@@ -298,11 +3208,33 @@ class TarFileWriter(object):
       mtime: modification time to put in the archive.
       mode: unix permission mode of the file, default 0644 (0755).
     """
-    name = name.replace('\\', '/')
     if file_content and os.path.isdir(file_content):
       # Recurse into directory
-      self.add_dir(name, file_content, uid, gid, uname, gname, mtime, mode)
+      self.add_dir(name.replace('\\', '/'), file_content, uid, gid, uname,
+                   gname, mtime, mode)
       return
+    self._add_file(name, kind, content, link, file_content, uid=uid, gid=gid,
+                   uname=uname, gname=gname, mtime=mtime, mode=mode)
+
+  def _add_file(self,
+                name,
+                kind=tarfile.REGTYPE,
+                content=None,
+                link=None,
+                file_content=None,
+                file_size=None,
+                uid=0,
+                gid=0,
+                uname='',
+                gname='',
+                mtime=None,
+                mode=None):
+    """Add a file whose file_content is not a directory, see add_file().
+
+    Args:
+      file_size: the size of file_content if already known, to save a fstat.
+    """
+    name = name.replace('\\', '/')
     if not (name == self.root_directory or name.startswith('/') or
             name.startswith(self.root_directory + '/')):
       name = self.root_directory + '/' + name
@@ -313,17 +3245,7 @@ class TarFileWriter(object):
     if mtime is None:
       mtime = self.default_mtime
 
-    components = name.rsplit('/', 1)
-    if len(components) > 1:
-      d = components[0]
-      self.add_file(d,
-                    tarfile.DIRTYPE,
-                    uid=uid,
-                    gid=gid,
-                    uname=uname,
-                    gname=gname,
-                    mtime=mtime,
-                    mode=0o755)
+    self._add_parents(name, uid, gid, uname, gname, mtime)
     tarinfo = tarfile.TarInfo(name)
     tarinfo.mtime = mtime
     tarinfo.uid = uid
@@ -342,14 +3264,79 @@ class TarFileWriter(object):
       tarinfo.size = len(content_bytes)
       self._addfile(tarinfo, io.BytesIO(content_bytes))
     elif file_content:
+      if self.prefetcher:
+        self.prefetcher.added(file_content)
       with open(file_content, 'rb') as f:
-        tarinfo.size = os.fstat(f.fileno()).st_size
-        self._addfile(tarinfo, f)
+        if file_size is None:
+          file_size = os.fstat(f.fileno()).st_size
+        tarinfo.size = file_size
+        extents = None
+        if self.sparse and kind == tarfile.REGTYPE and file_size:
+          extents = _data_extents(f.fileno(), file_size)
+          f.seek(0)
+        if extents is not None and extents != [(0, file_size)]:
+          self._addfile(tarinfo, f, extents)
+        elif self.deduplicator and kind == tarfile.REGTYPE and file_size:
+          self._add_deduplicated(tarinfo, file_content, f)
+        else:
+          self._addfile(tarinfo, f)
     else:
       if kind == tarfile.DIRTYPE:
         self.directories.add(name)
       self._addfile(tarinfo)
 
+  def _add_deduplicated(self, info, path, fileobj):
+    """Add a file, as a hard link if a previous file has the same content."""
+    if self._sorter:
+      # The first file in the output is the one to link to.
+      self._defer(info, fileobj, deduplicate=True)
+      return
+    # Hard links share their metadata as well.
+    metadata = (info.mode, info.uid, info.gid, info.uname, info.gname,
+                info.mtime)
+    target, digest = self.deduplicator.find(fileobj, info.size, metadata)
+    if target is None:
+      if self._addfile(info, fileobj):
+        self.deduplicator.add(info.name, path, fileobj, info.size, metadata,
+                              digest)
+      return
+    size = info.size
+    info.type = tarfile.LNKTYPE
+    info.linkname = target
+    info.size = 0
+    if self._addfile(info):
+      self.deduplicator.duplicates += 1
+      self.deduplicator.saved_bytes += size
+
+  def _add_parents(self, name, uid, gid, uname, gname, mtime):
+    """Add the missing parent directories of name, outermost first.
+
+    Parents are looked up from the innermost one and the walk stops at the
+    first known directory, so an entry of a known directory costs a single
+    lookup.
+    """
+    missing = []
+    while name != self.root_directory and '/' in name:
+      name = name.rsplit('/', 1)[0]
+      if not (name == self.root_directory or name.startswith('/') or
+              name.startswith(self.root_directory + '/')):
+        name = self.root_directory + '/' + name
+      name = name.rstrip('/')
+      if name in self.directories:
+        break
+      missing.append(name)
+    for name in reversed(missing):
+      tarinfo = tarfile.TarInfo(name)
+      tarinfo.mtime = mtime
+      tarinfo.uid = uid
+      tarinfo.gid = gid
+      tarinfo.uname = uname
+      tarinfo.gname = gname
+      tarinfo.type = tarfile.DIRTYPE
+      tarinfo.mode = 0o755
+      self.directories.add(name)
+      self._addfile(tarinfo)
+
   def add_tar(self,
               tar,
               rootuid=None,
@@ -377,70 +3364,438 @@ class TarFileWriter(object):
     if root and root[0] not in ['/', '.']:
       # Root prefix should start with a '/', adds it if missing
       root = '/' + root
-    intar = tarfile.open(name=tar, mode='r:*')
+    if self.prefetcher:
+      self.prefetcher.added(tar)
+    if (self.splice_deps and not self._sorter and rootuid is None and
+        rootgid is None and not numeric and name_filter is None and
+        root is None and self.preserve_mtime and self._splice_gzip_tar(tar)):
+      return
+    with self._open_input_tar(tar) as intar:
+      self._add_tar_members(intar, rootuid, rootgid, numeric, name_filter,
+                            root)
+
+  def _open_input_tar(self, tar):
+    """Opens a tar to merge, from its stream if decompressed ahead."""
+    return _open_tar(tar, self.decompressor and self.decompressor.open(tar))
+
+  def _splice_gzip_tar(self, tar):
+    """Copies the gzip members of a tar file to the output, if possible.
+
+    Members already in the output are left out like in _addfile(), and the
+    gzip members holding part of them are compressed again, as well as the
+    one holding the end of archive marker. All the others are copied as is.
+
+    Args:
+      tar: the name of the tar file to merge.
+
+    Returns:
+      Whether the tar was merged, false if it is not gzip compressed or if
+      some of its members would have to be renamed.
+    """
+    with open(tar, 'rb') as f:
+      if f.read(2) != b'\037\213':
+        return False
+      f.seek(0)
+      reader = _GzipMembersReader(f)
+      names = _PathSet() if self.low_memory else set()
+      # The (start, end) offsets of the members to leave out, and their
+      # names, reported once the tar is merged.
+      skipped = []
+      duplicates = []
+      try:
+        with tarfile.open(fileobj=reader, mode='r|') as intar:
+          duplicate = None
+          for tarinfo in intar:
+            if duplicate is not None:
+              skipped.append((duplicate, tarinfo.offset))
+              duplicate = None
+            name = tarinfo.name
+            if tarinfo.type == tarfile.DIRTYPE and not name.endswith('/'):
+              name += '/'
+            if (not name.startswith('/') and
+                not name.startswith(self.root_directory)):
+              return False
+            if name in self.members or name in names:
+              duplicate = tarinfo.offset
+              if tarinfo.type != tarfile.DIRTYPE:
+                duplicates.append(name)
+            else:
+              names.add(name)
+            if self.low_memory:
+              # Like in _add_tar_members().
+              del intar.members[:]
+          # Where the end of archive marker starts.
+          end = intar.offset
+          if duplicate is not None:
+            skipped.append((duplicate, end))
+        # Read the members after the end of archive marker too.
+        while reader.read():
+          pass
+      except (tarfile.TarError, zlib.error, EOFError):
+        return False
+      members = reader.members
+      # The skipped ranges are in order, the first one not ending before a
+      # gzip member is the only one it may overlap with first.
+      next_skipped = 0
+      for (offset, start), (next_offset, next_start) in zip(members,
+                                                            members[1:]):
+        if start >= end:
+          break
+        while (next_skipped < len(skipped) and
+               skipped[next_skipped][1] <= start):
+          next_skipped += 1
+        overlaps = (next_skipped < len(skipped) and
+                    skipped[next_skipped][0] < next_start)
+        if not overlaps and next_start <= end:
+          self.fileobj.copy_stream(f, offset, next_offset - offset,
+                                   next_start - start)
+        else:
+          f.seek(offset)
+          self._write_gzip_member_range(f, start, min(next_start, end),
+                                        skipped)
+    for name in duplicates:
+      print('Duplicate file in archive: %s, '
+            'picking first occurrence' % name)
+    self.tar.offset += end - sum(e - s for s, e in skipped)
+    self.members.update(names)
+    return True
+
+  def _write_gzip_member_range(self, f, start, end, skipped):
+    """Decompresses a gzip member to the output, up to an offset.
+
+    Args:
+      f: the input file, at the start of the gzip member.
+      start: the uncompressed offset of the member in the input.
+      end: the uncompressed offset to stop at.
+      skipped: the (start, end) uncompressed offsets to leave out.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    offset = start
+    while offset < end:
+      data = decompressor.decompress(
+          decompressor.unconsumed_tail or f.read(1024 * 1024),
+          min(end - offset, 1024 * 1024))
+      if not data:
+        raise self.Error('Unexpected end of file: %s' % f.name)
+      data_end = offset + len(data)
+      position = offset
+      for skip_start, skip_end in skipped:
+        if skip_start >= data_end:
+          break
+        if skip_end > position:
+          if skip_start > position:
+            self.fileobj.write(data[position - offset:skip_start - offset])
+          position = min(skip_end, data_end)
+      if position < data_end:
+        self.fileobj.write(data[position - offset:])
+      offset = data_end
+
+  def merge_tars(self,
+                 tars,
+                 rootuid=None,
+                 rootgid=None,
+                 numeric=False,
+                 root=None):
+    """Merge tar files like the layers of a container image.
+
+    Unlike add_tar(), the last of the tars to have a path wins, and the OCI
+    whiteouts, `.wh.<name>` files and `.wh..wh..opq` markers, delete the
+    paths of the previous tars, `<name>` or all the entries of the directory
+    of the marker. The headers of all the tars are read first to find the
+    members that make it to the output, then only these members are read
+    again and merged, in the order of the tars. Tars whose members are all
+    shadowed are not read again, nor the end of those whose last members
+    are. Hard links to a shadowed file are written as regular files with
+    its content. Whiteouts are not written to the output, and members
+    already in the output are still kept, like with add_tar().
+
+    Args:
+      tars: the names of the tars to merge, from the lowest layer up.
+      rootuid: see add_tar().
+      rootgid: see add_tar().
+      numeric: see add_tar().
+      root: see add_tar().
+
+    Raises:
+      TarFileWriter.Error: if an error happens when uncompressing a tar file.
+    """
+    if root and root[0] not in ['/', '.']:
+      root = '/' + root
+    # The (tar, offset) of the last member of each path, and of the target
+    # of each hard link, if any.
+    winners = {}
+    links = {}
+    for layer, tar in enumerate(tars):
+      with self._open_input_tar(tar) as intar:
+        self._scan_layer(intar, layer, winners, links)
+    # By tar, the offsets of the members to write, of the shadowed files to
+    # keep for the hard links to them, and of the hard links to write as
+    # these files.
+    kept = [set() for _ in tars]
+    targets = [set() for _ in tars]
+    copies = [{} for _ in tars]
+    for layer, offset, _ in winners.values():
+      kept[layer].add(offset)
+      target = links.get((layer, offset))
+      if target is not None and winners.get(target[0],
+                                            (None,))[:2] != target[1:]:
+        targets[layer].add(target[2])
+        copies[layer][offset] = target[2]
+    del winners, links
+    for layer, tar in enumerate(tars):
+      if self.prefetcher:
+        self.prefetcher.added(tar)
+      if not kept[layer]:
+        continue
+      with _open_tar(tar) as intar:
+        self._merge_layer(intar, kept[layer], targets[layer], copies[layer],
+                          rootuid, rootgid, numeric, root)
+
+  def _scan_layer(self, intar, layer, winners, links):
+    """Records the members of a tar in winners and links, see merge_tars()."""
+    # The offset of the last member of each path in this tar.
+    offsets = {}
+    # The paths deleted by whiteouts, with their content, and the
+    # directories whose content is.
+    deleted = set()
+    opaque = set()
+    for tarinfo in intar:
+      path = _layer_path(tarinfo.name)
+      directory, base = posixpath.split(path)
+      if base == _OPAQUE_WHITEOUT:
+        opaque.add(directory)
+      elif base.startswith(_WHITEOUT_PREFIX):
+        deleted.add(posixpath.join(directory, base[len(_WHITEOUT_PREFIX):]))
+      else:
+        previous = winners.get(path)
+        if (previous is not None and previous[0] < layer and
+            previous[2] and not tarinfo.isdir()):
+          # A file replacing a directory hides its content.
+          opaque.add(path)
+        winners[path] = (layer, tarinfo.offset, tarinfo.isdir())
+        if tarinfo.islnk():
+          target = _layer_path(tarinfo.linkname)
+          if target in offsets:
+            links[(layer, tarinfo.offset)] = (target, layer, offsets[target])
+        offsets[path] = tarinfo.offset
+      if self.low_memory:
+        del intar.members[:]
+    if deleted or opaque:
+      for path in [path for path, (winner, _, _) in winners.items()
+                   if winner < layer and
+                   _is_whited_out(path, deleted, opaque)]:
+        del winners[path]
+
+  def _merge_layer(self, intar, kept, targets, copies, rootuid, rootgid,
+                   numeric, root):
+    """Merges the members of a tar kept by merge_tars()."""
+    passthrough = isinstance(intar.fileobj, (io.BufferedReader, io.FileIO))
+    last = max(kept)
+    # The content of the shadowed files that hard links point to.
+    contents = {}
+    try:
+      for tarinfo in intar:
+        if tarinfo.offset in targets:
+          content = tempfile.TemporaryFile()
+          tarfile.copyfileobj(intar.extractfile(tarinfo), content,
+                              tarinfo.size)
+          contents[tarinfo.offset] = (content, tarinfo.size)
+        if tarinfo.offset in kept:
+          fileobj = None
+          if tarinfo.offset in copies:
+            fileobj, size = contents[copies[tarinfo.offset]]
+            fileobj.seek(0)
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.linkname = ''
+            tarinfo.size = size
+          self._add_tar_member(intar, tarinfo, passthrough, rootuid, rootgid,
+                               numeric, root, fileobj)
+        if self.low_memory:
+          del intar.members[:]
+        if tarinfo.offset >= last:
+          break
+    finally:
+      for content, _ in contents.values():
+        content.close()
+
+  def _add_tar_members(self, intar, rootuid, rootgid, numeric, name_filter,
+                       root):
+    """Merge the members of an opened tar file, see add_tar()."""
+    # The content of the members of an uncompressed input can be copied
+    # straight from the input file, even by the kernel, instead of being
+    # read through tarfile.
+    passthrough = isinstance(intar.fileobj, (io.BufferedReader, io.FileIO))
     for tarinfo in intar:
       if name_filter is None or name_filter(tarinfo.name):
-        if not self.preserve_mtime:
-          tarinfo.mtime = self.default_mtime
-        if rootuid is not None and tarinfo.uid == rootuid:
-          tarinfo.uid = 0
-          tarinfo.uname = 'root'
-        if rootgid is not None and tarinfo.gid == rootgid:
-          tarinfo.gid = 0
-          tarinfo.gname = 'root'
-        if numeric:
-          tarinfo.uname = ''
-          tarinfo.gname = ''
-
-        name = tarinfo.name
-        if (not name.startswith('/') and
-            not name.startswith(self.root_directory)):
-          name = self.root_directory + '/' + name
-        if root is not None:
-          if name.startswith('.'):
-            name = '.' + root + name.lstrip('.')
-            # Add root dir with same permissions if missing. Note that
-            # add_file deduplicates directories and is safe to call here.
-            self.add_file('.' + root,
-                          tarfile.DIRTYPE,
-                          uid=tarinfo.uid,
-                          gid=tarinfo.gid,
-                          uname=tarinfo.uname,
-                          gname=tarinfo.gname,
-                          mtime=tarinfo.mtime,
-                          mode=0o755)
-          # Relocate internal hardlinks as well to avoid breaking them.
-          link = tarinfo.linkname
-          if link.startswith('.') and tarinfo.type == tarfile.LNKTYPE:
-            tarinfo.linkname = '.' + root + link.lstrip('.')
-        tarinfo.name = name
-
-        # Remove path pax header to ensure that the proposed name is going
-        # to be used. Without this, files with long names will not be
-        # properly written to its new path.
-        if 'path' in tarinfo.pax_headers:
-          del tarinfo.pax_headers['path']
-
-        if tarinfo.isfile():
-          # use extractfile(tarinfo) instead of tarinfo.name to preserve
-          # seek position in intar
-          self._addfile(tarinfo, intar.extractfile(tarinfo))
-        else:
-          self._addfile(tarinfo)
-    intar.close()
+        self._add_tar_member(intar, tarinfo, passthrough, rootuid, rootgid,
+                             numeric, root)
+      if self.low_memory:
+        # tarfile keeps all the members it reads, the iteration goes on
+        # from the last offset read without them.
+        del intar.members[:]
+
+  def _add_tar_member(self, intar, tarinfo, passthrough, rootuid, rootgid,
+                      numeric, root, fileobj=None):
+    """Merge a member of an opened tar file, see add_tar().
+
+    Args:
+      fileobj: if set, the content of the member, instead of its content in
+          the tar file.
+    """
+    if not self.preserve_mtime:
+      tarinfo.mtime = self.default_mtime
+    if rootuid is not None and tarinfo.uid == rootuid:
+      tarinfo.uid = 0
+      tarinfo.uname = 'root'
+    if rootgid is not None and tarinfo.gid == rootgid:
+      tarinfo.gid = 0
+      tarinfo.gname = 'root'
+    if numeric:
+      tarinfo.uname = ''
+      tarinfo.gname = ''
+
+    name = tarinfo.name
+    if (not name.startswith('/') and
+        not name.startswith(self.root_directory)):
+      name = self.root_directory + '/' + name
+    if root is not None:
+      if name.startswith('.'):
+        name = '.' + root + name.lstrip('.')
+        # Add root dir with same permissions if missing. Note that
+        # add_file deduplicates directories and is safe to call here.
+        self.add_file('.' + root,
+                      tarfile.DIRTYPE,
+                      uid=tarinfo.uid,
+                      gid=tarinfo.gid,
+                      uname=tarinfo.uname,
+                      gname=tarinfo.gname,
+                      mtime=tarinfo.mtime,
+                      mode=0o755)
+      # Relocate internal hardlinks as well to avoid breaking them.
+      link = tarinfo.linkname
+      if link.startswith('.') and tarinfo.type == tarfile.LNKTYPE:
+        tarinfo.linkname = '.' + root + link.lstrip('.')
+    tarinfo.name = name
+
+    # Remove path pax header to ensure that the proposed name is going
+    # to be used. Without this, files with long names will not be
+    # properly written to its new path.
+    if 'path' in tarinfo.pax_headers:
+      del tarinfo.pax_headers['path']
+
+    if fileobj is not None:
+      self._addfile(tarinfo, fileobj)
+    elif tarinfo.isfile() and passthrough and tarinfo.sparse is None:
+      intar.fileobj.seek(tarinfo.offset_data)
+      self._addfile(tarinfo, intar.fileobj)
+    elif tarinfo.isfile():
+      # use extractfile(tarinfo) instead of tarinfo.name to preserve
+      # seek position in intar
+      self._addfile(tarinfo, intar.extractfile(tarinfo))
+    else:
+      self._addfile(tarinfo)
 
   def close(self):
     """Close the output tar file.
 
-    This class should not be used anymore after calling that method.
+    This class should not be used anymore after calling that method. The
+    outputs are removed if it fails.
 
     Raises:
       TarFileWriter.Error: if an error happens when compressing the output file.
     """
+    try:
+      self._close()
+    except:
+      self._failed = True
+      for output in self._outputs:
+        output.discard()
+      if self.digest_manifest:
+        self.digest_manifest.discard()
+      raise
+    finally:
+      # Do not leave temporary files behind, even if closing failed early.
+      for output in self._outputs:
+        output.close()
+      if self.digest_manifest:
+        self.digest_manifest.close()
+      if self.cache:
+        self._discard_cached_members()
+      if self._failed and self.volume_size:
+        self._remove_volumes()
+
+  def _close(self):
+    if self._sorter:
+      self._add_sorted()
+    if self.splice_deps:
+      self.fileobj.end_block()
     self.tar.close()
     # Close the file object if necessary.
     if self.fileobj:
       self.fileobj.close()
+    for extra, output in self._extras:
+      extra.close()
+      output.close()
+    if self._zip:
+      self._zip.close()
+    if self.cache:
+      self._store_cached_members()
+      self.cache.evict()
+    if self._reader:
+      self._reader.shutdown()
+    if self.prefetcher:
+      self.prefetcher.close()
+    if self.decompressor:
+      self.decompressor.close()
     if self.compressor_proc and self.compressor_proc.wait() != 0:
       raise self.Error('Custom compression command '
                        '"{}" failed'.format(self.compressor_cmd))
+    self.output.close()
+    if self.digest_manifest:
+      self.digest_manifest.close()
+    if self._failed:
+      # The outputs were discarded, there is nothing to describe.
+      return
+    if self.descriptor:
+      self._write_descriptor()
+    if self.index:
+      self._write_index()
+    if self.volume_size:
+      self._end_volume()
+
+  def output_stats(self):
+    """Returns the system calls made to write the output, and their speed."""
+    bytes_written = sum(output.bytes_written for output in self._outputs)
+    seconds = sum(output.seconds for output in self._outputs)
+    return '%d bytes in %d system calls, %.0f MiB/s' % (
+        bytes_written, sum(output.syscalls for output in self._outputs),
+        bytes_written / max(seconds, 1e-9) / (1024 * 1024))
+
+  def _write_descriptor(self):
+    """Write the descriptor of the output, as an OCI image layer."""
+    descriptor = {
+        'digest': 'sha256:' + self.output.hexdigest(),
+        'size': self.output.tell(),
+        'diffID': 'sha256:' + self._tar_digest.sha256.hexdigest(),
+        'uncompressedSize': self._tar_digest.size,
+    }
+    if self._media_type:
+      descriptor['mediaType'] = self._media_type
+    with open(self.descriptor, 'w') as f:
+      json.dump(descriptor, f, indent=2, sort_keys=True)
+      f.write('\n')
+
+  def _write_index(self):
+    """Write the sidecar index, one JSON object per member."""
+    with open(self.index, 'w') as f:
+      for name, block, offset, size in self.index_entries:
+        if block is None:
+          compressed_offset = offset
+        else:
+          compressed_offset = self.fileobj.block_offsets[block]
+        f.write(json.dumps({
+            'name': name,
+            'compressed_offset': compressed_offset,
+            'uncompressed_offset': offset,
+            'size': size,
+        }) + '\n')
@@ -22,6 +22,27 @@ import tempfile
 import archive
 import helpers
 
+# The compression of the extra outputs, from the extension of their name.
+_EXTRA_OUTPUT_FORMATS = [
+    ('.tar', ''),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tar.xz', 'xz'),
+    ('.tar.zst', 'zst'),
+    ('.tzst', 'zst'),
+    ('.tar.lz4', 'lz4'),
+    ('.zip', 'zip'),
+]
+
+
+def _extra_output_compression(name):
+  """Returns the compression of an extra output, None if unknown."""
+  for extension, compression in _EXTRA_OUTPUT_FORMATS:
+    if name.endswith(extension):
+      return compression
+  return None
+
 
 class TarFile(object):
   """A class to generates a TAR file."""
@@ -30,13 +51,47 @@ class TarFile(object):
     pass
 
   def __init__(self, output, directory, compression, compressor, root_directory,
-               default_mtime):
+               default_mtime, compression_threads=0,
+               compression_block_size=None, compression_level=None,
+               index=None, low_memory=False, splice_deps=False,
+               cache_dir=None, cache_max_size=archive.DEFAULT_CACHE_MAX_SIZE,
+               deduplicate=False, sparse=False, pipeline=False, prefetch=0,
+               prefetch_max_size=archive.DEFAULT_PREFETCH_MAX_SIZE,
+               sort=False, sort_buffer_size=archive.DEFAULT_SORT_BUFFER_SIZE,
+               volume_size=None, size_hint=0, digest_manifest=None,
+               descriptor=None, decompress_ahead=0,
+               decompress_buffer_size=archive.DEFAULT_DECOMPRESS_BUFFER_SIZE,
+               extra_outputs=()):
     self.directory = directory
     self.output = output
     self.compression = compression
     self.compressor = compressor
     self.root_directory = root_directory
     self.default_mtime = default_mtime
+    self.compression_threads = compression_threads
+    self.compression_block_size = compression_block_size
+    self.compression_level = compression_level
+    self.index = index
+    self.low_memory = low_memory
+    self.splice_deps = splice_deps
+    self.cache_dir = cache_dir
+    self.cache_max_size = cache_max_size
+    self.deduplicate = deduplicate
+    self.sparse = sparse
+    self.pipeline = pipeline
+    self.prefetch = prefetch
+    self.prefetch_max_size = prefetch_max_size
+    self.sort = sort
+    self.sort_buffer_size = sort_buffer_size
+    self.volume_size = volume_size
+    self.size_hint = size_hint
+    self.digest_manifest = digest_manifest
+    self.descriptor = descriptor
+    self.decompress_ahead = decompress_ahead
+    self.decompress_buffer_size = decompress_buffer_size
+    self.extra_outputs = extra_outputs
+    # Temporary files that members may still be read from until closing.
+    self.temp_files = []
 
   def __enter__(self):
     self.tarfile = archive.TarFileWriter(
@@ -44,11 +99,53 @@ class TarFile(object):
         self.compression,
         self.compressor,
         self.root_directory,
-        default_mtime=self.default_mtime)
+        default_mtime=self.default_mtime,
+        compression_threads=self.compression_threads,
+        compression_block_size=self.compression_block_size,
+        compression_level=self.compression_level,
+        index=self.index,
+        low_memory=self.low_memory,
+        splice_deps=self.splice_deps,
+        cache_dir=self.cache_dir,
+        cache_max_size=self.cache_max_size,
+        deduplicate=self.deduplicate,
+        sparse=self.sparse,
+        pipeline=self.pipeline,
+        prefetch=self.prefetch,
+        prefetch_max_size=self.prefetch_max_size,
+        sort=self.sort,
+        sort_buffer_size=self.sort_buffer_size,
+        volume_size=self.volume_size,
+        size_hint=self.size_hint,
+        digest_manifest=self.digest_manifest,
+        descriptor=self.descriptor,
+        decompress_ahead=self.decompress_ahead,
+        decompress_buffer_size=self.decompress_buffer_size,
+        extra_outputs=self.extra_outputs)
     return self
 
   def __exit__(self, t, v, traceback):
-    self.tarfile.close()
+    try:
+      self.tarfile.__exit__(t, v, traceback)
+    finally:
+      for temp_file in self.temp_files:
+        os.remove(temp_file)
+    if self.tarfile.cache:
+      print('Compressed member cache: %s' % self.tarfile.cache.stats())
+    if self.tarfile.deduplicator:
+      print('Deduplication: %s' % self.tarfile.deduplicator.stats())
+    if self.tarfile.prefetcher:
+      print('Prefetch: %s' % self.tarfile.prefetcher.stats())
+    if self.tarfile.decompressor:
+      print('Decompression: %s' % self.tarfile.decompressor.stats())
+
+  def prefetch_files(self, files):
+    """Plans the files and tar files to add next, to read them ahead."""
+    self.tarfile.prefetch_files(files)
+
+  def prefetch_tars(self, tars):
+    """Plans the tar files to merge next, to decompress them ahead."""
+    self.tarfile.prefetch_tars(tars)
 
   def add_file(self, f, destfile, mode=None, ids=None, names=None):
     """Add a file to the tar file.
@@ -161,6 +258,20 @@ class TarFile(object):
       root = self.directory
     self.tarfile.add_tar(tar, numeric=True, root=root)
 
+  def merge_tars(self, tars):
+    """Merge tar files into the destination tar file, as overlay layers.
+
+    Like add_tar(), but the last tar to have a path wins, and OCI whiteouts
+    delete the paths of the previous tars.
+
+    Args:
+      tars: the tar files to merge, from the lowest layer up.
+    """
+    root = None
+    if self.directory and self.directory != '/':
+      root = self.directory
+    self.tarfile.merge_tars(tars, numeric=True, root=root)
+
   def add_link(self, symlink, destination):
     """Add a symbolic link pointing to `destination`.
 
@@ -193,8 +304,9 @@ class TarFile(object):
       tmpfile = tempfile.mkstemp(suffix=os.path.splitext(current.filename)[-1])
       with open(tmpfile[1], 'wb') as f:
         f.write(current.data)
+      os.close(tmpfile[0])
       self.add_tar(tmpfile[1])
-      os.remove(tmpfile[1])
+      self.temp_files.append(tmpfile[1])
 
 
 def main():
@@ -238,10 +350,106 @@ def main():
 
   compression = parser.add_mutually_exclusive_group()
   compression.add_argument('--compression',
-                           help='Compression (`gz` or `bz2`), default is none.')
+                           help='Compression (`gz`, `bz2`, `xz`, `zst` or'
+                                ' `lz4`), default is none.')
   compression.add_argument('--compressor',
                            help='Compressor program and arguments, '
                                 'e.g. `pigz -p 4`')
+  parser.add_argument(
+      '--compression_threads', type=int, default=0,
+      help='Compress independent blocks on that many threads, default is to'
+           ' use a single compression stream.')
+  parser.add_argument(
+      '--compression_block_size', type=int,
+      help='Size of the blocks compressed by each compression thread.')
+  parser.add_argument(
+      '--compression_level', type=int,
+      help='Compression level (preset for xz), default depends on the'
+           ' compression.')
+
+  parser.add_argument(
+      '--index',
+      help='Write an index of the members to this file, and compress the'
+           ' output by blocks that can be decompressed independently.')
+  parser.add_argument(
+      '--low_memory', default=False, action='store_true',
+      help='Bound the memory used for archives with millions of entries.')
+  parser.add_argument(
+      '--splice_deps', default=False, action='store_true',
+      help='Copy the gzip compressed content of the --tar inputs to a gzip'
+           ' compressed output without compressing it again.')
+  parser.add_argument(
+      '--cache_dir',
+      help='Directory where to cache compressed members across builds.')
+  parser.add_argument(
+      '--cache_max_size', type=int, default=archive.DEFAULT_CACHE_MAX_SIZE,
+      help='Size in bytes above which the least recently used entries of'
+           ' the cache are removed.')
+  parser.add_argument(
+      '--deduplicate', default=False, action='store_true',
+      help='Write the files with the same content and attributes as a'
+           ' previous one as hard links to it.')
+  parser.add_argument(
+      '--sparse', default=False, action='store_true',
+      help='Only store the data of the files with holes, as GNU tar sparse'
+           ' members.')
+  parser.add_argument(
+      '--pipeline', default=False, action='store_true',
+      help='Read the input files, write the tar stream and compress it on'
+           ' separate threads.')
+  parser.add_argument(
+      '--prefetch', type=int, default=0,
+      help='Number of input files to read ahead of the one being added, on'
+           ' background threads.')
+  parser.add_argument(
+      '--prefetch_max_size', type=int,
+      default=archive.DEFAULT_PREFETCH_MAX_SIZE,
+      help='Total size in bytes of the input files read ahead and not added'
+           ' yet above which no more are read ahead.')
+  parser.add_argument(
+      '--decompress_ahead', type=int, default=0,
+      help='Number of compressed tars to decompress ahead of the one being'
+           ' merged, on background threads or with pigz or xz.')
+  parser.add_argument(
+      '--decompress_buffer_size', type=int,
+      default=archive.DEFAULT_DECOMPRESS_BUFFER_SIZE,
+      help='Size in bytes of the content of each tar decompressed ahead and'
+           ' not merged yet above which its decompression waits.')
+  parser.add_argument(
+      '--sort', default=False, action='store_true',
+      help='Write all the entries, including those of the merged tars and'
+           ' debs, in the order of their paths.')
+  parser.add_argument(
+      '--sort_buffer_size', type=int,
+      default=archive.DEFAULT_SORT_BUFFER_SIZE,
+      help='Size in bytes of the entries sorted in memory before they are'
+           ' written to temporary files and merged.')
+  parser.add_argument(
+      '--volume_size', type=int,
+      help='Split the output into standalone archives of at most this many'
+           ' bytes, numbered before the extension of the output'
+           ' (foo.001.tar.gz), and list them with their members in'
+           ' foo.volumes.json. The output itself is not written.')
+  parser.add_argument(
+      '--digest_manifest',
+      help='Write the path, type, size, mode, owner, link target and SHA-256'
+           ' of each entry to this file, one JSON object per line, hashing'
+           ' the content as it is written.')
+  parser.add_argument(
+      '--descriptor',
+      help='Write the SHA-256 and size of the output and of the uncompressed'
+           ' tar stream to this JSON file, to describe an OCI image layer.')
+  parser.add_argument(
+      '--extra_output', action='append',
+      help='Also write the archive to this file, in the format given by its'
+           ' extension (.tar, .tar.gz, .tar.bz2, .tar.xz, .tar.zst, .tar.lz4'
+           ' or .zip), from the same pass over the inputs.')
+  parser.add_argument(
+      '--overlay', default=False, action='store_true',
+      help='Merge the tars like the layers of a container image: the last'
+           ' tar to have a path wins, and whiteouts delete the paths of the'
+           ' previous ones. All the tars are merged where the first one is'
+           ' added without this flag.')
 
   parser.add_argument(
       '--modes', action='append',
@@ -265,6 +473,12 @@ def main():
   parser.add_argument('--root_directory', default='./',
                       help='Default root directory is named "."')
   options = parser.parse_args()
+  extra_outputs = []
+  for extra_output in options.extra_output or []:
+    compression = _extra_output_compression(extra_output)
+    if compression is None:
+      parser.error('Unknown format of --extra_output: %s' % extra_output)
+    extra_outputs.append((extra_output, compression))
 
   # Parse modes arguments
   default_mode = None
@@ -303,11 +517,44 @@ def main():
         f = f[1:]
       ids_map[f] = (int(user), int(group))
 
+  manifest = {}
+  if options.manifest:
+    with open(options.manifest, 'r') as manifest_fp:
+      manifest = json.load(manifest_fp)
+  files = [helpers.SplitNameValuePairAtSeparator(f, '=')
+           for f in options.file or []]
+  # The files and tars to read, in the order they are added below.
+  inputs = ([f['src'] for f in manifest.get('files', [])] +
+            manifest.get('tars', []) + [inf for inf, _ in files] +
+            (options.tar or []))
+  # Each file takes a header, and about half a block of padding. Compressed
+  # outputs are much smaller, they are not preallocated.
+  size_hint = 0
+  if not options.compression and not options.compressor:
+    for path in inputs + (options.deb or []) + manifest.get('debs', []):
+      if os.path.isfile(path):
+        size_hint += os.path.getsize(path) + 2 * tarfile.BLOCKSIZE
+
   # Add objects to the tar file
   with TarFile(
       options.output, helpers.GetFlagValue(options.directory),
       options.compression, options.compressor, options.root_directory,
-      options.mtime) as output:
+      options.mtime, compression_threads=options.compression_threads,
+      compression_block_size=options.compression_block_size,
+      compression_level=options.compression_level,
+      index=options.index, low_memory=options.low_memory,
+      splice_deps=options.splice_deps, cache_dir=options.cache_dir,
+      cache_max_size=options.cache_max_size,
+      deduplicate=options.deduplicate, sparse=options.sparse,
+      pipeline=options.pipeline, prefetch=options.prefetch,
+      prefetch_max_size=options.prefetch_max_size, sort=options.sort,
+      sort_buffer_size=options.sort_buffer_size,
+      volume_size=options.volume_size, size_hint=size_hint,
+      digest_manifest=options.digest_manifest,
+      descriptor=options.descriptor,
+      decompress_ahead=options.decompress_ahead,
+      decompress_buffer_size=options.decompress_buffer_size,
+      extra_outputs=extra_outputs) as output:
 
     def file_attributes(filename):
       if filename.startswith('/'):
@@ -318,26 +565,32 @@ def main():
           'names': names_map.get(filename, default_ownername),
       }
 
-    if options.manifest:
-      with open(options.manifest, 'r') as manifest_fp:
-        manifest = json.load(manifest_fp)
-        for f in manifest.get('files', []):
-          output.add_file(f['src'], f['dst'], **file_attributes(f['dst']))
-        for f in manifest.get('empty_files', []):
-          output.add_empty_file(f, **file_attributes(f))
-        for d in manifest.get('empty_dirs', []):
-          output.add_empty_dir(d, **file_attributes(d))
-        for d in manifest.get('empty_root_dirs', []):
-          output.add_empty_root_dir(d, **file_attributes(d))
-        for f in manifest.get('symlinks', []):
-          output.add_link(f['linkname'], f['target'])
-        for tar in manifest.get('tars', []):
-          output.add_tar(tar)
-        for deb in manifest.get('debs', []):
-          output.add_deb(deb)
-
-    for f in options.file or []:
-      (inf, tof) = helpers.SplitNameValuePairAtSeparator(f, '=')
+    output.prefetch_files(inputs)
+    output.prefetch_tars(manifest.get('tars', []) + (options.tar or []))
+
+    for f in manifest.get('files', []):
+      output.add_file(f['src'], f['dst'], **file_attributes(f['dst']))
+    for f in manifest.get('empty_files', []):
+      output.add_empty_file(f, **file_attributes(f))
+    for d in manifest.get('empty_dirs', []):
+      output.add_empty_dir(d, **file_attributes(d))
+    for d in manifest.get('empty_root_dirs', []):
+      output.add_empty_root_dir(d, **file_attributes(d))
+    for f in manifest.get('symlinks', []):
+      output.add_link(f['linkname'], f['target'])
+    # With --overlay, all the tars are merged at once, where the first of
+    # them is added otherwise, so that the files added before them still
+    # win over their members.
+    layers = manifest.get('tars', []) + (options.tar or [])
+    if not options.overlay:
+      for tar in manifest.get('tars', []):
+        output.add_tar(tar)
+    elif manifest.get('tars'):
+      output.merge_tars(layers)
+    for deb in manifest.get('debs', []):
+      output.add_deb(deb)
+
+    for inf, tof in files:
       output.add_file(inf, tof, **file_attributes(tof))
     for f in options.empty_file or []:
       output.add_empty_file(f, **file_attributes(f))
@@ -345,8 +598,11 @@ def main():
       output.add_empty_dir(f, **file_attributes(f))
     for f in options.empty_root_dir or []:
       output.add_empty_root_dir(f, **file_attributes(f))
-    for tar in options.tar or []:
-      output.add_tar(tar)
+    if not options.overlay:
+      for tar in options.tar or []:
+        output.add_tar(tar)
+    elif not manifest.get('tars'):
+      output.merge_tars(layers)
     for deb in options.deb or []:
       output.add_deb(deb)
     for link in options.link or []:
@@ -14,12 +14,12 @@
 """This tool builds zip files from a list of inputs."""
 
 import argparse
-import datetime
 import zipfile
 
+import archive
 from helpers import SplitNameValuePairAtSeparator
 
-ZIP_EPOCH = 315532800
+ZIP_EPOCH = archive.ZIP_EPOCH
 
 
 def _create_argument_parser():
@@ -60,8 +60,7 @@ def _combine_paths(left, right):
 
 
 def parse_date(ts):
-  ts = datetime.datetime.utcfromtimestamp(ts)
-  return (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
+  return archive.zip_date_time(ts)
 
 
 def main(args):
@@ -71,24 +70,21 @@ def main(args):
   if args.mode:
     default_mode = int(args.mode, 8)
 
-  with zipfile.ZipFile(args.output, 'w') as zip_file:
-    for f in args.files or []:
-      (src_path, dst_path) = SplitNameValuePairAtSeparator(f, '=')
-
-      dst_path = _combine_paths(args.directory, dst_path)
-
-      entry_info = zipfile.ZipInfo(filename=dst_path, date_time=ts)
-
-      if default_mode:
-        entry_info.external_attr = default_mode << 16
-
-      entry_info.compress_type = zipfile.ZIP_DEFLATED
-
-      # the zipfile library doesn't support adding a file by path with write()
-      # and specifying a ZipInfo at the same time.
-      with open(src_path, 'rb') as src:
-        data = src.read()
-        zip_file.writestr(entry_info, data)
+  files = [SplitNameValuePairAtSeparator(f, '=') for f in args.files or []]
+  # No size hint: the entries are deflated, the size of the zip cannot be
+  # estimated from the size of the files.
+  with archive.OutputFile(args.output) as output:
+    with zipfile.ZipFile(output, 'w') as zip_file:
+      for (src_path, dst_path) in files:
+        dst_path = _combine_paths(args.directory, dst_path)
+
+        entry_info = archive.zip_file_info(dst_path, ts, default_mode)
+
+        # the zipfile library doesn't support adding a file by path with
+        # write() and specifying a ZipInfo at the same time.
+        with open(src_path, 'rb') as src:
+          data = src.read()
+          zip_file.writestr(entry_info, data)
 
 if __name__ == '__main__':
   arg_parser = _create_argument_parser()
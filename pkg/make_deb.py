@@ -31,6 +31,7 @@ else:
 
 # list of debian fields : (name, mandatory, wrap[, default])
 # see http://www.debian.org/doc/debian-policy/ch-controlfields.html
+import archive
 from helpers import GetFlagValue
 
 DEBIAN_FIELDS = [
@@ -196,7 +197,10 @@ def CreateDeb(output,
   control = CreateDebControl(extrafiles=extrafiles, **kwargs)
 
   # Write the final AR archive (the deb package)
-  with open(output, 'wb') as f:
+  data_size = os.stat(data).st_size
+  # The headers of the 3 entries are 60 bytes each.
+  size_hint = 8 + 3 * 60 + 4 + len(control) + data_size + 2
+  with archive.OutputFile(output, size_hint=size_hint) as f:
     f.write(b'!<arch>\n')  # Magic AR header
     AddArFileEntry(f, 'debian-binary', b'2.0\n')
     AddArFileEntry(f, 'control.tar.gz', control)
@@ -212,7 +216,6 @@ def CreateDeb(output,
       ext = '.'.join(ext)
       if ext not in ['tar.bz2', 'tar.gz', 'tar.xz', 'tar.lzma']:
         ext = 'tar'
-    data_size = os.stat(data).st_size
     with open(data, 'rb') as datafile:
       AddArFileEntry(f, 'data.' + ext, datafile, content_len=data_size)
 
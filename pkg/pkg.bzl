@@ -24,13 +24,20 @@ HAS_XZ_SUPPORT = True
 # Filetype to restrict inputs
 tar_filetype = (
     [".tar", ".tar.gz", ".tgz", ".tar.bz2", "tar.xz"] if HAS_XZ_SUPPORT else [".tar", ".tar.gz", ".tgz", ".tar.bz2"]
-)
+) + [".tar.zst", ".tzst", ".tar.lz4"]
+
+# zst and lz4 are left out: they need the optional zstandard and lz4 Python
+# modules, and the test targets generated from this list are always built
+# and read back with tarfile, which cannot decompress them.
 SUPPORTED_TAR_COMPRESSIONS = (
     ["", "gz", "bz2", "xz"] if HAS_XZ_SUPPORT else ["", "gz", "bz2"]
 )
 deb_filetype = [".deb", ".udeb"]
 _DEFAULT_MTIME = -1
 
+# No compression accepts that level, zstd accepts negative ones.
+_DEFAULT_COMPRESSION_LEVEL = -2147483648
+
 def _remap(remap_paths, path):
     """If path starts with a key in remap_paths, rewrite it."""
     for prefix, replacement in remap_paths.items():
@@ -78,6 +85,58 @@ def _pkg_tar_impl(ctx):
     ]
     if ctx.executable.compressor:
         args.append("--compressor=%s %s" % (ctx.executable.compressor.path, ctx.attr.compressor_args))
+    if ctx.attr.compression_threads:
+        args.append("--compression_threads=%d" % ctx.attr.compression_threads)
+    if ctx.attr.compression_level != _DEFAULT_COMPRESSION_LEVEL:
+        args.append("--compression_level=%d" % ctx.attr.compression_level)
+    if ctx.attr.splice_deps:
+        args.append("--splice_deps")
+    if ctx.attr.deduplicate:
+        args.append("--deduplicate")
+    if ctx.attr.sparse:
+        args.append("--sparse")
+    if ctx.attr.pipeline:
+        args.append("--pipeline")
+    if ctx.attr.prefetch:
+        args.append("--prefetch=%d" % ctx.attr.prefetch)
+    if ctx.attr.decompress_ahead:
+        args.append("--decompress_ahead=%d" % ctx.attr.decompress_ahead)
+    if ctx.attr.sort:
+        args.append("--sort")
+    if ctx.attr.overlay_deps:
+        args.append("--overlay")
+    index_file = None
+    if ctx.attr.create_index:
+        index_file = ctx.actions.declare_file(
+            output_file.basename + ".index",
+            sibling = output_file,
+        )
+        args.append("--index=" + index_file.path)
+    digest_manifest_file = None
+    if ctx.attr.create_digest_manifest:
+        digest_manifest_file = ctx.actions.declare_file(
+            output_file.basename + ".digests",
+            sibling = output_file,
+        )
+        args.append("--digest_manifest=" + digest_manifest_file.path)
+    descriptor_file = None
+    if ctx.attr.create_descriptor:
+        descriptor_file = ctx.actions.declare_file(
+            output_file.basename + ".descriptor.json",
+            sibling = output_file,
+        )
+        args.append("--descriptor=" + descriptor_file.path)
+    extra_files = []
+    for extension in ctx.attr.extra_formats:
+        if (extension == ctx.attr.extension or
+            ctx.label.name + "." + extension == output_file.basename):
+            fail("extra_formats cannot hold the format of the output: %s" % extension, attr = "extra_formats")
+        extra_file = ctx.actions.declare_file(
+            ctx.label.name + "." + extension,
+            sibling = output_file,
+        )
+        args.append("--extra_output=" + extra_file.path)
+        extra_files.append(extra_file)
     if ctx.attr.mtime != _DEFAULT_MTIME:
         if ctx.attr.portable_mtime:
             fail("You may not set both mtime and portable_mtime")
@@ -138,6 +197,8 @@ def _pkg_tar_impl(ctx):
             args += ["--compression=%s" % ctx.attr.extension[dotPos:]]
         elif ctx.attr.extension == "tgz":
             args += ["--compression=gz"]
+        elif ctx.attr.extension == "tzst":
+            args += ["--compression=zst"]
     args += ["--tar=" + f.path for f in ctx.files.deps]
     args += [
         "--link=%s:%s" % (_quote(k, protect = ":"), ctx.attr.symlinks[k])
@@ -154,7 +215,11 @@ def _pkg_tar_impl(ctx):
         tools = [ctx.executable.compressor] if ctx.executable.compressor else [],
         executable = ctx.executable.build_tar,
         arguments = ["@" + arg_file.path],
-        outputs = [output_file],
+        outputs = [output_file] + [
+            f
+            for f in [index_file, digest_manifest_file, descriptor_file]
+            if f
+        ] + extra_files,
         env = {
             "LANG": "en_US.UTF-8",
             "LC_CTYPE": "UTF-8",
@@ -163,6 +228,15 @@ def _pkg_tar_impl(ctx):
         },
         use_default_shell_env = True,
     )
+    output_groups = {}
+    if index_file:
+        output_groups["index"] = depset([index_file])
+    if digest_manifest_file:
+        output_groups["digest_manifest"] = depset([digest_manifest_file])
+    if descriptor_file:
+        output_groups["descriptor"] = depset([descriptor_file])
+    if extra_files:
+        output_groups["extra_formats"] = depset(extra_files)
     return [
         DefaultInfo(
             files = depset([output_file]),
@@ -172,6 +246,7 @@ def _pkg_tar_impl(ctx):
             label = ctx.label.name,
             file_name = output_name,
         ),
+        OutputGroupInfo(**output_groups),
     ]
 
 def _pkg_deb_impl(ctx):
@@ -356,6 +431,20 @@ pkg_tar_impl = rule(
         "remap_paths": attr.string_dict(),
         "compressor": attr.label(executable = True, cfg = "exec"),
         "compressor_args": attr.string(),
+        "compression_threads": attr.int(default = 0),
+        "compression_level": attr.int(default = _DEFAULT_COMPRESSION_LEVEL),
+        "create_index": attr.bool(default = False),
+        "create_digest_manifest": attr.bool(default = False),
+        "create_descriptor": attr.bool(default = False),
+        "splice_deps": attr.bool(default = False),
+        "deduplicate": attr.bool(default = False),
+        "sparse": attr.bool(default = False),
+        "pipeline": attr.bool(default = False),
+        "prefetch": attr.int(default = 0),
+        "decompress_ahead": attr.int(default = 0),
+        "sort": attr.bool(default = False),
+        "overlay_deps": attr.bool(default = False),
+        "extra_formats": attr.string_list(),
 
         # Common attributes
         "out": attr.output(mandatory = True),
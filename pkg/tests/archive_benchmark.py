@@ -0,0 +1,270 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmarks for archive.TarFileWriter.
+
+Usage: bazel run //tests:archive_benchmark -- [--files=N] [--memory]
+"""
+
+import argparse
+import os
+import resource
+import tarfile
+import tempfile
+import time
+
+from rules_pkg import archive
+
+
+def _time(label, func, count):
+  start = time.perf_counter()
+  func()
+  elapsed = time.perf_counter() - start
+  print('%-40s %8.3fs %10.0f/s' % (label, elapsed, count / elapsed))
+
+
+def _infos(count):
+  infos = []
+  for i in range(count):
+    info = tarfile.TarInfo('./node_modules/pkg%d/lib/file%d.js' % (i % 997, i))
+    info.size = i % 4096
+    info.mode = 0o644
+    infos.append(info)
+  return infos
+
+
+def bench_headers(count):
+  """Compare the fast header encoder with TarInfo.tobuf()."""
+  infos = _infos(count)
+  encoder = archive._HeaderEncoder(tarfile.GNU_FORMAT)
+  fast = [encoder.encode(info) for info in infos]
+  slow = [info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+          for info in infos]
+  if fast != slow:
+    raise AssertionError('Header encoder output differs from tarfile')
+
+  def encode_fast():
+    for info in infos:
+      encoder.encode(info)
+
+  def encode_slow():
+    for info in infos:
+      info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+  _time('headers: tarfile tobuf', encode_slow, count)
+  _time('headers: fast encoder', encode_fast, count)
+
+
+def bench_small_files(count):
+  """Time writing many tiny files end to end."""
+  with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'out.tar')
+
+    def write():
+      with archive.TarFileWriter(output) as f:
+        for i in range(count):
+          content = 'x' * (i % 512)
+          f.add_file('./node_modules/pkg%d/file%d.js' % (i % 997, i),
+                     content=content)
+
+    _time('writer: %d small files' % count, write, count)
+
+
+def bench_parents(count):
+  """Time adding files to deep and to wide trees of implicit directories."""
+  with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'out.tar')
+
+    def deep():
+      with archive.TarFileWriter(output) as f:
+        for i in range(count):
+          f.add_file('d%d/%sf%d' % (i // 1000, 'a/' * 40, i))
+
+    def wide():
+      with archive.TarFileWriter(output) as f:
+        for i in range(count):
+          f.add_file('./d%d/e%d/file%d' % (i % 1000, i % 7, i))
+
+    _time('parents: deep tree (depth 42)', deep, count)
+    _time('parents: wide tree', wide, count)
+
+
+def bench_add_dir(count):
+  """Time ingesting a directory tree of small files."""
+  with tempfile.TemporaryDirectory() as tmp, \
+       tempfile.TemporaryDirectory() as out:
+    for i in range(count):
+      directory = os.path.join(tmp, 'd%d' % (i % 100), 'e%d' % (i % 7))
+      os.makedirs(directory, exist_ok=True)
+      with open(os.path.join(directory, 'file%d' % i), 'wb') as f:
+        f.write(b'x' * (i % 64))
+
+    def add_dir():
+      with archive.TarFileWriter(os.path.join(out, 'out.tar')) as f:
+        f.add_dir('tree', tmp)
+
+    _time('add_dir: %d files' % count, add_dir, count)
+
+
+def bench_add_tar(megabytes):
+  """Time merging an uncompressed tar of big files into another one."""
+  with tempfile.TemporaryDirectory() as tmp:
+    content = os.path.join(tmp, 'content')
+    with open(content, 'wb') as f:
+      f.write(os.urandom(1024 * 1024))
+    source = os.path.join(tmp, 'source.tar')
+    with archive.TarFileWriter(source) as f:
+      for i in range(megabytes):
+        f.add_file('./file%d' % i, file_content=content)
+
+    def add_tar():
+      with archive.TarFileWriter(os.path.join(tmp, 'out.tar')) as f:
+        f.add_tar(source)
+
+    _time('add_tar: %d MiB (MiB/s)' % megabytes, add_tar, megabytes)
+
+
+def bench_pipeline(megabytes):
+  """Compare the serial and the pipelined writers, for each compression."""
+  with tempfile.TemporaryDirectory() as tmp:
+    content = os.path.join(tmp, 'content')
+    with open(content, 'wb') as f:
+      for i in range(megabytes):
+        f.write(os.urandom(512 * 1024) + b'\0' * 512 * 1024)
+    output = os.path.join(tmp, 'out.tar')
+    for compression in ['gz', 'bz2', 'xz']:
+      for pipeline in [False, True]:
+
+        def write():
+          with archive.TarFileWriter(output, compression,
+                                     pipeline=pipeline) as f:
+            f.add_file('./content', file_content=content)
+            for i in range(10000):
+              f.add_file('./small/file%d' % i, content='x' * (i % 512))
+
+        _time('pipeline: %s, pipeline=%s (MiB/s)' % (compression, pipeline),
+              write, megabytes)
+
+
+def bench_sort(count):
+  """Compare writing entries in the order they are added or sorted."""
+  with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'out.tar')
+    for sort in [False, True]:
+
+      def write():
+        with archive.TarFileWriter(output, sort=sort,
+                                   sort_buffer_size=4 * 1024 * 1024) as f:
+          for i in reversed(range(count)):
+            f.add_file('./dir%d/file%d' % (i % 1000, i),
+                       content='x' * (i % 64))
+
+      _time('sort: %d entries, sort=%s' % (count, sort), write, count)
+
+
+def _evict(paths):
+  """Drops files from the page cache, as far as the kernel agrees to."""
+  for path in paths:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+      os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+      os.close(fd)
+
+
+def bench_prefetch(count):
+  """Compare adding files from a cold page cache with and without prefetch."""
+  with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp:
+    paths = []
+    for i in range(count):
+      paths.append(os.path.join(tmp, 'file%d' % i))
+      with open(paths[-1], 'wb') as f:
+        f.write(os.urandom(256 * 1024))
+    for prefetch in [0, 16]:
+
+      def write():
+        with archive.TarFileWriter(os.path.join(tmp, 'out.tar'),
+                                   prefetch=prefetch) as f:
+          f.prefetch_files(paths)
+          for i, path in enumerate(paths):
+            f.add_file('./file%d' % i, file_content=path)
+          if f.prefetcher:
+            print('  %s' % f.prefetcher.stats())
+
+      _evict(paths)
+      _time('prefetch: %d cold files, prefetch=%d' % (count, prefetch),
+            write, count)
+
+
+def _peak_rss(func):
+  """Runs func in a child process and returns its peak RSS in MiB."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    func()
+    os.write(write_fd, b'%d' % resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss)
+    os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd, 'rb') as f:
+    peak_kib = int(f.read())
+  os.waitpid(pid, 0)
+  return peak_kib / 1024
+
+
+def bench_memory(counts):
+  """Report the peak RSS of writing many empty files, with each mode."""
+  with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'out.tar')
+    for count in counts:
+      for low_memory in [False, True]:
+
+        def write():
+          with archive.TarFileWriter(output, low_memory=low_memory) as f:
+            for i in range(count):
+              f.add_file('./dir%d/file%d' % (i // 1000, i))
+
+        start = time.perf_counter()
+        peak = _peak_rss(write)
+        print('memory: %9d entries, low_memory=%-5s %8.0f MiB %8.1fs' % (
+            count, low_memory, peak, time.perf_counter() - start))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--files', type=int, default=100000,
+                      help='Number of entries to generate.')
+  parser.add_argument('--megabytes', type=int, default=512,
+                      help='Size of the content to merge.')
+  parser.add_argument('--memory', action='store_true',
+                      help='Measure the peak RSS of the writer instead.')
+  parser.add_argument('--memory_entries', default='1000000,5000000,10000000',
+                      help='Comma separated entry counts for --memory.')
+  options = parser.parse_args()
+  if options.memory:
+    bench_memory([int(c) for c in options.memory_entries.split(',')])
+    return
+  bench_headers(options.files)
+  bench_small_files(options.files)
+  bench_parents(options.files)
+  bench_add_dir(options.files)
+  bench_add_tar(options.megabytes)
+  bench_pipeline(options.megabytes // 8)
+  bench_prefetch(options.files // 100)
+  bench_sort(options.files)
+
+
+if __name__ == '__main__':
+  main()
@@ -13,9 +13,20 @@
 # limitations under the License.
 """Testing for archive."""
 
+import bz2
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
 import os
+import stat
 import tarfile
+import threading
 import unittest
+import zipfile
+import zlib
 
 from bazel_tools.tools.python.runfiles import runfiles
 from rules_pkg import archive
@@ -97,6 +108,56 @@ class SimpleArFileTest(unittest.TestCase):
     self.assertSimpleFileContent(["a", "b", "ab"])
 
 
+class HeaderEncoderTest(unittest.TestCase):
+  """Testing for the fast header encoder against tarfile."""
+
+  def assertSameHeader(self, tar_format, **attributes):
+    info = tarfile.TarInfo(attributes.pop("name", "./a"))
+    for k, v in attributes.items():
+      setattr(info, k, v)
+    encoder = archive._HeaderEncoder(tar_format)
+    # Twice, to go through the cached template the second time.
+    for _ in range(2):
+      header = encoder.encode(info)
+      if header is not None:
+        self.assertEqual(header, info.tobuf(tar_format, "utf-8",
+                                            "surrogateescape"))
+
+  def testGoldenHeaders(self):
+    for tar_format in [tarfile.PAX_FORMAT, tarfile.GNU_FORMAT,
+                       tarfile.USTAR_FORMAT]:
+      self.assertSameHeader(tar_format)
+      self.assertSameHeader(tar_format, size=12345, mode=0o755, mtime=1234)
+      self.assertSameHeader(tar_format, name="./d", type=tarfile.DIRTYPE)
+      self.assertSameHeader(tar_format, name="./d/", type=tarfile.DIRTYPE)
+      self.assertSameHeader(tar_format, type=tarfile.SYMTYPE,
+                            linkname="/path/to/bin/java")
+      self.assertSameHeader(tar_format, uid=42, gid=24, uname="titi",
+                            gname="tata", mode=0o104755)
+      self.assertSameHeader(tar_format, name="./" + "x" * 98)
+      self.assertSameHeader(tar_format, size=8 ** 11 - 1,
+                            mtime=8 ** 11 - 1)
+      self.assertSameHeader(tar_format, uid=8 ** 7 - 1, gid=8 ** 7 - 1)
+
+  def testComplexHeadersAreLeftToTarfile(self):
+    encoder = archive._HeaderEncoder(tarfile.PAX_FORMAT)
+    for attributes in [
+        {"name": "./" + "x" * 99},
+        {"name": "./\u00e9"},
+        {"linkname": "l" * 101, "type": tarfile.LNKTYPE},
+        {"uname": "\u00e9"},
+        {"size": 8 ** 11},
+        {"uid": 8 ** 7},
+        {"mtime": 1.5},
+        {"type": tarfile.CHRTYPE},
+        {"pax_headers": {"comment": "c"}},
+    ]:
+      info = tarfile.TarInfo(attributes.pop("name", "./a"))
+      for k, v in attributes.items():
+        setattr(info, k, v)
+      self.assertIsNone(encoder.encode(info), attributes)
+
+
 class TarFileWriterTest(unittest.TestCase):
   """Testing for TarFileWriter class."""
 
@@ -228,6 +289,27 @@ class TarFileWriterTest(unittest.TestCase):
         f.add_tar(datafile, name_filter=lambda n: n != "./b")
       self.assertTarFileContent(self.tempfile, content)
 
+  def testMergeZstdAndLz4Tar(self):
+    content = [
+        {"name": "./a", "data": b"a"},
+        {"name": "./ab", "data": b"ab"},
+        ]
+    for ext, available, module in [(".zst", archive.HAS_ZSTD, "zstandard"),
+                                   (".lz4", archive.HAS_LZ4, "lz4")]:
+      datafile = self.data_files.Rlocation(
+          "rules_pkg/tests/testdata/tar_test.tar" + ext)
+      with self.subTest(ext=ext):
+        if not available:
+          # The error tells what is missing, rather than a bad tar file.
+          with self.assertRaisesRegex(archive.TarFileWriter.Error,
+                                      "requires the %s module" % module):
+            with archive.TarFileWriter(self.tempfile) as f:
+              f.add_tar(datafile)
+          continue
+        with archive.TarFileWriter(self.tempfile) as f:
+          f.add_tar(datafile, name_filter=lambda n: n != "./b")
+        self.assertTarFileContent(self.tempfile, content)
+
   def testMergeTarRelocated(self):
     content = [
         {"name": ".", "mode": 0o755},
@@ -241,6 +323,861 @@ class TarFileWriterTest(unittest.TestCase):
       f.add_tar(datafile, name_filter=lambda n: n != "./b", root="/foo")
     self.assertTarFileContent(self.tempfile, content)
 
+  def testParallelGzipCompression(self):
+    text = " ".join(str(i) for i in range(100000))
+    content = [
+        {"name": "."},
+        {"name": "./a", "data": text.encode("utf-8")},
+        {"name": "./b", "data": b"b"},
+    ]
+    with archive.TarFileWriter(self.tempfile) as f:
+      f.add_file("./a", content=text)
+      f.add_file("./b", content="b")
+    with open(self.tempfile, "rb") as f:
+      uncompressed = f.read()
+    outputs = []
+    for threads in [1, 4]:
+      with archive.TarFileWriter(self.tempfile, "gz",
+                                 compression_threads=threads,
+                                 compression_block_size=64 * 1024) as f:
+        f.add_file("./a", content=text)
+        f.add_file("./b", content="b")
+      self.assertTarFileContent(self.tempfile, content)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    # The output does not depend on the number of threads.
+    self.assertEqual(outputs[0], outputs[1])
+    self.assertEqual(gzip.decompress(outputs[0]), uncompressed)
+
+  @unittest.skipIf(not archive.HAS_LZMA, "lzma is not available")
+  def testParallelXzCompression(self):
+    text = " ".join(str(i) for i in range(100000))
+    content = [
+        {"name": "."},
+        {"name": "./a", "data": text.encode("utf-8")},
+    ]
+    outputs = []
+    for threads in [1, 4]:
+      with archive.TarFileWriter(self.tempfile, "xz",
+                                 compression_threads=threads,
+                                 compression_block_size=64 * 1024) as f:
+        f.add_file("./a", content=text)
+      self.assertTarFileContent(self.tempfile, content)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(outputs[0], outputs[1])
+
+  def testParallelBzip2Compression(self):
+    text = " ".join(str(i) for i in range(100000))
+    content = [
+        {"name": "."},
+        {"name": "./a", "data": text.encode("utf-8")},
+    ]
+    with archive.TarFileWriter(self.tempfile, "bz2", compression_threads=4,
+                               compression_block_size=64 * 1024) as f:
+      f.add_file("./a", content=text)
+    self.assertTarFileContent(self.tempfile, content)
+
+  def testZstdAndLz4Compression(self):
+    text = " ".join(str(i) for i in range(100000))
+    content = [
+        {"name": "."},
+        {"name": "./a", "data": text.encode("utf-8")},
+    ]
+    for compression in ["zst", "lz4"]:
+      if compression not in archive.COMPRESSIONS:
+        continue
+      outputs = []
+      for threads in [0, 4]:
+        with archive.TarFileWriter(self.tempfile, compression,
+                                   compression_threads=threads,
+                                   compression_block_size=64 * 1024) as f:
+          f.add_file("./a", content=text)
+        with open(self.tempfile, "rb") as f:
+          outputs.append(f.read())
+      self.assertEqual(outputs[0], outputs[1])
+      # tarfile cannot read those, merge it back into a plain tar.
+      merged = self.tempfile + ".merged.tar"
+      with archive.TarFileWriter(merged) as f:
+        f.add_tar(self.tempfile)
+      self.assertTarFileContent(merged, content)
+      os.remove(merged)
+
+  def testSeekableIndex(self):
+    index = self.tempfile + ".index"
+    files = {"./a": "a" * 100000, "./b": "b", "./c/d": "cd"}
+    for compression in ["", "gz"]:
+      with archive.TarFileWriter(self.tempfile, compression, index=index,
+                                 compression_block_size=16 * 1024) as f:
+        for name, text in sorted(files.items()):
+          f.add_file(name, content=text)
+      with open(index, "r") as f:
+        entries = [json.loads(line) for line in f]
+      self.assertEqual([e["name"] for e in entries],
+                       ["./", "./a", "./b", "./c/", "./c/d"])
+      for entry in entries:
+        # Decompress from the block of the member only.
+        with open(self.tempfile, "rb") as f:
+          f.seek(entry["compressed_offset"])
+          if compression:
+            f = gzip.GzipFile(fileobj=f)
+          header = f.read(tarfile.BLOCKSIZE)
+          info = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+          self.assertEqual(info.name, entry["name"].rstrip("/"))
+          self.assertEqual(info.size, entry["size"])
+          if info.isfile():
+            self.assertEqual(f.read(info.size),
+                             files[info.name].encode("utf-8"))
+    os.remove(index)
+
+  def testZeroCopyMatchesBufferedCopy(self):
+    path = os.path.join(os.environ["TEST_TMPDIR"], "big_file")
+    data = os.urandom(300 * 1024 + 7)
+    with open(path, "wb") as f:
+      f.write(data)
+    # Uncompressed output copies big files in the kernel, compressed output
+    # goes through Python buffers, the tar stream must be identical.
+    with archive.TarFileWriter(self.tempfile) as f:
+      f.add_file("./big", file_content=path)
+      f.add_file("./small", content="small")
+    with open(self.tempfile, "rb") as f:
+      uncompressed = f.read()
+    with archive.TarFileWriter(self.tempfile, "gz") as f:
+      f.add_file("./big", file_content=path)
+      f.add_file("./small", content="small")
+    with open(self.tempfile, "rb") as f:
+      self.assertEqual(gzip.decompress(f.read()), uncompressed)
+    # The bz2 and xz outputs compressed by tarfile itself are not copied in
+    # the kernel either.
+    for compression, decompress in [("bz2", bz2.decompress),
+                                     ("xz", lzma.decompress)]:
+      with archive.TarFileWriter(self.tempfile, compression) as f:
+        f.add_file("./big", file_content=path)
+        f.add_file("./small", content="small")
+      with open(self.tempfile, "rb") as f:
+        self.assertEqual(decompress(f.read()), uncompressed, compression)
+    with archive.TarFileWriter(self.tempfile) as f:
+      f.add_file("./big", file_content=path)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./big", "data": data},
+    ])
+
+  def testLowMemoryMatchesDefaultOutput(self):
+    def write(low_memory):
+      with archive.TarFileWriter(self.tempfile, low_memory=low_memory) as f:
+        f.add_file("./a/b/c", content="c")
+        f.add_file("./a/b/c", content="duplicate")
+        f.add_file("./a/d", tarfile.SYMTYPE, link="b/c")
+        f.add_file("./a/b", tarfile.DIRTYPE)
+        f.add_tar(self.data_files.Rlocation(
+            "rules_pkg/tests/testdata/tar_test.tar"))
+        f.add_tar(self.data_files.Rlocation(
+            "rules_pkg/tests/testdata/tar_test.tar"), root="/again")
+        if low_memory:
+          self.assertEqual(f.tar.members, [])
+      with open(self.tempfile, "rb") as f:
+        return f.read()
+    self.assertEqual(write(True), write(False))
+
+  def testPathSet(self):
+    paths = archive._PathSet(capacity=4)
+    for i in range(1000):
+      paths.add("./dir/%d" % i)
+      paths.add("./dir/%d" % (i // 2))
+    self.assertEqual(len(paths), 1000)
+    self.assertIn("./dir/999", paths)
+    self.assertNotIn("./dir/1000", paths)
+    self.assertNotIn("./dir", paths)
+
+    class CollidingPathSet(archive._PathSet):
+      # All the paths collide, and most are read back from the disk.
+      _BUFFER_SIZE = 64
+      _FOUND_SIZE = 4
+
+      @staticmethod
+      def _fingerprint(data):
+        return 1
+
+    paths = CollidingPathSet(capacity=4)
+    for i in range(200):
+      paths.add("./dir/%d" % i)
+      paths.add("./dir/%d" % (i // 2))
+    self.assertEqual(len(paths), 200)
+    self.assertIn("./dir/199", paths)
+    self.assertIn("./dir/0", paths)
+    self.assertNotIn("./dir/200", paths)
+    merged = archive._PathSet()
+    merged.add("./other")
+    merged.update(paths)
+    self.assertEqual(len(merged), 201)
+    self.assertIn("./dir/42", merged)
+
+  def testAddTarPassthroughMatchesExtractedContent(self):
+    source = os.path.join(os.environ["TEST_TMPDIR"], "source.tar")
+    big = os.path.join(os.environ["TEST_TMPDIR"], "big_content")
+    with open(big, "wb") as f:
+      f.write(os.urandom(200 * 1024 + 3))
+    with archive.TarFileWriter(source) as f:
+      f.add_file("./small", content="small")
+      f.add_file("./big", file_content=big)
+      f.add_file("./empty")
+    with open(source, "rb") as f:
+      data = f.read()
+    compressed = source + ".gz"
+    with open(compressed, "wb") as f:
+      f.write(gzip.compress(data))
+
+    # An uncompressed input is copied from the file, a compressed one is
+    # extracted through tarfile, into both an uncompressed and a compressed
+    # output.
+    outputs = []
+    for compression in ["", "gz"]:
+      for input_tar in [source, compressed]:
+        with archive.TarFileWriter(self.tempfile, compression) as f:
+          f.add_tar(input_tar, root="/merged")
+          f.add_tar(input_tar)
+        with open(self.tempfile, "rb") as f:
+          output = f.read()
+        outputs.append(gzip.decompress(output) if compression else output)
+    for output in outputs[1:]:
+      self.assertEqual(output, outputs[0])
+    with open(big, "rb") as f:
+      self.assertTarFileContent(self.tempfile, [
+          {"name": "."},
+          {"name": "./merged"},
+          {"name": "./merged/small", "data": b"small"},
+          {"name": "./merged/big", "data": f.read()},
+          {"name": "./merged/empty"},
+          {"name": "./small"},
+          {"name": "./big"},
+          {"name": "./empty"},
+      ])
+
+  def testSpliceGzipDeps(self):
+    tmp = os.environ["TEST_TMPDIR"]
+    content = os.path.join(tmp, "random_content")
+    with open(content, "wb") as f:
+      f.write(os.urandom(3 * 1024 * 1024))
+    base = os.path.join(tmp, "base.tar.gz")
+    with archive.TarFileWriter(base, "gz", splice_deps=True) as f:
+      f.add_file("./etc/a", content="a")
+      f.add_file("./big", file_content=content)
+    with open(base, "rb") as f:
+      base_data = f.read()
+
+    middle = os.path.join(tmp, "middle.tar.gz")
+    with archive.TarFileWriter(middle, "gz", splice_deps=True) as f:
+      f.add_file("./big2", file_content=content)
+      f.add_file("./etc/b", content="duplicate")
+      f.add_file("./last", content="last")
+    with open(middle, "rb") as f:
+      middle_data = f.read()
+
+    def layer(splice_deps, low_memory=False):
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        with archive.TarFileWriter(self.tempfile, "gz",
+                                   splice_deps=splice_deps,
+                                   low_memory=low_memory) as f:
+          f.add_file("./etc/b", content="b")
+          f.add_tar(base)
+          f.add_tar(base)
+          f.add_tar(middle)
+          f.add_file("./top", content="top")
+      self.assertEqual(output.getvalue().count("./etc/b,"), 1)
+      self.assertEqual(output.getvalue().count("./big,"), 1)
+      with open(self.tempfile, "rb") as f:
+        return f.read()
+
+    def gzip_members(data):
+      members = []
+      while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressor.decompress(data)
+        members.append(data[:len(data) - len(decompressor.unused_data)])
+        data = decompressor.unused_data
+      return members
+
+    expected = gzip.decompress(layer(False))
+    spliced = layer(True)
+    self.assertEqual(gzip.decompress(spliced), expected)
+    self.assertEqual(layer(True, low_memory=True), spliced)
+    # The gzip members of the random content are copied as is, after the
+    # first one holding the directories already in the output.
+    members = gzip_members(base_data)
+    self.assertGreater(len(members), 3)
+    self.assertIn(members[1] + members[2], spliced)
+    # So are those before a member left out, only the gzip members holding
+    # part of it are compressed again.
+    members = gzip_members(middle_data)
+    self.assertIn(members[1] + members[2], spliced)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./etc"},
+        {"name": "./etc/b"},
+        {"name": "./etc/a", "data": b"a"},
+        {"name": "./big"},
+        {"name": "./big2"},
+        {"name": "./last", "data": b"last"},
+        {"name": "./top"},
+    ])
+
+  def testCompressedMemberCache(self):
+    tmp = os.environ["TEST_TMPDIR"]
+    cache = os.path.join(tmp, "member_cache")
+    contents = []
+    for i in range(3):
+      contents.append(os.path.join(tmp, "cached_content_%d" % i))
+      with open(contents[-1], "wb") as f:
+        f.write(os.urandom(100 * 1024))
+
+    def build(compression, threads=0, cache_max_size=1 << 30):
+      with archive.TarFileWriter(self.tempfile, compression,
+                                 compression_threads=threads,
+                                 cache_dir=cache,
+                                 cache_max_size=cache_max_size) as writer:
+        for i, content in enumerate(contents):
+          writer.add_file("./file%d" % i, file_content=content)
+        writer.add_file("./small", content="small")
+      with open(self.tempfile, "rb") as f:
+        return f.read(), (writer.cache.hits, writer.cache.misses)
+
+    for compression in ["gz", "bz2"] + sorted(
+        set(archive.COMPRESSIONS) & {"zst", "lz4"}):
+      cold, stats = build(compression)
+      self.assertEqual(stats, (0, 3))
+      # The entries are renamed into place once complete.
+      self.assertEqual([f for _, _, files in os.walk(cache) for f in files
+                        if f.endswith(".tmp")], [])
+      self.assertEqual(build(compression, threads=2), (cold, (3, 0)))
+      with open(contents[1], "ab") as f:
+        f.write(b"changed")
+      changed, stats = build(compression)
+      self.assertEqual(stats, (2, 1))
+      # Evict everything.
+      self.assertEqual(build(compression, cache_max_size=0)[1], (3, 0))
+      self.assertEqual([f for _, _, files in os.walk(cache) for f in files],
+                       [])
+      self.assertEqual(build(compression, threads=2), (changed, (0, 3)))
+
+  def testDeduplicate(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "dedup")
+    os.makedirs(tmp)
+    for name, content in [("a", b"same"), ("b", b"same"), ("c", b"diff"),
+                          ("d", b"other size")]:
+      with open(os.path.join(tmp, name), "wb") as f:
+        f.write(content)
+    os.link(os.path.join(tmp, "d"), os.path.join(tmp, "e"))
+    with archive.TarFileWriter(self.tempfile, deduplicate=True) as f:
+      f.add_dir("tree", tmp)
+      f.add_file("./copy", file_content=os.path.join(tmp, "a"))
+      f.add_file("./executable", file_content=os.path.join(tmp, "a"),
+                 mode=0o755)
+      self.assertEqual(f.deduplicator.duplicates, 3)
+      self.assertEqual(f.deduplicator.saved_bytes, 18)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./tree"},
+        {"name": "./tree/a", "data": b"same"},
+        {"name": "./tree/b", "type": tarfile.LNKTYPE,
+         "linkname": "./tree/a"},
+        {"name": "./tree/c", "data": b"diff"},
+        {"name": "./tree/d", "data": b"other size"},
+        {"name": "./tree/e", "type": tarfile.LNKTYPE,
+         "linkname": "./tree/d"},
+        {"name": "./copy", "type": tarfile.LNKTYPE, "linkname": "./tree/a"},
+        {"name": "./executable", "data": b"same"},
+    ])
+
+  def testSparseFile(self):
+    path = os.path.join(os.environ["TEST_TMPDIR"], "sparse_file")
+    with open(path, "wb") as f:
+      f.truncate(4 * 1024 * 1024)
+      f.seek(1024 * 1024)
+      f.write(b"data")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      if archive._data_extents(fd, 4 * 1024 * 1024) == [(0, 4 * 1024 * 1024)]:
+        self.skipTest("The file system does not support holes")
+    finally:
+      os.close(fd)
+    dense = os.path.join(os.environ["TEST_TMPDIR"], "dense_file")
+    with open(dense, "wb") as f:
+      f.write(b"dense")
+    with archive.TarFileWriter(self.tempfile, sparse=True) as f:
+      f.add_file("./sparse", file_content=path)
+      f.add_file("./dense", file_content=dense)
+    self.assertLess(os.path.getsize(self.tempfile), 64 * 1024)
+    with open(path, "rb") as f:
+      content = f.read()
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./sparse", "size": len(content), "data": content},
+        {"name": "./dense", "data": b"dense", "sparse": None},
+    ])
+
+  def testPipeline(self):
+    content = os.path.join(os.environ["TEST_TMPDIR"], "pipeline_content")
+    with open(content, "wb") as f:
+      f.write(b"".join(b"%d\n" % i for i in range(200000)))
+
+    def build(compression, pipeline):
+      # The name of the output is stored in the gzip header.
+      output = os.path.join(os.environ["TEST_TMPDIR"],
+                            "pipeline.tar.%s" % compression)
+      with archive.TarFileWriter(output, compression,
+                                 pipeline=pipeline) as f:
+        f.add_file("./big", file_content=content)
+        f.add_file("./small", content="small")
+      with open(output, "rb") as f:
+        return f.read()
+
+    for compression in ["", "gz", "bz2", "xz"]:
+      serial = build(compression, False)
+      self.assertEqual(build(compression, True), serial)
+    with open(content, "rb") as f:
+      data = f.read()
+    self.assertTarFileContent(
+        os.path.join(os.environ["TEST_TMPDIR"], "pipeline.tar.bz2"), [
+            {"name": "."},
+            {"name": "./big", "data": data},
+            {"name": "./small", "data": b"small"},
+        ])
+
+  def testPrefetch(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "prefetch")
+    os.makedirs(tmp)
+    paths = []
+    for i in range(6):
+      paths.append(os.path.join(tmp, "file%d" % i))
+      with open(paths[-1], "wb") as f:
+        f.write(b"%d" % i * 1000)
+    with archive.TarFileWriter(self.tempfile, prefetch=2,
+                               prefetch_max_size=2500) as f:
+      f.prefetch_files(paths[:5])
+      # The first file is skipped, the last one was not planned.
+      for i in range(1, 6):
+        f.add_file("./file%d" % i, file_content=paths[i])
+      prefetcher = f.prefetcher
+      self.assertEqual(prefetcher.ready + prefetcher.in_flight, 4)
+      self.assertEqual(prefetcher.unplanned, 1)
+    self.assertTarFileContent(self.tempfile, [{"name": "."}] + [
+        {"name": "./file%d" % i, "data": b"%d" % i * 1000}
+        for i in range(1, 6)])
+
+  def testSort(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "sort")
+    os.makedirs(tmp)
+    content = os.path.join(tmp, "content")
+    with open(content, "wb") as f:
+      f.write(b"same")
+    dep = os.path.join(tmp, "dep.tar.gz")
+    with archive.TarFileWriter(dep, "gz") as f:
+      f.add_file("b/dep", content="dep")
+      f.add_file("a/dep", content="first")
+    # Every member is a run of its own.
+    with archive.TarFileWriter(self.tempfile, deduplicate=True, sort=True,
+                               sort_buffer_size=1) as f:
+      f.add_file("./c/file", file_content=content)
+      f.add_tar(dep)
+      f.add_file("./a/dep", content="shadowed")
+      f.add_file("./a/link", tarfile.SYMTYPE, link="dep")
+      f.add_file("./a/file", file_content=content)
+      for i in reversed(range(100)):
+        f.add_file("./d/%02d" % i)
+      self.assertGreater(f._sorter.runs, archive._SORT_MAX_RUNS)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./a"},
+        {"name": "./a/dep", "data": b"first"},
+        {"name": "./a/file", "data": b"same"},
+        {"name": "./a/link", "type": tarfile.SYMTYPE, "linkname": "dep"},
+        {"name": "./b"},
+        {"name": "./b/dep", "data": b"dep"},
+        {"name": "./c"},
+        {"name": "./c/file", "type": tarfile.LNKTYPE,
+         "linkname": "./a/file"},
+        {"name": "./d"},
+    ] + [{"name": "./d/%02d" % i} for i in range(100)])
+
+    # Hard links sorting before their target come right after it.
+    links = os.path.join(tmp, "links.tar")
+    with archive.TarFileWriter(links) as f:
+      f.add_file("z/target", content="target")
+      f.add_file("alink", tarfile.LNKTYPE, link="z/target")
+      f.add_file("blink", tarfile.LNKTYPE, link="./alink")
+      f.add_file("dangling", tarfile.LNKTYPE, link="missing")
+    with archive.TarFileWriter(self.tempfile, sort=True) as f:
+      f.add_tar(links)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "."},
+        {"name": "./z"},
+        {"name": "./z/target", "data": b"target"},
+        {"name": "./alink", "type": tarfile.LNKTYPE, "linkname": "z/target"},
+        {"name": "./blink", "type": tarfile.LNKTYPE, "linkname": "./alink"},
+        {"name": "./dangling", "type": tarfile.LNKTYPE,
+         "linkname": "missing"},
+    ])
+
+  def testVolumes(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "volumes")
+    os.makedirs(tmp)
+    # Content that does not compress too well.
+    contents = [os.urandom(5000).hex() for _ in range(20)]
+    for compression in ["", "gz", "bz2"]:
+      extension = compression and "." + compression
+      output = os.path.join(tmp, "out.tar" + extension)
+      with archive.TarFileWriter(output, compression,
+                                 volume_size=64 * 1024) as f:
+        for i in range(20):
+          f.add_file("./file%d" % i, content=contents[i])
+      with open(os.path.join(tmp, "out.volumes.json")) as f:
+        volumes = [json.loads(line) for line in f]
+      self.assertGreater(len(volumes), 2)
+      members = []
+      for i, volume in enumerate(volumes):
+        path = os.path.join(tmp, volume["name"])
+        self.assertEqual(volume["name"], "out.%03d.tar%s" % (i + 1, extension))
+        self.assertEqual(os.path.getsize(path), volume["size"])
+        self.assertLessEqual(volume["size"], 64 * 1024)
+        with tarfile.open(path) as tar:
+          self.assertEqual(tar.getnames(),
+                           [name.rstrip("/") for name in volume["members"]])
+          for name in volume["members"][1 if i == 0 else 0:]:
+            self.assertEqual(tar.extractfile(name).read(),
+                             contents[int(name[len("./file"):])].encode())
+        members += volume["members"]
+      self.assertEqual(members,
+                       ["./"] + ["./file%d" % i for i in range(20)])
+    # A failed build leaves no volume behind.
+    tmp = os.path.join(tmp, "failed")
+    os.makedirs(tmp)
+    output = os.path.join(tmp, "out.tar")
+    with self.assertRaises(archive.TarFileWriter.Error):
+      with archive.TarFileWriter(output, volume_size=16 * 1024) as f:
+        f.add_file("./small", content="x")
+        f.add_file("./big", content="x" * 100000)
+    self.assertEqual(os.listdir(tmp), [])
+    with self.assertRaises(ValueError):
+      with archive.TarFileWriter(output, volume_size=64 * 1024) as f:
+        for i in range(20):
+          f.add_file("./file%d" % i, content=contents[i])
+        raise ValueError()
+    self.assertEqual(os.listdir(tmp), [])
+
+  def testDigestManifest(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "digests")
+    os.makedirs(tmp)
+    big = os.path.join(tmp, "big")
+    with open(big, "wb") as f:
+      f.write(b"".join(b"%d\n" % i for i in range(300000)))
+    sparse = os.path.join(tmp, "sparse")
+    with open(sparse, "wb") as f:
+      f.truncate(1024 * 1024)
+      f.seek(4096)
+      f.write(b"data")
+    dep = os.path.join(tmp, "dep.tar")
+    with archive.TarFileWriter(dep) as f:
+      f.add_file("./dep", content="from a dep")
+    manifest = os.path.join(tmp, "out.digests")
+    cache = os.path.join(tmp, "cache")
+    for settings in [{}, {"pipeline": True}, {"sparse": True},
+                     {"deduplicate": True}, {"sort": True},
+                     {"compression": "gz", "cache_dir": cache},
+                     {"compression": "gz", "cache_dir": cache}]:
+      with self.subTest(**settings):
+        output = os.path.join(tmp, "out.tar")
+        with archive.TarFileWriter(output, digest_manifest=manifest,
+                                   **settings) as f:
+          f.add_file("./big", file_content=big)
+          f.add_file("./sparse", file_content=sparse)
+          f.add_file("./copy", file_content=big)
+          f.add_file("./empty", content="")
+          f.add_file("./link", tarfile.SYMTYPE, link="./big")
+          f.add_tar(dep)
+        with open(manifest) as f:
+          entries = [json.loads(line) for line in f]
+        with tarfile.open(output) as tar:
+          members = tar.getmembers()
+          self.assertEqual([entry["path"].rstrip("/") for entry in entries],
+                           [member.name for member in members])
+          for entry, member in zip(entries, members):
+            self.assertEqual(entry["size"], member.size)
+            self.assertEqual(entry["mode"], member.mode)
+            self.assertEqual(entry["uid"], member.uid)
+            self.assertEqual(entry["gid"], member.gid)
+            self.assertEqual(entry["link"], member.linkname or None)
+            if member.isreg():
+              self.assertEqual(entry["type"], "file")
+              self.assertEqual(
+                  entry["digest"], "sha256:" + hashlib.sha256(
+                      tar.extractfile(member).read()).hexdigest())
+            else:
+              self.assertIsNone(entry["digest"])
+        types = {entry["path"]: entry["type"] for entry in entries}
+        self.assertEqual(types["./"], "directory")
+        self.assertEqual(types["./link"], "symlink")
+        self.assertEqual(types["./copy"],
+                         "hardlink" if settings.get("deduplicate") else "file")
+
+  def testDescriptor(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "descriptor")
+    os.makedirs(tmp)
+    content = os.path.join(tmp, "content")
+    with open(content, "wb") as f:
+      f.write(b"".join(b"%d\n" % i for i in range(200000)))
+    descriptor = os.path.join(tmp, "layer.json")
+    cache = os.path.join(tmp, "cache")
+    decompress = {"": lambda data: data, "gz": gzip.decompress}
+    for compression, settings in [("", {}), ("gz", {}),
+                                  ("gz", {"compression_threads": 2}),
+                                  ("gz", {"pipeline": True}),
+                                  ("gz", {"cache_dir": cache}),
+                                  ("gz", {"cache_dir": cache})]:
+      with self.subTest(compression=compression, **settings):
+        with archive.TarFileWriter(self.tempfile, compression,
+                                   descriptor=descriptor, **settings) as f:
+          f.add_file("./content", file_content=content)
+          f.add_file("./small", content="small")
+        with open(self.tempfile, "rb") as f:
+          data = f.read()
+        with open(descriptor) as f:
+          layer = json.load(f)
+        tar = decompress[compression](data)
+        self.assertEqual(layer, {
+            "mediaType": "application/vnd.oci.image.layer.v1.tar" + (
+                "+gzip" if compression else ""),
+            "digest": "sha256:" + hashlib.sha256(data).hexdigest(),
+            "size": len(data),
+            "diffID": "sha256:" + hashlib.sha256(tar).hexdigest(),
+            "uncompressedSize": len(tar),
+        })
+    with self.assertRaises(archive.TarFileWriter.Error):
+      archive.TarFileWriter(self.tempfile, descriptor=descriptor,
+                            volume_size=1024 * 1024)
+
+  def testMergeTars(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "layers")
+    os.makedirs(tmp)
+
+    def layer(name, entries):
+      path = os.path.join(tmp, name)
+      with tarfile.open(path, "w:gz" if name.endswith(".gz") else "w") as tar:
+        for entry in entries:
+          info = tarfile.TarInfo(entry[0])
+          if entry[1] == tarfile.REGTYPE:
+            info.size = len(entry[2])
+            tar.addfile(info, io.BytesIO(entry[2]))
+          else:
+            info.type = entry[1]
+            info.linkname = entry[2] if len(entry) > 2 else ""
+            tar.addfile(info)
+      return path
+
+    layers = [
+        layer("layer1.tar", [
+            ("./", tarfile.DIRTYPE),
+            ("./a/", tarfile.DIRTYPE),
+            ("./a/x", tarfile.REGTYPE, b"x"),
+            ("./b/", tarfile.DIRTYPE),
+            ("./b/y", tarfile.REGTYPE, b"y"),
+            ("./c/", tarfile.DIRTYPE),
+            ("./c/z", tarfile.REGTYPE, b"z"),
+            ("./f", tarfile.REGTYPE, b"old f"),
+            ("./g", tarfile.LNKTYPE, "./f"),
+        ]),
+        layer("layer2.tar.gz", [
+            ("./a/.wh..wh..opq", tarfile.REGTYPE, b""),
+            ("./a/new", tarfile.REGTYPE, b"new"),
+            ("./.wh.b", tarfile.REGTYPE, b""),
+            ("./c", tarfile.REGTYPE, b"c is a file"),
+            ("./f", tarfile.REGTYPE, b"new f"),
+        ]),
+        layer("layer3.tar", [
+            ("./h", tarfile.REGTYPE, b"h"),
+        ]),
+    ]
+    for settings in [{}, {"low_memory": True}]:
+      with self.subTest(**settings):
+        with archive.TarFileWriter(self.tempfile, **settings) as f:
+          f.merge_tars(layers)
+        self.assertTarFileContent(self.tempfile, [
+            {"name": ".", "type": tarfile.DIRTYPE},
+            {"name": "./a", "type": tarfile.DIRTYPE},
+            # A hard link to a shadowed file gets its content.
+            {"name": "./g", "type": tarfile.REGTYPE, "data": b"old f"},
+            {"name": "./a/new", "data": b"new"},
+            {"name": "./c", "data": b"c is a file"},
+            {"name": "./f", "data": b"new f"},
+            {"name": "./h", "data": b"h"},
+        ])
+
+  def testDecompressAhead(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "decompress")
+    os.makedirs(tmp)
+    deps = []
+    for i, compression in enumerate(["gz", "bz2", "gz", ""]):
+      dep = os.path.join(tmp, "dep%d.tar%s" % (i, compression and
+                                               "." + compression))
+      with archive.TarFileWriter(dep, compression) as f:
+        for j in range(10):
+          f.add_file("./dep%d/file%d" % (i, j),
+                     content=os.urandom(10000).hex())
+        f.add_file("./shared", content="from dep %d" % i)
+      deps.append(dep)
+
+    # Compressed source files, which are not decompressed ahead.
+    sources = []
+    for i in range(3):
+      sources.append(os.path.join(tmp, "source%d.gz" % i))
+      with gzip.open(sources[-1], "wb") as f:
+        f.write(b"source %d" % i)
+
+    def build(decompress_ahead, planned, merged):
+      with archive.TarFileWriter(self.tempfile,
+                                 decompress_ahead=decompress_ahead) as f:
+        f.prefetch_files(sources + planned)
+        f.prefetch_tars(planned)
+        for i, source in enumerate(sources):
+          f.add_file("./source%d.gz" % i, file_content=source)
+        for dep in merged:
+          f.add_tar(dep)
+        if f.decompressor:
+          self.decompressed = f.decompressor.decompressed
+      with open(self.tempfile, "rb") as f:
+        return f.read()
+
+    self.assertEqual(build(2, deps, deps), build(0, deps, deps))
+    self.assertEqual(self.decompressed, 3)
+    # Deps planned and not merged, or merged and not planned.
+    self.assertEqual(build(1, deps, deps[1:]), build(0, [], deps[1:]))
+    self.assertEqual(build(2, deps[:2], deps), build(0, [], deps))
+    self.assertEqual(build(2, deps + deps, deps + deps),
+                     build(0, [], deps + deps))
+    self.assertEqual(self.decompressed, 6)
+
+  def testExtraOutputs(self):
+    tmp = os.path.join(os.environ["TEST_TMPDIR"], "extra_outputs")
+    os.makedirs(os.path.join(tmp, "alone"))
+    content = os.path.join(tmp, "content")
+    with open(content, "wb") as f:
+      f.write(b"".join(b"%d\n" % i for i in range(200000)))
+    extras = [("out.tar", ""), ("out.tar.bz2", "bz2"), ("out.tar.xz", "xz")]
+
+    def build(name, compression, **kwargs):
+      with archive.TarFileWriter(os.path.join(tmp, name), compression,
+                                 default_mtime="portable", **kwargs) as f:
+        f.add_file("./dir", tarfile.DIRTYPE)
+        f.add_file("./dir/big", file_content=content)
+        f.add_file("./dir/small", content="small", mode=0o600)
+        f.add_file("./dir/link", tarfile.SYMTYPE, link="small")
+        f.add_file("./dir/hard", tarfile.LNKTYPE, link="./dir/small")
+
+    build("out.tar.gz", "gz",
+          extra_outputs=[(os.path.join(tmp, name), compression)
+                         for name, compression in extras + [("out.zip", "zip")]])
+    for name, compression in [("out.tar.gz", "gz")] + extras:
+      build(os.path.join("alone", name), compression, pipeline=True)
+      with open(os.path.join(tmp, name), "rb") as f:
+        with open(os.path.join(tmp, "alone", name), "rb") as alone:
+          self.assertEqual(f.read(), alone.read(), name)
+
+    with open(content, "rb") as f:
+      data = f.read()
+    with zipfile.ZipFile(os.path.join(tmp, "out.zip")) as z:
+      self.assertEqual(
+          [(i.filename, i.external_attr >> 16, i.date_time)
+           for i in z.infolist()],
+          [("dir/", 0o40755, (2000, 1, 1, 0, 0, 0)),
+           ("dir/big", 0o644, (2000, 1, 1, 0, 0, 0)),
+           ("dir/small", 0o600, (2000, 1, 1, 0, 0, 0)),
+           ("dir/link", 0o120755, (2000, 1, 1, 0, 0, 0))])
+      self.assertEqual(z.read("dir/big"), data)
+      self.assertEqual(z.read("dir/small"), b"small")
+      self.assertEqual(z.read("dir/link"), b"small")
+    with self.assertRaises(archive.TarFileWriter.Error):
+      build("bad.tar.gz", "gz", deduplicate=True,
+            extra_outputs=[(os.path.join(tmp, "bad.zip"), "zip")])
+    # No temporary file is left behind when an extra output cannot be
+    # written.
+    with self.assertRaises(archive.TarFileWriter.Error):
+      build("bad.tar.gz", "gz",
+            extra_outputs=[(os.path.join(tmp, "bad.rar"), "rar")])
+    with self.assertRaises(FileNotFoundError):
+      build("bad.tar.gz", "gz",
+            extra_outputs=[(os.path.join(tmp, "bad.tar"), ""),
+                           (os.path.join(tmp, "missing", "bad.zip"), "zip")])
+    self.assertEqual([name for name in os.listdir(tmp)
+                      if name.startswith("bad.")], [])
+
+  def testOutputFile(self):
+    path = os.path.join(os.environ["TEST_TMPDIR"], "output_file")
+    with archive.OutputFile(path, size_hint=1024 * 1024,
+                            buffer_size=4096) as output:
+      self.assertFalse(os.path.exists(path))
+      output.write(b"header")
+      output.write(b"x" * 10000)
+      output.write(b"tail")
+      output.seek(0)
+      output.write(b"HEADER")
+      output.seek(0, os.SEEK_END)
+      output.write(b"!")
+      self.assertEqual(output.tell(), 10011)
+    with open(path, "rb") as f:
+      self.assertEqual(f.read(), b"HEADER" + b"x" * 10000 + b"tail!")
+    # One fallocate, a write for the big chunk, two for each seek and the
+    # final write and ftruncate, never one per write() call.
+    self.assertLessEqual(output.syscalls, 9)
+    self.assertEqual(os.listdir(os.environ["TEST_TMPDIR"]).count(
+        "output_file"), 1)
+    with self.assertRaises(ValueError):
+      with archive.OutputFile(path) as f:
+        f.write(b"partial")
+        raise ValueError()
+    with open(path, "rb") as f:
+      self.assertEqual(f.read(), b"HEADER" + b"x" * 10000 + b"tail!")
+    self.assertEqual([name for name in os.listdir(os.environ["TEST_TMPDIR"])
+                      if name.startswith("output_file.")], [])
+
+    # Only uncompressed outputs are preallocated, compressed ones would be
+    # truncated back.
+    with archive.TarFileWriter(self.tempfile, "gz",
+                               size_hint=1024 * 1024) as f:
+      self.assertEqual(f.output._preallocated, 0)
+
+    # Outputs that are not regular files are written to, not replaced.
+    fifo = os.path.join(os.environ["TEST_TMPDIR"], "output_fifo")
+    os.mkfifo(fifo)
+    received = []
+
+    def read():
+      with open(fifo, "rb") as f:
+        received.append(f.read())
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    with archive.OutputFile(fifo, size_hint=1024 * 1024) as output:
+      output.write(b"through the fifo")
+    reader.join()
+    self.assertEqual(received, [b"through the fifo"])
+    self.assertTrue(stat.S_ISFIFO(os.stat(fifo).st_mode))
+    with archive.TarFileWriter(os.devnull) as f:
+      f.add_file("./file", content="content")
+    self.assertTrue(stat.S_ISCHR(os.stat(os.devnull).st_mode))
+
+    # All the outputs are removed when closing fails.
+    failed = os.path.join(os.environ["TEST_TMPDIR"], "failed_close")
+    os.makedirs(failed)
+    writer = archive.TarFileWriter(os.path.join(failed, "out.tar"),
+                                   compressor="false",
+                                   digest_manifest=os.path.join(
+                                       failed, "digests.jsonl"))
+    with self.assertRaises((archive.TarFileWriter.Error, OSError)):
+      with writer:
+        writer.add_file("./file", content="x" * (1024 * 1024))
+    self.assertEqual(os.listdir(failed), [])
+
   def testDefaultMtimeNotProvided(self):
     with archive.TarFileWriter(self.tempfile) as f:
       self.assertEqual(f.default_mtime, 0)
@@ -350,6 +1287,14 @@ class TarFileWriterTest(unittest.TestCase):
     ]
     self.assertTarFileContent(self.tempfile, content)
 
+  def testAddDirDepthLimit(self):
+    tree = os.path.join(os.environ["TEST_TMPDIR"], "deep_tree")
+    os.makedirs(os.path.join(tree, "a", "b", "c"))
+    with archive.TarFileWriter(self.tempfile) as f:
+      f.add_dir("tree", tree, depth=4)
+      with self.assertRaises(archive.TarFileWriter.Error):
+        f.add_dir("other", tree, depth=3)
+
   def testChangingRootDirectory(self):
     with archive.TarFileWriter(self.tempfile, root_directory="root") as f:
       f.add_file("d", tarfile.DIRTYPE)
@@ -384,6 +1329,20 @@ class TarFileWriterTest(unittest.TestCase):
     ]
     self.assertTarFileContent(self.tempfile, content)
 
+  def testChangingRootDirectoryToNestedPath(self):
+    with archive.TarFileWriter(self.tempfile, root_directory="./root") as f:
+      f.add_file("d/e/f", mtime=12)
+      f.add_file("/abs/f")
+    content = [
+        {"name": "./root", "mode": 0o755, "mtime": 12},
+        {"name": "./root/d", "mode": 0o755, "mtime": 12},
+        {"name": "./root/d/e", "mode": 0o755, "mtime": 12},
+        {"name": "./root/d/e/f"},
+        {"name": "/abs", "mode": 0o755},
+        {"name": "/abs/f"},
+    ]
+    self.assertTarFileContent(self.tempfile, content)
+
   def testPackageDirFileAttribute(self):
     """Tests package_dir and package_dir_file attributes of pkg_tar.
 
@@ -13,6 +13,8 @@
 # limitations under the License.
 """Testing for archive."""
 
+import hashlib
+import json
 import tarfile
 import unittest
 
@@ -181,6 +183,32 @@ class PkgTarTest(unittest.TestCase):
         self.assertTarFileContent('test-tar-inclusion-%s.tar' % ext[1:],
                                   content)
 
+  def test_digest_manifest(self):
+    r = runfiles.Create()
+    with open(r.Rlocation('rules_pkg/tests/test-tar-digests.tar.gz.digests'),
+              'r') as f:
+      entries = [json.loads(line) for line in f]
+    by_path = {entry['path']: entry for entry in entries}
+    self.assertEqual(by_path['./usr/bin/java']['type'], 'symlink')
+    self.assertEqual(by_path['./usr/bin/java']['link'], '/path/to/bin/java')
+    self.assertEqual(by_path['./usr/titi']['mode'], 0o755)
+    self.assertEqual(by_path['./etc/nsswitch.conf']['uid'], 24)
+    with tarfile.open(
+        r.Rlocation('rules_pkg/tests/test-tar-digests.tar.gz')) as f:
+      members = f.getmembers()
+      self.assertEqual([entry['path'].rstrip('/') for entry in entries],
+                       [member.name for member in members])
+      for entry, member in zip(entries, members):
+        self.assertEqual(entry['size'], member.size)
+        if member.isfile():
+          self.assertEqual(entry['type'], 'file')
+          self.assertEqual(
+              entry['digest'],
+              'sha256:' + hashlib.sha256(f.extractfile(member).read())
+              .hexdigest())
+        else:
+          self.assertIsNone(entry['digest'])
+
   def test_strip_prefix_empty(self):
     content = [
         {'name': '.'},